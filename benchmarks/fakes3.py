@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""In-process stand-in for the S3 client used by the benchmarks.
+
+Objects are kept as sizes and ETags only; their content reads as zero
+bytes. Every request costs a fixed latency, data moving between client
+and S3 shares the client's link bandwidth, and server-side copies run
+at a per-request rate. Requests may be throttled per key prefix.
+"""
+from __future__ import absolute_import
+import hashlib
+import itertools
+import posixpath
+import random
+import threading
+import time
+from collections import Counter
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+
+MB = 1024 * 1024
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * 1024 * MB
+MAX_PARTS = 10000
+
+
+def _error(op, code, status, message=''):
+    return ClientError({
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status}}, op)
+
+
+def _etag(*args):
+    return '"{}"'.format(hashlib.md5(repr(args)).hexdigest())
+
+
+def _size(body):
+    if hasattr(body, 'read'):
+        body = body.read()
+    return len(body)
+
+
+def _parse_range(byte_range, size):
+    start, end = byte_range[len('bytes='):].split('-')
+    start, end = int(start), min(int(end), size - 1)
+    if start > end:
+        raise ValueError(byte_range)
+    return start, end
+
+
+class _Body(object):
+    """Streaming body of zero bytes."""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size=None):
+        if size is None or size > self.remaining:
+            size = self.remaining
+        self.remaining -= size
+        return '\0' * size
+
+
+class Stats(object):
+    """What the requests made to a fake S3 cost."""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.throttled = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.bytes_copied = 0
+
+    def as_dict(self):
+        return {
+            'requests': dict(self.requests),
+            'throttled': self.throttled,
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_uploaded': self.bytes_uploaded,
+            'bytes_copied': self.bytes_copied}
+
+
+class FakeS3(object):
+    """S3 client implementing the requests s3concat makes.
+
+    `latency` is the seconds every request takes, `bandwidth` the bytes
+    per second of the link shared by all requests moving data to or from
+    the client, and `copy_rate` the bytes per second at which a single
+    server-side copy proceeds. A prefix receiving more than
+    `throttle_rate` requests in a second, and any request with
+    probability `throttle_probability`, fails with SlowDown.
+    """
+
+    def __init__(self, latency=0., bandwidth=None, copy_rate=None,
+                 throttle_rate=None, throttle_probability=0.,
+                 random=random.random, clock=time.time, sleep=time.sleep):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.copy_rate = copy_rate
+        self.throttle_rate = throttle_rate
+        self.throttle_probability = throttle_probability
+        self.random = random
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = Stats()
+        self._objects = {}
+        self._sorted = {}
+        self._uploads = {}
+        self._windows = {}
+        self._link_free = 0.
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add_object(self, bucket, key, size):
+        """Create an object without making a request."""
+        self._store(bucket, key, size, _etag(bucket, key, size))
+
+    def get_size(self, bucket, key):
+        return self._objects[bucket, key][0]
+
+    def _store(self, bucket, key, size, etag):
+        if (bucket, key) not in self._objects:
+            self._sorted.pop(bucket, None)
+        self._objects[bucket, key] = (size, etag)
+
+    def _request(self, op, bucket, key=None, transfer=0, copy=0):
+        """Account for a request and wait for as long as it takes."""
+        now = self.clock()
+        with self._lock:
+            self.stats.requests[op] += 1
+            throttled = self.random() < self.throttle_probability
+            if self.throttle_rate is not None:
+                prefix = (bucket, posixpath.dirname(key or ''))
+                window = self._windows.setdefault(prefix, deque())
+                while window and window[0] <= now - 1:
+                    window.popleft()
+                if len(window) >= self.throttle_rate:
+                    throttled = True
+                else:
+                    window.append(now)
+            done = now + self.latency
+            if throttled:
+                self.stats.throttled += 1
+            else:
+                if transfer and self.bandwidth:
+                    # Transfers queue up for the link in request order.
+                    start = max(now, self._link_free)
+                    self._link_free = start + float(transfer) / self.bandwidth
+                    done = max(done, self._link_free)
+                if copy and self.copy_rate:
+                    done += float(copy) / self.copy_rate
+        if done > now:
+            self.sleep(done - now)
+        if throttled:
+            raise _error(op, 'SlowDown', 503, 'Please reduce your request '
+                         'rate.')
+
+    def _get(self, op, bucket, key):
+        try:
+            return self._objects[bucket, key]
+        except KeyError:
+            raise _error(op, 'NoSuchKey', 404)
+
+    def _get_upload(self, op, upload_id):
+        try:
+            return self._uploads[upload_id]
+        except KeyError:
+            raise _error(op, 'NoSuchUpload', 404)
+
+    def head_object(self, Bucket, Key):
+        self._request('HeadObject', Bucket, Key)
+        if (Bucket, Key) not in self._objects:
+            raise _error('HeadObject', '404', 404)
+        size, etag = self._objects[Bucket, Key]
+        return {'ContentLength': size, 'ETag': etag}
+
+    def get_object(self, Bucket, Key, Range=None):
+        size, etag = self._objects.get((Bucket, Key), (0, None))
+        start, end = 0, size - 1
+        if Range is not None and size:
+            start, end = _parse_range(Range, size)
+        self._request('GetObject', Bucket, Key, transfer=end - start + 1)
+        self._get('GetObject', Bucket, Key)
+        self.stats.bytes_downloaded += end - start + 1
+        return {'Body': _Body(end - start + 1), 'ContentLength':
+                end - start + 1, 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body=''):
+        size = _size(Body)
+        self._request('PutObject', Bucket, Key, transfer=size)
+        self.stats.bytes_uploaded += size
+        etag = _etag(Bucket, Key, size, next(self._ids))
+        self._store(Bucket, Key, size, etag)
+        return {'ETag': etag}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._request('CreateMultipartUpload', Bucket, Key)
+        upload_id = 'upload-{}'.format(next(self._ids))
+        self._uploads[upload_id] = (Bucket, Key, {})
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        size = _size(Body)
+        self._request('UploadPart', Bucket, Key, transfer=size)
+        parts = self._get_upload('UploadPart', UploadId)[2]
+        self.stats.bytes_uploaded += size
+        etag = _etag(UploadId, PartNumber, size, next(self._ids))
+        parts[PartNumber] = (size, etag)
+        return {'ETag': etag}
+
+    def upload_part_copy(self, Bucket, Key, PartNumber, UploadId,
+                         CopySource, CopySourceRange=None,
+                         CopySourceIfMatch=None):
+        src = (CopySource['Bucket'], CopySource['Key'])
+        size, etag = self._get('UploadPartCopy', *src)
+        if CopySourceIfMatch not in (None, etag):
+            raise _error('UploadPartCopy', 'PreconditionFailed', 412)
+        start, end = 0, size - 1
+        if CopySourceRange is not None:
+            start, end = _parse_range(CopySourceRange, size)
+        self._request('UploadPartCopy', Bucket, Key, copy=end - start + 1)
+        parts = self._get_upload('UploadPartCopy', UploadId)[2]
+        if end - start + 1 > MAX_PART_SIZE:
+            raise _error('UploadPartCopy', 'InvalidRequest', 400,
+                         'The specified copy source is larger than the '
+                         'maximum allowable size for a copy source')
+        self.stats.bytes_copied += end - start + 1
+        etag = _etag(UploadId, PartNumber, src, start, end)
+        parts[PartNumber] = (end - start + 1, etag)
+        return {'CopyPartResult': {'ETag': etag}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self._request('CompleteMultipartUpload', Bucket, Key)
+        parts = self._get_upload('CompleteMultipartUpload', UploadId)[2]
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        if not numbers or len(numbers) > MAX_PARTS or (
+                numbers != sorted(set(numbers))):
+            raise _error('CompleteMultipartUpload', 'InvalidPartOrder', 400)
+        sizes = []
+        for part in MultipartUpload['Parts']:
+            size, etag = parts.get(part['PartNumber'], (None, None))
+            if etag != part['ETag']:
+                raise _error('CompleteMultipartUpload', 'InvalidPart', 400)
+            sizes.append(size)
+        if any(size < MIN_PART_SIZE for size in sizes[:-1]):
+            raise _error('CompleteMultipartUpload', 'EntityTooSmall', 400)
+        del self._uploads[UploadId]
+        etag = '"{}-{}"'.format(
+            _etag(UploadId)[1:-1], len(MultipartUpload['Parts']))
+        self._store(Bucket, Key, sum(sizes), etag)
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request('AbortMultipartUpload', Bucket, Key)
+        self._uploads.pop(UploadId, None)
+        return {}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0,
+                   MaxParts=1000):
+        self._request('ListParts', Bucket, Key)
+        parts = self._get_upload('ListParts', UploadId)[2]
+        numbers = sorted(n for n in parts if n > PartNumberMarker)
+        page = numbers[:MaxParts]
+        resp = {'Parts': [
+            {'PartNumber': n, 'Size': parts[n][0], 'ETag': parts[n][1]}
+            for n in page], 'IsTruncated': len(numbers) > MaxParts}
+        if resp['IsTruncated']:
+            resp['NextPartNumberMarker'] = page[-1]
+        return resp
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None,
+                        MaxKeys=1000):
+        self._request('ListObjectsV2', Bucket, Prefix)
+        keys = self._sorted.get(Bucket)
+        if keys is None:
+            keys = self._sorted[Bucket] = sorted(
+                k for b, k in self._objects if b == Bucket)
+        after = ContinuationToken or ''
+        matched = [k for k in keys if k.startswith(Prefix) and k > after]
+        page = matched[:MaxKeys]
+        resp = {'Contents': [], 'IsTruncated': len(matched) > MaxKeys}
+        for key in page:
+            size, etag = self._objects[Bucket, key]
+            resp['Contents'].append({'Key': key, 'Size': size, 'ETag': etag})
+        if resp['IsTruncated']:
+            resp['NextContinuationToken'] = page[-1]
+        return resp
+
+    def delete_objects(self, Bucket, Delete):
+        self._request('DeleteObjects', Bucket)
+        deleted = []
+        for obj in Delete['Objects']:
+            if self._objects.pop((Bucket, obj['Key']), None) is not None:
+                self._sorted.pop(Bucket, None)
+            deleted.append({'Key': obj['Key']})
+        return {'Deleted': deleted}
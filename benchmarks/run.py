@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Benchmark s3concat against a fake S3 with injected latency.
+
+Each scenario runs in a process of its own, so that its peak memory is
+measured apart from the others. Results can be saved as JSON and
+compared with a saved baseline; the exit status is 1 when a scenario
+got worse than the baseline by more than the tolerance.
+
+Run from the top of the source tree::
+
+    python -m benchmarks.run --latency 0.02 mixed huge
+"""
+from __future__ import absolute_import
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import resource
+import sys
+import time
+import traceback
+
+from s3concat import executors
+from s3concat import s3concat
+from s3concat import s3concat_content
+from s3concat.s3concat import CONCURRENCY
+
+from .fakes3 import FakeS3
+
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+BUCKET = 'bench'
+
+
+def _tiny(s3, rng, scale):
+    """Many objects of a few KB, found by listing a prefix."""
+    s3.add_object(BUCKET, 'tiny/target', 4 * KB)
+    for i in xrange(int(2000 * scale)):
+        s3.add_object(BUCKET, 'tiny/src/{:06d}'.format(i),
+                      rng.randint(KB, 64 * KB))
+    return lambda **kw: s3concat(
+        ['s3://{}/tiny/target'.format(BUCKET),
+         's3://{}/tiny/src/'.format(BUCKET)], **kw)
+
+
+def _mixed(s3, rng, scale):
+    """Objects of log-normally distributed sizes around 1 MB."""
+    urls = []
+    for i in xrange(int(300 * scale)):
+        size = int(rng.lognormvariate(math.log(MB), 2))
+        key = 'mixed/{:06d}'.format(i)
+        s3.add_object(BUCKET, key, max(1, min(size, 5 * GB)))
+        urls.append('s3://{}/{}'.format(BUCKET, key))
+    return lambda **kw: s3concat(urls, **kw)
+
+
+def _huge(s3, rng, scale):
+    """A few objects of several GB and some small ones in between."""
+    urls = []
+    for i in xrange(max(2, int(4 * scale))):
+        for key, size in (('huge/{}'.format(i), rng.randint(4, 8) * GB),
+                          ('huge/{}.tail'.format(i), rng.randint(1, 3) * MB)):
+            s3.add_object(BUCKET, key, size)
+            urls.append('s3://{}/{}'.format(BUCKET, key))
+    return lambda **kw: s3concat(urls, **kw)
+
+
+def _chunks(size, chunk_size=MB):
+    chunk = '\0' * chunk_size
+    for _ in xrange(size // chunk_size):
+        yield chunk
+    if size % chunk_size:
+        yield '\0' * (size % chunk_size)
+
+
+def _append(s3, rng, scale):
+    """Content streamed onto the end of a large object."""
+    s3.add_object(BUCKET, 'append/big', 10 * GB)
+    size = int(64 * MB * scale)
+    return lambda **kw: s3concat_content(
+        BUCKET, 'append/big', _chunks(size), **kw)
+
+
+def _append_small(s3, rng, scale):
+    """Content appended to an object too small to be copied as a part."""
+    s3.add_object(BUCKET, 'append/small', MB)
+    size = int(8 * MB * scale)
+    return lambda **kw: s3concat_content(
+        BUCKET, 'append/small', _chunks(size), **kw)
+
+
+SCENARIOS = [
+    ('tiny', _tiny),
+    ('mixed', _mixed),
+    ('huge', _huge),
+    ('append', _append),
+    ('append-small', _append_small),
+]
+
+
+def _run(name, options):
+    executors.configure(options['backend'])
+    # Latency blocks as botocore does on its sockets, unless the run
+    # stands for a process monkey-patched on purpose.
+    s3 = FakeS3(latency=options['latency'], bandwidth=options['bandwidth'],
+                copy_rate=options['copy_rate'],
+                throttle_rate=options['throttle_rate'],
+                throttle_probability=options['throttle_probability'],
+                random=random.Random(options['seed']).random,
+                sleep=executors.sleep if options['patched'] else time.sleep)
+    job = dict(SCENARIOS)[name](
+        s3, random.Random(options['seed']), options['scale'])
+    start = time.time()
+    job(concurrency=options['concurrency'], client=s3)
+    result = s3.stats.as_dict()
+    result['wall_time'] = time.time() - start
+    # ru_maxrss is in kilobytes on Linux.
+    result['peak_memory'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss * KB
+    return result
+
+
+def _child(queue, name, options):
+    try:
+        queue.put(_run(name, options))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def run_scenario(name, options):
+    """Run a scenario in a new process and return what it measured."""
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_child, args=(queue, name, options))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+# Metrics compared with a baseline, and whether they are too noisy to
+# be compared within the same tolerance as request and byte counts.
+METRICS = [
+    ('requests', False),
+    ('bytes_client', False),
+    ('bytes_copied', False),
+    ('wall_time', True),
+    ('peak_memory', True),
+]
+
+
+def _metrics(result):
+    return {
+        'requests': sum(result['requests'].values()),
+        'bytes_client': result['bytes_downloaded'] + result['bytes_uploaded'],
+        'bytes_copied': result['bytes_copied'],
+        'wall_time': result['wall_time'],
+        'peak_memory': result['peak_memory'],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of the metrics that regressed."""
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if 'error' in result or 'error' in baseline.get(name, {'error': 0}):
+            continue
+        new, old = _metrics(result), _metrics(baseline[name])
+        for metric, noisy in METRICS:
+            limit = old[metric] * (1 + tolerance * (2 if noisy else 1))
+            if new[metric] > limit:
+                regressions.append('{}: {} rose from {} to {}'.format(
+                    name, metric, old[metric], new[metric]))
+    return regressions
+
+
+def _format(name, result):
+    if 'error' in result:
+        return '{:<14}error\n{}'.format(name, result['error'])
+    m = _metrics(result)
+    return ('{:<14}{:>9d}{:>10d}{:>12.1f}{:>12.1f}{:>10.2f}{:>10.1f}'.format(
+        name, m['requests'], result['throttled'],
+        float(m['bytes_client']) / MB, float(m['bytes_copied']) / MB,
+        m['wall_time'], float(m['peak_memory']) / MB))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        'scenarios', nargs='*', metavar='scenario',
+        help='scenarios to run, out of {} (default: all)'.format(
+            ', '.join(name for name, _ in SCENARIOS)))
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=100.,
+                        help='MB/s of the client link')
+    parser.add_argument('--copy-rate', type=float, default=500.,
+                        help='MB/s of a server-side copy')
+    parser.add_argument('--throttle-rate', type=int,
+                        help='requests per second a prefix takes before '
+                        'throttling')
+    parser.add_argument('--throttle-probability', type=float, default=0.,
+                        help='probability that any request is throttled')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--backend', choices=sorted(executors.BACKENDS),
+                        default='thread')
+    parser.add_argument('--patched', action='store_true',
+                        help='let injected latency yield to other '
+                        'greenlets, as in a monkey-patched process')
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='multiplier of the number or size of inputs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE',
+                        help='save results to FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with results saved in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative increase taken as a regression; '
+                        'doubled for wall time and memory')
+    args = parser.parse_args(argv)
+
+    names = args.scenarios or [name for name, _ in SCENARIOS]
+    unknown = set(names) - set(dict(SCENARIOS))
+    if unknown:
+        parser.error('unknown scenario: {}'.format(', '.join(sorted(unknown))))
+    options = {
+        'latency': args.latency,
+        'bandwidth': args.bandwidth * MB,
+        'copy_rate': args.copy_rate * MB,
+        'throttle_rate': args.throttle_rate,
+        'throttle_probability': args.throttle_probability,
+        'concurrency': args.concurrency,
+        'backend': args.backend,
+        'patched': args.patched,
+        'scale': args.scale,
+        'seed': args.seed,
+    }
+
+    print('{:<14}{:>9}{:>10}{:>12}{:>12}{:>10}{:>10}'.format(
+        'scenario', 'requests', 'throttled', 'client MB', 'copied MB',
+        'wall s', 'peak MB'))
+    results = {}
+    for name in names:
+        results[name] = run_scenario(name, options)
+        print(_format(name, results[name]))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': options, 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+    status = 1 if any('error' in r for r in results.itervalues()) else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
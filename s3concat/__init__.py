@@ -24,8 +24,16 @@
 # SOFTWARE.
 from __future__ import absolute_import
 
+from .appender import S3Appender  # noqa
+from .compact import s3compact  # noqa
+from .incremental import IncrementalCompactor  # noqa
+from .many import s3concat_many  # noqa
+from .s3concat import IntegrityError  # noqa
 from .s3concat import s3concat  # noqa
 from .s3concat import s3concat_content  # noqa
+from .s3concat import s3concat_plan  # noqa
+from .s3concat import s3concat_resume  # noqa
+from .split import s3split  # noqa
 
 
 __version__ = '0.1.0.dev'
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import logging
+import threading
+import time
+
+from . import executors
+from .planner import COPY_PART_SIZE
+from .planner import check_copy_part_size
+from .s3concat import CONCURRENCY
+from .s3concat import MB
+from .s3concat import _MultipartUpload
+from .s3concat import _add_copy_parts
+from .s3concat import _get_client
+from .s3concat import _get_object_info
+from .s3concat import s3concat_content
+
+
+log = logging.getLogger(__name__)
+
+
+class S3Appender(object):
+    """Append to an S3 object through a local buffer.
+
+    Writes are buffered until a full 5 MB part is available, which is
+    then uploaded into a multipart upload kept open on the object. The
+    upload is completed, making the appended data visible, on flush() or
+    close(). A flush also happens on write once `flush_size` bytes have
+    been written, and once `flush_interval` seconds by `clock` have
+    passed since the first unflushed write, whether or not more is
+    written. The latter is checked by poll(), which a background timer
+    calls when the interval is over; under the gevent backend, the timer
+    only fires while the process waits on gevent, so a writer that does
+    not should call poll() now and then. An existing object of 5 MB or
+    more is copied into the upload in parts of `copy_part_size` bytes.
+
+    Writes and flushes may come from different threads. An error in a
+    background flush is raised by the next call.
+    """
+
+    def __init__(self, bucket, key, flush_size=None, flush_interval=None,
+                 concurrency=CONCURRENCY, client=None,
+                 copy_part_size=COPY_PART_SIZE, clock=time.time):
+        check_copy_part_size(copy_part_size)
+        self.s3 = _get_client(client, concurrency)
+        self.bucket = bucket
+        self.key = key
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.concurrency = concurrency
+        self.copy_part_size = copy_part_size
+        self.clock = clock
+        self.closed = False
+        self._mpu = None
+        self._lock = threading.Lock()
+        self._cancel_timer = None
+        self._error = None
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, exc_tb):
+        if exc_t:
+            self.abort()
+        else:
+            self.close()
+
+    def _reset(self):
+        self._buffer = []
+        self._buffered = 0
+        self._unflushed = 0
+        self._first_write = None
+        if self._cancel_timer is not None:
+            self._cancel_timer()
+            self._cancel_timer = None
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, data):
+        with self._lock:
+            self._raise_error()
+            if self.closed:
+                raise ValueError('I/O operation on closed appender')
+            if not data:
+                return
+            if self._first_write is None:
+                self._first_write = self.clock()
+                if self.flush_interval is not None:
+                    self._cancel_timer = executors.later(
+                        self.flush_interval, self._on_timer)
+            self._buffer.append(data)
+            self._buffered += len(data)
+            self._unflushed += len(data)
+
+            if self._buffered >= 5 * MB:
+                self._upload_parts()
+
+            if self._should_flush():
+                self._flush()
+
+    def poll(self):
+        """Flush if `flush_interval` has passed since the first unflushed
+        write; returns whether it did.
+
+        Nothing is done while another thread is writing or flushing.
+        """
+        if not self._lock.acquire(False):
+            return False
+        try:
+            self._raise_error()
+            if (self.closed or self._first_write is None or
+                    self.flush_interval is None or
+                    self.clock() - self._first_write < self.flush_interval):
+                return False
+            self._flush()
+            return True
+        finally:
+            self._lock.release()
+
+    def _on_timer(self):
+        # The timer is spent; only a later write sets another.
+        self._cancel_timer = None
+        try:
+            self.poll()
+        except Exception as exc:
+            log.warning('Background flush to %s/%s failed: %r', self.bucket,
+                        self.key, exc)
+            self._error = exc
+
+    def _should_flush(self):
+        if (self.flush_size is not None and
+                self._unflushed >= self.flush_size):
+            return True
+        if (self.flush_interval is not None and
+                self.clock() - self._first_write >= self.flush_interval):
+            return True
+        return False
+
+    def _open(self):
+        mpu = _MultipartUpload(
+            self.bucket, self.key, self.concurrency, self.s3)
+        mpu.__enter__()
+        self._mpu = mpu
+
+        info = _get_object_info(self.bucket, self.key, self.s3)
+        if info is None or info['ContentLength'] == 0:
+            return
+        size = info['ContentLength']
+        if size < 5 * MB:
+            # Too small to be a part of its own; it becomes the head of
+            # the first uploaded part instead.
+            resp = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+            self._buffer.insert(0, resp['Body'].read())
+            self._buffered += size
+        else:
+            _add_copy_parts(
+                mpu, self.bucket, self.key, info, self.copy_part_size)
+
+    def _upload_parts(self, final=False):
+        if self._mpu is None:
+            self._open()
+        data = ''.join(self._buffer)
+        offset = 0
+        while len(data) - offset >= 5 * MB:
+            self._mpu.add_part(Body=data[offset:offset + 5 * MB])
+            offset += 5 * MB
+        if final and offset < len(data):
+            self._mpu.add_part(Body=data[offset:])
+            offset = len(data)
+        self._buffer = [data[offset:]] if offset < len(data) else []
+        self._buffered = len(data) - offset
+
+    def flush(self):
+        with self._lock:
+            self._raise_error()
+            self._flush()
+
+    def _flush(self):
+        if self._mpu is None:
+            if self._buffered:
+                s3concat_content(self.bucket, self.key, ''.join(self._buffer),
+                                 self.concurrency, self.s3,
+                                 self.copy_part_size)
+        else:
+            try:
+                self._upload_parts(final=True)
+                self._mpu.start()
+            except Exception:
+                log.exception('Error flushing to %s/%s; aborting',
+                              self.bucket, self.key)
+                self._abort()
+                raise
+            self._mpu = None
+        self._reset()
+
+    def close(self):
+        with self._lock:
+            self._raise_error()
+            if not self.closed:
+                self._flush()
+                self.closed = True
+
+    def abort(self):
+        with self._lock:
+            self._abort()
+
+    def _abort(self):
+        if self._mpu is not None:
+            self._mpu.abort()
+            self._mpu = None
+        self._reset()
+        self.closed = True
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class MetadataCache(object):
+    """Bounded LRU cache of object sizes and ETags.
+
+    Entries stored from this process's own writes are trusted for
+    `write_ttl` seconds, so that appending repeatedly to an object skips
+    its HEAD. Copies of such an entry's object are made conditional on
+    its ETag, so that a change by another writer fails them instead of
+    going unnoticed; set `write_ttl` to 0 when that happens often.
+    Entries from lookups and listings are trusted for `ttl` seconds, by
+    default not at all. A `maxsize` of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize=10000, ttl=0, write_ttl=60, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.write_ttl = write_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, bucket, key, trust_writes=True):
+        """Return (info, fresh) for a cached object, or None.
+
+        Without `trust_writes`, entries from this process's own writes
+        are only as fresh as `ttl` makes them.
+        """
+        with self._lock:
+            entry = self._entries.pop((bucket, key), None)
+            if entry is None:
+                return None
+            self._entries[(bucket, key)] = entry
+        info, stored, written = entry
+        ttl = self.write_ttl if written and trust_writes else self.ttl
+        return info, self.clock() - stored < ttl
+
+    def set(self, bucket, key, info, written=False):
+        """Store info, `written` if it comes from this process's write."""
+        if self.maxsize <= 0:
+            return
+        entry = (
+            {'ContentLength': info['ContentLength'], 'ETag': info['ETag']},
+            self.clock(), written)
+        with self._lock:
+            self._entries.pop((bucket, key), None)
+            self._entries[(bucket, key)] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bucket, key):
+        with self._lock:
+            self._entries.pop((bucket, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+metadata_cache = MetadataCache()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Command line interface.
+
+Concatenates the sources to the target given as arguments, or runs the
+jobs of a manifest, a file of one JSON object per line such as::
+
+    {"target": "s3://bucket/out", "sources": ["s3://bucket/in-1"]}
+
+where ``remove_orig`` may also be set. Jobs of a manifest run together
+as by :func:`s3concat.many.s3concat_many`.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import logging
+import sys
+
+from . import executors
+from .many import MAX_MEMORY
+from .many import s3concat_many
+from .planner import COPY_PART_SIZE
+from .planner import MB
+
+
+def _read_manifest(path):
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        jobs = []
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not (job['target'] and isinstance(job['sources'], list)):
+                    raise ValueError('no target or sources')
+            except (KeyError, TypeError, ValueError) as exc:
+                raise ValueError('{}:{}: invalid job: {}'.format(
+                    path, lineno, exc))
+            jobs.append(job)
+        return jobs
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _summary(result):
+    report = result.report
+    status = 'ok' if result.error is None else 'FAILED: {}'.format(
+        result.error)
+    return ('{} {} ({} requests, {} retries, {} bytes copied, {} uploaded, '
+            '{:.2f} s)'.format(result.target, status, report.requests,
+                               report.retries, report.bytes_copied,
+                               report.bytes_uploaded, report.wall_time))
+
+
+def _parser():
+    p = argparse.ArgumentParser(
+        prog='s3concat', description='Concatenate S3 objects.')
+    p.add_argument('target', nargs='?',
+                   help='S3 URL of the object to append to')
+    p.add_argument('sources', nargs='*', metavar='source',
+                   help='S3 URL or local path of an object to append')
+    p.add_argument('-m', '--manifest', metavar='PATH',
+                   help="file of jobs, one JSON object a line; '-' reads "
+                   'standard input')
+    p.add_argument('-c', '--concurrency', type=int, default=64,
+                   help='requests in flight over all jobs')
+    p.add_argument('-j', '--job-concurrency', type=int, default=4,
+                   help='requests in flight per job')
+    p.add_argument('--max-memory', type=int, default=MAX_MEMORY // MB,
+                   metavar='MB', help='memory for part buffers, in MB')
+    p.add_argument('--copy-part-size', type=int,
+                   default=COPY_PART_SIZE // MB, metavar='MB',
+                   help='size of parts copied server-side, in MB')
+    p.add_argument('--remove-orig', action='store_true',
+                   help='delete the sources once concatenated')
+    # botocore blocks on sockets, so gevent would serialize requests in
+    # a process that is not monkey-patched, as this one is not.
+    p.add_argument('--backend', choices=sorted(executors.BACKENDS),
+                   default='thread',
+                   help='how requests are run concurrently '
+                        '(default: %(default)s)')
+    p.add_argument('--json', action='store_true',
+                   help='print reports as JSON lines')
+    p.add_argument('-v', '--verbose', action='store_true')
+    return p
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(levelname)s %(name)s: %(message)s')
+    executors.configure(args.backend)
+
+    if args.manifest:
+        if args.target:
+            parser.error('give either a manifest or a target and sources')
+        try:
+            jobs = _read_manifest(args.manifest)
+        except (IOError, ValueError) as exc:
+            parser.error(str(exc))
+    elif args.target and args.sources:
+        jobs = [{'target': args.target, 'sources': args.sources,
+                 'remove_orig': args.remove_orig}]
+    else:
+        parser.error('give a manifest, or a target and sources')
+    if args.remove_orig:
+        for job in jobs:
+            job['remove_orig'] = True
+
+    try:
+        results = s3concat_many(
+            jobs, args.concurrency, args.job_concurrency,
+            args.max_memory * MB, copy_part_size=args.copy_part_size * MB)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    for result in results:
+        if args.json:
+            print(json.dumps(dict(
+                result.report.as_dict(), target=result.target,
+                error=None if result.error is None else str(result.error)),
+                sort_keys=True))
+        else:
+            print(_summary(result))
+    return 1 if any(r.error is not None for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
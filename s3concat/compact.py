@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import heapq
+import json
+import logging
+import math
+from collections import namedtuple
+
+from . import executors
+from .metrics import Recorder
+from .planner import COPY_PART_SIZE
+from .planner import MB
+from .planner import check_copy_part_size
+from .s3concat import CONCURRENCY
+from .s3concat import _Job
+from .s3concat import _delete_objects
+from .s3concat import _get_client
+from .s3concat import _lookup_all
+from .s3concat import _merge
+from .s3concat import _write_url
+from .sources import SourceTable
+from .urls import S3URL
+from .urls import make_url
+
+
+log = logging.getLogger(__name__)
+
+
+SHARD_SIZE = 256 * MB
+
+# An output object and the table of the sources that went into it.
+Shard = namedtuple('Shard', ['s3url', 'sources'])
+
+Compaction = namedtuple('Compaction', ['shards', 'manifest', 'report'])
+
+
+def _assign_ordered(s3objs, shard_size):
+    """Yield consecutive runs of sources of about `shard_size` bytes."""
+    shard = SourceTable()
+    size = 0
+    for o in s3objs:
+        n = o.info['ContentLength']
+        # A shard ends where its size comes closest to the target.
+        if size and size + n - shard_size > shard_size - size:
+            yield shard
+            shard = SourceTable()
+            size = 0
+        shard.add(o)
+        size += n
+        if size >= shard_size:
+            yield shard
+            shard = SourceTable()
+            size = 0
+    if shard:
+        yield shard
+
+
+def _assign_balanced(s3objs, shard_size):
+    """Spread the sources over shards of about equal size.
+
+    As many shards as `shard_size` requires are filled by adding the
+    largest remaining source to the smallest shard. Sources keep their
+    input order within a shard.
+    """
+    table = SourceTable.from_objs(s3objs)
+    count = max(1, int(math.ceil(float(sum(table.sizes)) / shard_size)))
+    heap = [(0, i, []) for i in xrange(count)]
+    for index in sorted(xrange(len(table)), key=lambda i: -table.sizes[i]):
+        size, i, members = heapq.heappop(heap)
+        members.append(index)
+        heapq.heappush(heap, (size + table.sizes[index], i, members))
+    groups = sorted(sorted(group) for _, _, group in heap if group)
+    return [SourceTable.from_objs(table[i] for i in group)
+            for group in groups]
+
+
+def _check_outputs(groups, outputs, manifest):
+    """Refuse to write over any of the sources."""
+    written = set((s3url.bucket, s3url.key)
+                  for s3url in outputs + [make_url(manifest)])
+    for sources in groups:
+        for i in xrange(len(sources)):
+            if (sources.bucket(i), sources.key(i)) in written:
+                raise ValueError('An output would overwrite {}'.format(
+                    sources.s3url(i)))
+
+
+def _manifest(shards):
+    return {'shards': [{
+        'url': str(shard.s3url),
+        'size': sum(shard.sources.sizes),
+        'sources': [{'url': str(shard.sources.s3url(i)),
+                     'size': shard.sources.sizes[i],
+                     'etag': shard.sources.etag(i)}
+                    for i in xrange(len(shard.sources))],
+    } for shard in shards]}
+
+
+def s3compact(urls, prefix, shard_size=SHARD_SIZE, ordered=True,
+              name='part-{:05d}', manifest=None, remove_orig=False,
+              concurrency=CONCURRENCY, client=None,
+              copy_part_size=COPY_PART_SIZE, hooks=()):
+    """Compact the sources into objects of about `shard_size` bytes.
+
+    URLs are read as by :func:`s3concat`, but every one of them is a
+    source. The outputs are written under the S3 URL `prefix`, named by
+    formatting `name` with the shard number, and built `concurrency` at
+    a time. When `ordered`, each shard is a run of consecutive sources;
+    otherwise sources are spread over shards to even out their sizes.
+    All sources are looked up first, and a ValueError is raised before
+    anything is written if an output would overwrite one of them.
+
+    A JSON manifest of the sources of each shard is written to the URL
+    `manifest`, an S3 URL or a local path, by default ``manifest.json``
+    under the prefix. Returns a :class:`Compaction` of the shards, the
+    manifest and the report of the requests made.
+    """
+    check_copy_part_size(copy_part_size)
+    if shard_size <= 0:
+        raise ValueError('Shard size must be positive')
+    target = S3URL(prefix)
+    if manifest is None:
+        manifest = '{}manifest.json'.format(prefix)
+
+    with Recorder(hooks) as recorder:
+        s3 = _get_client(client, concurrency, recorder)
+        s3objs = (o for _, objs in _lookup_all(s3, urls, concurrency)
+                  for o in objs)
+        if ordered:
+            groups = list(_assign_ordered(s3objs, shard_size))
+        else:
+            groups = _assign_balanced(s3objs, shard_size)
+        outputs = [S3URL.from_parts(target.bucket, target.key + name.format(i))
+                   for i in xrange(len(groups))]
+        _check_outputs(groups, outputs, manifest)
+
+        def build(args):
+            s3url, sources = args
+            # Shards are built in parallel, each one part at a time.
+            job = _Job(s3, 1, copy_part_size=copy_part_size)
+            try:
+                _merge(job, s3url.bucket, s3url.key, sources)
+            finally:
+                if job.temps:
+                    _delete_objects(s3, job.temps)
+            log.info('Built %s from %d sources', s3url, len(sources))
+            return Shard(s3url, sources)
+
+        shards = list(executors.pool(concurrency).imap(
+            build, zip(outputs, groups)))
+        if not shards:
+            raise ValueError('None of input S3 objects exist')
+        data = _manifest(shards)
+        _write_url(s3, manifest, json.dumps(data, indent=1, sort_keys=True))
+
+        if remove_orig:
+            # Outputs are never sources, but are kept whatever happens.
+            written = set(str(s3url) for s3url in outputs)
+            _delete_objects(s3, [
+                shard.sources.s3url(i) for shard in shards
+                for i in xrange(len(shard.sources))
+                if str(shard.sources.s3url(i)) not in written],
+                concurrency)
+    return Compaction(shards, data, recorder.report)
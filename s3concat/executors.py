@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from collections import deque
+
+import gevent
+import gevent.event
+import gevent.pool
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+
+log = logging.getLogger(__name__)
+
+
+class ThreadPool(object):
+    """Bounded pool of threads, with the parts of gevent's Pool used here.
+
+    Like gevent's Pool, spawn() blocks while all threads are busy, so
+    callers producing work cannot run ahead of the pool.
+    """
+
+    def __init__(self, size):
+        self._executor = ThreadPoolExecutor(size)
+        self._slots = threading.Semaphore(size)
+        self._lock = threading.Lock()
+        self._futures = set()
+
+    def spawn(self, func, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+
+    def imap(self, func, iterable):
+        futures = deque()
+        for item in iterable:
+            futures.append(self.spawn(func, item))
+            while futures and futures[0].done():
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+    def map(self, func, iterable):
+        return list(self.imap(func, iterable))
+
+    def join(self):
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+    def kill(self):
+        # Running threads cannot be killed; pending calls are cancelled
+        # and running ones waited for.
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        wait(futures)
+
+
+class Budget(object):
+    """Amount of a resource, such as bytes of memory, shared by workers.
+
+    acquire() waits until the amount asked for is free, in the order
+    asked. An amount over the whole budget is cut down to it, so that
+    it is granted once everything else is released.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.available = total
+        self._waiters = deque()
+        # Guards the state above; never held while waiting.
+        self._lock = threading.Lock()
+
+    def acquire(self, amount):
+        """Take the amount, waiting if need be; returns the amount held."""
+        amount = min(amount, self.total)
+        with self._lock:
+            if not self._waiters and amount <= self.available:
+                self.available -= amount
+                return amount
+            waiter = event()
+            self._waiters.append((amount, waiter))
+        waiter.wait()
+        return amount
+
+    def release(self, amount):
+        with self._lock:
+            self.available += amount
+            while self._waiters and self._waiters[0][0] <= self.available:
+                granted, waiter = self._waiters.popleft()
+                self.available -= granted
+                waiter.set()
+
+
+class GeventBackend(object):
+    """Run work in greenlets.
+
+    S3 requests only run in parallel if the process is monkey-patched
+    by gevent.
+    """
+
+    name = 'gevent'
+
+    def pool(self, size):
+        return gevent.pool.Pool(size)
+
+    def event(self):
+        return gevent.event.Event()
+
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    def later(self, seconds, func):
+        greenlet = gevent.spawn_later(seconds, func)
+        return lambda: greenlet.kill(block=False)
+
+
+class ThreadBackend(object):
+    """Run work in pools of OS threads."""
+
+    name = 'thread'
+
+    def pool(self, size):
+        return ThreadPool(size)
+
+    def event(self):
+        return threading.Event()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def later(self, seconds, func):
+        timer = threading.Timer(seconds, func)
+        timer.daemon = True
+        timer.start()
+        return timer.cancel
+
+
+BACKENDS = {b.name: b for b in (GeventBackend, ThreadBackend)}
+
+_backend = GeventBackend()
+
+
+def configure(backend):
+    """Set the backend running concurrent work, by name or instance.
+
+    Use ``'thread'`` when embedding in a process that is not
+    monkey-patched by gevent.
+    """
+    global _backend
+    if isinstance(backend, basestring):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend {}; choose from {}'.format(
+                backend, ', '.join(sorted(BACKENDS))))
+        backend = BACKENDS[backend]()
+    _backend = backend
+    log.debug('Using %s backend', backend.name)
+
+
+def get_backend():
+    return _backend
+
+
+def pool(size):
+    """Return a pool running at most `size` calls at once."""
+    return _backend.pool(size)
+
+
+def event():
+    return _backend.event()
+
+
+def sleep(seconds):
+    _backend.sleep(seconds)
+
+
+def later(seconds, func):
+    """Call func after `seconds` in the background; returns a function
+    cancelling the call.
+
+    Under the gevent backend, the call only happens while the process
+    waits on gevent, as when it is monkey-patched.
+    """
+    return _backend.later(seconds, func)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import itertools
+import json
+import logging
+from collections import namedtuple
+
+from .metrics import Recorder
+from .planner import COPY_PART_SIZE
+from .planner import check_copy_part_size
+from .s3concat import CONCURRENCY
+from .s3concat import _Job
+from .s3concat import _get_client
+from .s3concat import _get_object_info
+from .s3concat import _list_objects
+from .s3concat import _read_url
+from .s3concat import _run
+from .s3concat import _write_url
+from .sources import S3Obj
+from .sources import SourceTable
+from .urls import S3URL
+from .urls import make_url
+
+
+log = logging.getLogger(__name__)
+
+
+# The keys appended by a run with their ETags, the bytes they added,
+# and the report of the requests made.
+Increment = namedtuple('Increment', ['keys', 'size', 'report'])
+
+
+class IncrementalCompactor(object):
+    """Append the objects that keep arriving under a prefix to a target.
+
+    Each :meth:`run` lists only the keys after the watermark, the last
+    key appended, and appends them in key order to the `target` object.
+    Runs thus cost in proportion to the new data, which suits prefixes
+    whose keys sort in the order they are written, as those of most
+    streaming sinks do; a key sorting before the watermark when it
+    arrives is never picked up.
+
+    The state index is a small JSON document kept in `state`, a local
+    path or an S3 URL. It holds the watermark, the last `history`
+    consumed keys with their ETags, and totals. A batch is recorded as
+    pending before it is appended, so a run cut short is settled by the
+    next one: by the size of the target, the batch either took effect
+    and is committed, or did not and is appended again. Only one
+    compactor may run on a state at a time.
+    """
+
+    def __init__(self, target, prefix, state, history=1000,
+                 max_keys=None, concurrency=CONCURRENCY, client=None,
+                 copy_part_size=COPY_PART_SIZE, hooks=()):
+        check_copy_part_size(copy_part_size)
+        self.target = S3URL(target)
+        if self.target.is_prefix:
+            raise ValueError('The target must name an object, not a prefix')
+        self.prefix = S3URL(prefix)
+        self.state_url = state
+        self.history = history
+        self.max_keys = max_keys
+        self.concurrency = concurrency
+        self.client = client
+        self.copy_part_size = copy_part_size
+        self.hooks = hooks
+
+    def _load(self, s3):
+        data = _read_url(s3, self.state_url)
+        if data is None:
+            return {'target': str(self.target), 'prefix': str(self.prefix),
+                    'watermark': None, 'consumed': [], 'keys': 0,
+                    'bytes': 0, 'pending': None}
+        state = json.loads(data)
+        if (state['target'], state['prefix']) != (
+                str(self.target), str(self.prefix)):
+            raise ValueError('{} records appending {} to {}'.format(
+                self.state_url, state['prefix'], state['target']))
+        return state
+
+    def _save(self, s3, state):
+        _write_url(s3, self.state_url, json.dumps(state, sort_keys=True))
+
+    def _skip(self, key):
+        if key == self.target.key or '.s3concat-' in key:
+            return True
+        state = make_url(self.state_url)
+        return (state.bucket, state.key) == (self.prefix.bucket, key)
+
+    def _list_new(self, s3, state):
+        objs = (o for o in _list_objects(s3, self.prefix, state['watermark'])
+                if not self._skip(o.s3url.key))
+        return list(itertools.islice(objs, self.max_keys))
+
+    def _commit(self, state):
+        pending = state['pending']
+        keys = [[key, etag] for key, etag, _ in pending['keys']]
+        state['watermark'] = max(state['watermark'], keys[-1][0])
+        state['consumed'] = (state['consumed'] + keys)[-self.history:]
+        state['keys'] += len(keys)
+        state['bytes'] += pending['size']
+        state['pending'] = None
+
+    def _settle(self, s3, state):
+        """Commit the pending batch if it was appended, else return it."""
+        pending = state['pending']
+        info = _get_object_info(self.target.bucket, self.target.key, s3)
+        size = 0 if info is None else info['ContentLength']
+        if size == pending['target_size'] + pending['size']:
+            log.info('Batch of %d keys was appended to %s before; '
+                     'committing', len(pending['keys']), self.target)
+            self._commit(state)
+            self._save(s3, state)
+            return None
+        if size != pending['target_size']:
+            raise ValueError(
+                '{} is {} bytes, which matches neither before nor after '
+                'appending the batch pending in {}'.format(
+                    self.target, size, self.state_url))
+        log.info('Appending the batch of %d keys pending in %s again',
+                 len(pending['keys']), self.state_url)
+        return [S3Obj(S3URL.from_parts(self.prefix.bucket, key),
+                      {'ContentLength': n, 'ETag': etag})
+                for key, etag, n in pending['keys']]
+
+    def run(self):
+        """Append the keys that arrived since the last run.
+
+        Returns an :class:`Increment`, with no keys if there were none.
+        """
+        with Recorder(self.hooks) as recorder:
+            s3 = _get_client(self.client, self.concurrency, recorder)
+            state = self._load(s3)
+            new = None
+            if state['pending'] is not None:
+                new = self._settle(s3, state)
+            info = _get_object_info(self.target.bucket, self.target.key, s3)
+            if new is None:
+                new = self._list_new(s3, state)
+                if not new:
+                    return Increment([], 0, recorder.report)
+                state['pending'] = {
+                    'keys': [[o.s3url.key, o.info['ETag'],
+                              o.info['ContentLength']] for o in new],
+                    'size': sum(o.info['ContentLength'] for o in new),
+                    'target_size': 0 if info is None else (
+                        info['ContentLength'])}
+                self._save(s3, state)
+
+            pending = state['pending']
+            sources = SourceTable()
+            if info is not None and info['ContentLength']:
+                sources.add(S3Obj(self.target, info))
+            for o in new:
+                sources.add(o)
+            job = _Job(s3, self.concurrency,
+                       copy_part_size=self.copy_part_size)
+            _run(job, self.target, sources, False)
+
+            self._commit(state)
+            self._save(s3, state)
+            log.info('Appended %d keys of %d bytes to %s', len(new),
+                     pending['size'], self.target)
+        return Increment([(key, etag) for key, etag, _ in pending['keys']],
+                         pending['size'], recorder.report)
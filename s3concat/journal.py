@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import json
+import logging
+import os
+import threading
+import uuid
+
+
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """Append-only record of a concatenation, for resuming it after a crash.
+
+    The journal is a file of JSON lines. It records the job (the target,
+    its sources with sizes and ETags, and a token naming intermediate
+    objects), each multipart upload started with its ID, the ETag of
+    each finished part, intermediate objects, and completed uploads.
+    Every record is flushed to disk before the work it describes is
+    considered done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.job = None
+        self.uploads = {}
+        self.completed = {}
+        self.temps = []
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+        self._file = open(path, 'a')
+
+    def _load(self):
+        with open(self.path, 'r+') as f:
+            offset = 0
+            for line in iter(f.readline, ''):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # A record cut short by a crash; nothing follows it.
+                    log.warning('Dropping truncated record in %s', self.path)
+                    f.truncate(offset)
+                    break
+                offset += len(line)
+                kind = rec.pop('type')
+                if kind == 'job':
+                    self.job = rec
+                elif kind == 'upload':
+                    self.uploads[(rec['bucket'], rec['key'])] = (
+                        rec['upload_id'], rec['parts'])
+                elif kind == 'temp':
+                    self.temps.append(rec['url'])
+                elif kind == 'complete':
+                    self.uploads.pop((rec['bucket'], rec['key']), None)
+                    self.completed[(rec['bucket'], rec['key'])] = rec['size']
+
+    def _write(self, **rec):
+        line = json.dumps(rec) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    @property
+    def token(self):
+        return self.job['token']
+
+    def start_job(self, target, sources, remove_orig, copy_part_size=None):
+        """Record the job; sources are (url, size, etag) tuples."""
+        self.job = {'target': target, 'sources': sources,
+                    'remove_orig': remove_orig,
+                    'copy_part_size': copy_part_size,
+                    'token': uuid.uuid4().hex}
+        self._write(type='job', **self.job)
+
+    def start_upload(self, bucket, key, upload_id, parts):
+        self.uploads[(bucket, key)] = (upload_id, parts)
+        self._write(type='upload', bucket=bucket, key=key,
+                    upload_id=upload_id, parts=parts)
+
+    def record_part(self, upload_id, part_number, etag):
+        self._write(type='part', upload_id=upload_id, part=part_number,
+                    etag=etag)
+
+    def add_temp(self, url):
+        self.temps.append(url)
+        self._write(type='temp', url=url)
+
+    def complete_upload(self, bucket, key, size):
+        self.uploads.pop((bucket, key), None)
+        self.completed[(bucket, key)] = size
+        self._write(type='complete', bucket=bucket, key=key, size=size)
+
+    def close(self, remove=False):
+        self._file.close()
+        if remove:
+            os.remove(self.path)
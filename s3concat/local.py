@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import io
+import logging
+import mmap
+
+
+log = logging.getLogger(__name__)
+
+
+class MappedRange(object):
+    """Read-only file-like view of a byte range of a local file.
+
+    The range is memory-mapped, so a part uploaded from it is read from
+    the page cache in small chunks as the request is sent, rather than
+    loaded into memory beforehand. Seeking is relative to the start of
+    the range, which lets botocore rewind the body for a retry.
+    """
+
+    def __init__(self, path, start, end):
+        offset = start - start % mmap.ALLOCATIONGRANULARITY
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), end + 1 - offset,
+                                  access=mmap.ACCESS_READ, offset=offset)
+        self._start = start - offset
+        self._end = end + 1 - offset
+        self._pos = self._start
+
+    def __len__(self):
+        return self._end - self._start
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._end - self._pos
+        data = self._map[self._pos:min(self._pos + size, self._end)]
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        base = (self._start, self._pos, self._end)[whence]
+        self._pos = min(max(base + offset, self._start), self._end)
+
+    def tell(self):
+        return self._pos - self._start
+
+    def close(self):
+        self._map.close()
+
+
+def read_into(path, start, view):
+    """Fill the writable buffer with the bytes of the file from start."""
+    with io.open(path, 'rb', buffering=0) as f:
+        f.seek(start)
+        filled = 0
+        while filled < len(view):
+            n = f.readinto(view[filled:])
+            if not n:
+                raise IOError('Premature end of {} at byte {}'.format(
+                    path, start + filled))
+            filled += n
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Run many concatenations at once over shared resources."""
+from __future__ import absolute_import
+import logging
+import threading
+from collections import namedtuple
+
+from botocore.exceptions import ClientError
+
+from . import executors
+from . import regions
+from .metrics import Recorder
+from .planner import COPY_PART_SIZE
+from .planner import MB
+from .planner import check_copy_part_size
+from .s3concat import _concat
+from .s3concat import _get_client
+from .scheduler import UNSCHEDULED
+
+
+log = logging.getLogger(__name__)
+
+
+MAX_MEMORY = 1024 * MB
+
+# Requests writing or deleting objects, which lookups must not outlive.
+_WRITES = frozenset(['put_object', 'complete_multipart_upload',
+                     'delete_object', 'delete_objects'])
+
+# The outcome of one job: its report, or the error that failed it.
+JobResult = namedtuple('JobResult', ['target', 'report', 'error'])
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = executors.event()
+        self.result = None
+        self.error = None
+        self.stale = False
+
+
+class _SharedClient(object):
+    """S3 client proxy shared by concurrent jobs.
+
+    At most `slots` requests are in flight at once across all jobs. An
+    object is HEADed once for the lifetime of the proxy, its response,
+    or that it does not exist, going to every caller, until the object
+    is written or deleted through the proxy.
+    """
+
+    def __init__(self, client, slots):
+        self.client = client
+        self.slots = executors.Budget(slots)
+        self._flights = {}
+        self._heads = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or name in UNSCHEDULED or not callable(attr):
+            return attr
+
+        def call(**kwargs):
+            if name == 'head_object':
+                return self._head_object(attr, kwargs)
+            if name in _WRITES:
+                return self._write(attr, kwargs)
+            return self._call(attr, kwargs)
+        call.__name__ = name
+        return call
+
+    def _call(self, func, kwargs):
+        self.slots.acquire(1)
+        try:
+            return func(**kwargs)
+        finally:
+            self.slots.release(1)
+
+    def _forget(self, kwargs):
+        bucket = kwargs.get('Bucket')
+        keys = [kwargs.get('Key')]
+        if 'Delete' in kwargs:
+            keys = [o['Key'] for o in kwargs['Delete']['Objects']]
+        with self._lock:
+            for key in keys:
+                self._heads.pop((bucket, key), None)
+                flight = self._flights.get((bucket, key))
+                if flight is not None:
+                    flight.stale = True
+
+    def _write(self, func, kwargs):
+        # Lookups made while the write is under way are forgotten too.
+        self._forget(kwargs)
+        try:
+            return self._call(func, kwargs)
+        finally:
+            self._forget(kwargs)
+
+    def _head_object(self, func, kwargs):
+        key = (kwargs.get('Bucket'), kwargs.get('Key'))
+        with self._lock:
+            flight = self._heads.get(key) or self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._call(func, kwargs)
+        except ClientError as exc:
+            flight.error = exc
+            if exc.response['Error']['Code'] not in ('404', 'NotFound'):
+                flight.stale = True
+            raise
+        except Exception as exc:
+            flight.error = exc
+            flight.stale = True
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if not flight.stale:
+                    self._heads[key] = flight
+            flight.done.set()
+        return flight.result
+
+
+def _parse_job(job):
+    if isinstance(job, dict):
+        return job['target'], job['sources'], job.get('remove_orig', False)
+    target, sources = job
+    return target, sources, False
+
+
+def s3concat_many(jobs, concurrency=64, job_concurrency=4,
+                  max_memory=MAX_MEMORY, client=None,
+                  copy_part_size=COPY_PART_SIZE, hooks=(),
+                  transfer_remote=False):
+    """Run many concatenations concurrently.
+
+    Each job is a ``(target, sources)`` pair or a dict with ``target``,
+    ``sources`` and optionally ``remove_orig``, and appends the source
+    URLs to the target as :func:`s3concat` does. Up to `concurrency`
+    requests are in flight over all jobs, each of which runs at most
+    `job_concurrency` of them; packed parts being uploaded hold at most
+    `max_memory` bytes in all. Lookups of the same object are shared
+    between jobs for the whole run, unless a job writes the object.
+    `transfer_remote` is passed on as to :func:`s3concat`.
+
+    A failed job does not stop the others. Returns a list of
+    :class:`JobResult`, in the order of the jobs.
+    """
+    check_copy_part_size(copy_part_size)
+    if concurrency < 1 or job_concurrency < 1:
+        raise ValueError('Concurrency must be positive')
+    jobs = [_parse_job(job) for job in jobs]
+    shared = _SharedClient(client or regions.RegionRouter(
+        max_pool_connections=2 * concurrency), concurrency)
+    memory = executors.Budget(max_memory)
+
+    def run(job):
+        target, sources, remove_orig = job
+        with Recorder(hooks) as recorder:
+            try:
+                _concat(_get_client(shared, job_concurrency, recorder),
+                        [target] + list(sources), remove_orig,
+                        job_concurrency, None, copy_part_size, memory,
+                        transfer_remote=transfer_remote)
+            except Exception as exc:
+                log.exception('Error concatenating to %s', target)
+                return JobResult(target, recorder.report, exc)
+        return JobResult(target, recorder.report, None)
+
+    # Jobs only wait on requests, so enough of them run to fill the
+    # request slots.
+    size = max(1, min(len(jobs), -(-concurrency // job_concurrency)))
+    return list(executors.pool(size).imap(run, jobs))
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+
+# An attempt at a request. `bytes` counts the data downloaded by a GET,
+# uploaded by a PUT or part upload, or copied by a part copy. `error` is
+# the exception the attempt raised, if any, and `in_flight` the number
+# of attempts running when it started, itself included.
+RequestEvent = namedtuple('RequestEvent', [
+    'operation', 'bucket', 'key', 'attempt', 'latency', 'error', 'bytes',
+    'in_flight'])
+
+
+class OperationStats(object):
+    """Totals of the attempts at one kind of request."""
+
+    __slots__ = ('count', 'errors', 'retries', 'total_time', 'max_time')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_time = 0.
+        self.max_time = 0.
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.count if self.count else 0.
+
+    def as_dict(self):
+        return {'count': self.count, 'errors': self.errors,
+                'retries': self.retries, 'total_time': self.total_time,
+                'max_time': self.max_time, 'mean_time': self.mean_time}
+
+
+class Report(object):
+    """Performance of one concatenation or append.
+
+    `operations` maps client method names to their
+    :class:`OperationStats`; every attempt counts, retries included.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.bytes_copied = 0
+        self.max_in_flight = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def requests(self):
+        return sum(s.count for s in self.operations.itervalues())
+
+    @property
+    def retries(self):
+        return sum(s.retries for s in self.operations.itervalues())
+
+    @property
+    def wall_time(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def as_dict(self):
+        return {
+            'operations': {name: stats.as_dict()
+                           for name, stats in self.operations.iteritems()},
+            'requests': self.requests,
+            'retries': self.retries,
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_uploaded': self.bytes_uploaded,
+            'bytes_copied': self.bytes_copied,
+            'max_in_flight': self.max_in_flight,
+            'wall_time': self.wall_time,
+        }
+
+    def __repr__(self):
+        return ('<Report requests={} retries={} downloaded={} uploaded={} '
+                'copied={} wall_time={}>'.format(
+                    self.requests, self.retries, self.bytes_downloaded,
+                    self.bytes_uploaded, self.bytes_copied, self.wall_time))
+
+
+class Hook(object):
+    """Receiver of the metrics of a job; override the methods needed.
+
+    Hooks are called from the threads or greenlets making requests, so
+    they should return quickly.
+    """
+
+    def request(self, event):
+        """Called with a :class:`RequestEvent` after every attempt."""
+
+    def finish(self, report):
+        """Called with the :class:`Report` once the job is over."""
+
+
+# Hooks receiving the metrics of every job, in addition to those passed
+# to the job itself.
+global_hooks = []
+
+
+def _range_size(byte_range):
+    start, end = byte_range[len('bytes='):].split('-')
+    return int(end) - int(start) + 1
+
+
+def _request_bytes(operation, kwargs, resp):
+    if operation == 'get_object':
+        if 'ContentLength' in resp:
+            return resp['ContentLength']
+        return _range_size(kwargs['Range']) if 'Range' in kwargs else 0
+    if operation in ('put_object', 'upload_part'):
+        body = kwargs.get('Body', '')
+        return len(body) if hasattr(body, '__len__') else 0
+    if operation == 'upload_part_copy' and 'CopySourceRange' in kwargs:
+        return _range_size(kwargs['CopySourceRange'])
+    return 0
+
+
+_BYTES = {
+    'get_object': 'bytes_downloaded',
+    'put_object': 'bytes_uploaded',
+    'upload_part': 'bytes_uploaded',
+    'upload_part_copy': 'bytes_copied',
+}
+
+
+class Recorder(object):
+    """Collect a :class:`Report` from the requests made for a job.
+
+    Used as a context manager around the job, which marks its start and
+    end and hands the report to the hooks when it is over.
+    """
+
+    def __init__(self, hooks=(), clock=time.time):
+        self.hooks = global_hooks + list(hooks)
+        self.clock = clock
+        self.report = Report()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.report.started = self.clock()
+        return self
+
+    def __exit__(self, exc_t, exc_v, exc_tb):
+        self.report.finished = self.clock()
+        for hook in self.hooks:
+            try:
+                hook.finish(self.report)
+            except Exception:
+                log.exception('Error in metrics hook %r', hook)
+
+    def wrap(self, operation, func):
+        """Return func recording each call as an attempt at a request."""
+        attempts = [0]
+
+        def call(**kwargs):
+            attempts[0] += 1
+            attempt = attempts[0]
+            with self._lock:
+                self._in_flight += 1
+                in_flight = self._in_flight
+            start = self.clock()
+            error = resp = None
+            try:
+                resp = func(**kwargs)
+                return resp
+            except Exception as exc:
+                error = exc
+                raise
+            finally:
+                self._record(RequestEvent(
+                    operation, kwargs.get('Bucket'), kwargs.get('Key'),
+                    attempt, self.clock() - start, error,
+                    0 if error else _request_bytes(operation, kwargs, resp),
+                    in_flight))
+        call.__name__ = getattr(func, '__name__', operation)
+        return call
+
+    def _record(self, event):
+        report = self.report
+        with self._lock:
+            self._in_flight -= 1
+            stats = report.operations.get(event.operation)
+            if stats is None:
+                stats = report.operations[event.operation] = OperationStats()
+            stats.count += 1
+            stats.total_time += event.latency
+            stats.max_time = max(stats.max_time, event.latency)
+            if event.error is not None:
+                stats.errors += 1
+            if event.attempt > 1:
+                stats.retries += 1
+            if event.bytes:
+                attr = _BYTES[event.operation]
+                setattr(report, attr, getattr(report, attr) + event.bytes)
+            report.max_in_flight = max(report.max_in_flight, event.in_flight)
+        for hook in self.hooks:
+            try:
+                hook.request(event)
+            except Exception:
+                log.exception('Error in metrics hook %r', hook)
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Part planning for multipart concatenation.
+
+A plan is a list of parts, each a list of ``(index, (start, end))``
+pieces referring to byte ranges (inclusive, as in HTTP Range headers)
+of the source at ``index``. A part with a single piece is copied
+server-side with ``upload_part_copy``, unless its source is in another
+region and faster to transfer; a part with several pieces is downloaded
+and uploaded with ``upload_part``.
+
+The planner minimizes the number of bytes that have to pass through the
+client. Every part but the last must be at least MIN_PART_SIZE bytes,
+so sources smaller than that are packed together, topped up where
+needed with bytes borrowed from the head or tail of a neighbouring
+source large enough to still be copied.
+"""
+from __future__ import absolute_import
+import logging
+from collections import deque
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+
+KB = 1024
+MB = KB**2
+GB = KB**3
+
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * GB
+MAX_PARTS = 10000
+
+# Size of the ranged parts a large source is copied in. Many parts copy
+# concurrently, where one huge copy would be the slowest of the job.
+COPY_PART_SIZE = 256 * MB
+
+# Size of the parts a source is downloaded and uploaded in instead, as
+# done from buckets in other regions when faster than copying. Each is
+# held in memory while it is uploaded.
+TRANSFER_PART_SIZE = 16 * MB
+
+# Bound on the number of alternative partial plans kept while planning.
+MAX_STATES = 32
+
+_CLOSED, _PENDING, _OPEN = range(3)
+_PACK, _COPY = range(2)
+
+
+Estimate = namedtuple('Estimate', [
+    'parts', 'gets', 'puts', 'copies',
+    'bytes_downloaded', 'bytes_uploaded', 'bytes_copied'])
+
+
+class _State(object):
+
+    __slots__ = ('cost', 'kind', 'pending', 'spare', 'chain')
+
+    def __init__(self, cost, kind, pending, spare, chain):
+        self.cost = cost          # (bytes downloaded, GET requests)
+        self.kind = kind
+        self.pending = pending    # bytes in an open pack below min size
+        self.spare = spare        # bytes the last copied source can lend
+        self.chain = chain        # (decision, previous chain)
+
+    def dominates(self, other):
+        if self.cost > other.cost:
+            return False
+        if self.kind == _OPEN:
+            return True
+        return (self.kind == other.kind and
+                self.pending >= other.pending and
+                self.spare >= other.spare)
+
+
+def _advance(states, index, size, is_last):
+    """Extend every partial plan with a decision on the next source."""
+    spare_if_copied = size - (1 if is_last else MIN_PART_SIZE)
+    candidates = []
+    for st in states:
+        nbytes, ngets = st.cost
+
+        # Pack the whole source with its neighbours.
+        pending = st.pending + size
+        if st.kind == _OPEN or pending >= MIN_PART_SIZE:
+            kind, pending = _OPEN, 0
+        else:
+            kind = _PENDING
+        candidates.append(_State(
+            (nbytes + size, ngets + 1), kind, pending,
+            st.spare if kind == _PENDING else 0,
+            ((index, _PACK, 0, 0), st.chain)))
+
+        # Copy the source, topping up an open pack below minimum size
+        # first from the previous copied source's tail, then from the
+        # head of this one.
+        if spare_if_copied < 0:
+            continue
+        borrow = head = 0
+        if st.kind == _PENDING:
+            deficit = MIN_PART_SIZE - st.pending
+            borrow = min(st.spare, deficit)
+            head = deficit - borrow
+            if head > spare_if_copied:
+                continue
+        candidates.append(_State(
+            (nbytes + borrow + head,
+             ngets + (borrow > 0) + (head > 0)),
+            _CLOSED, 0, spare_if_copied - head,
+            ((index, _COPY, borrow, head), st.chain)))
+
+    candidates.sort(key=lambda st: st.cost)
+    kept = []
+    for st in candidates:
+        if not any(other.dominates(st) for other in kept):
+            kept.append(st)
+            if len(kept) == MAX_STATES:
+                break
+    return kept
+
+
+def _split_range(start, end, max_size, min_size=MIN_PART_SIZE):
+    """Split an inclusive byte range into balanced ranges of at most
+    `max_size` bytes, none smaller than `min_size` unless unavoidable."""
+    size = end - start + 1
+    n = -(-size // max_size)
+    n = max(1, min(n, size // min_size))
+    step, extra = divmod(size, n)
+    for i in xrange(n):
+        length = step + (1 if i < extra else 0)
+        yield start, start + length - 1
+        start += length
+
+
+def check_copy_part_size(copy_part_size):
+    if not MIN_PART_SIZE <= copy_part_size <= MAX_PART_SIZE:
+        raise ValueError(
+            'Copy part size must be between {} and {} bytes'.format(
+                MIN_PART_SIZE, MAX_PART_SIZE))
+
+
+def split_copy(start, end, copy_part_size=COPY_PART_SIZE, max_parts=None):
+    """Split an inclusive byte range copied server-side into part ranges.
+
+    With `max_parts`, `copy_part_size` is doubled as needed to keep the
+    range within that many parts.
+    """
+    check_copy_part_size(copy_part_size)
+    if max_parts is not None:
+        size = end - start + 1
+        while size > copy_part_size * max_parts:
+            if copy_part_size == MAX_PART_SIZE:
+                raise ValueError('{} bytes do not fit in {} parts'.format(
+                    size, max_parts))
+            copy_part_size = min(MAX_PART_SIZE, 2 * copy_part_size)
+    return list(_split_range(start, end, copy_part_size))
+
+
+class StreamPlanner(object):
+    """Plan parts incrementally as the sizes of sources become known.
+
+    Sources are fed in order with add(), which returns the parts whose
+    byte ranges are settled so far; finish() returns the rest. A
+    decision is settled once all partial plans kept agree on it. If
+    `window` sources go by without that happening, the cheapest partial
+    plan is settled on instead, which bounds the work held back at the
+    cost of a possibly less economical plan.
+    """
+
+    # Sources added between checks for settled decisions.
+    CHECK_INTERVAL = 32
+
+    def __init__(self, copy_part_size=COPY_PART_SIZE, window=1024):
+        check_copy_part_size(copy_part_size)
+        self.copy_part_size = copy_part_size
+        self.window = window
+        self._states = [_State((0, 0), _CLOSED, 0, 0, None)]
+        self._root = None       # chain of the decisions settled so far
+        self._sizes = {}        # sizes of sources not yet settled
+        self._part_sizes = {}   # part sizes of sources not copied as usual
+        self._last = None       # source not yet planned, as it may be last
+        self._unchecked = 0
+        self._pack = deque()    # pieces of the open pack
+        self._packed = 0
+        self._held = None       # copied source whose tail may be lent
+
+    def add(self, index, size, part_size=None):
+        """Add the source at index; return the parts settled by it.
+
+        Ranges of the source taken whole into parts are split at
+        `part_size` bytes if given, else at the copy part size.
+        """
+        if not size:
+            return []
+        if part_size is not None:
+            self._part_sizes[index] = part_size
+        if self._last is not None:
+            self._states = _advance(self._states, self._last[0],
+                                    self._last[1], False)
+        self._last = (index, size)
+        self._sizes[index] = size
+        self._unchecked += 1
+        if self._unchecked < self.CHECK_INTERVAL:
+            return []
+        self._unchecked = 0
+        return self._settle()
+
+    def finish(self):
+        """Return the remaining parts once all sources have been added."""
+        if self._last is not None:
+            self._states = _advance(self._states, self._last[0],
+                                    self._last[1], True)
+            self._last = None
+        self._states = self._states[:1]
+        parts = self._settle()
+        if self._held is not None:
+            self._release(0, parts)
+        self._close_pack(parts)
+        return parts
+
+    def _settle(self):
+        """Apply the decisions shared by all states kept."""
+        path = []
+        chain = self._states[0].chain
+        while chain is not self._root:
+            path.append(chain)
+            chain = chain[1]
+        depth = dict((id(chain), n) for n, chain in enumerate(path))
+
+        common = 0
+        for st in self._states[1:]:
+            chain = st.chain
+            while chain is not self._root and id(chain) not in depth:
+                chain = chain[1]
+            if chain is self._root:
+                common = len(path)
+                break
+            common = max(common, depth[id(chain)])
+
+        if self.window is not None and common >= self.window:
+            log.debug('Decisions on %d sources unsettled; settling on the '
+                      'cheapest plan', common)
+            self._states = self._states[:1]
+            common = 0
+
+        parts = []
+        if common < len(path):
+            self._root = path[common]
+            for chain in reversed(path[common:]):
+                self._apply(chain[0], parts)
+        return parts
+
+    def _apply(self, decision, parts):
+        index, action, borrow, head = decision
+        size = self._sizes.pop(index)
+        if action == _PACK:
+            self._part_sizes.pop(index, None)
+            self._add_piece(index, 0, size - 1, parts)
+            return
+        if self._held is not None:
+            self._release(borrow, parts)
+        if head:
+            self._add_piece(index, 0, head - 1, parts)
+        self._close_pack(parts)
+        self._held = (index, size, head)
+
+    def _release(self, tail, parts):
+        # The tail lent to the pack that follows is now known.
+        index, size, head = self._held
+        self._held = None
+        part_size = self._part_sizes.pop(index, self.copy_part_size)
+        parts.extend([(index, byte_range)] for byte_range in
+                     split_copy(head, size - tail - 1, part_size))
+        if tail:
+            self._pack.appendleft((index, (size - tail, size - 1)))
+            self._packed += tail
+
+    def _add_piece(self, index, start, end, parts):
+        self._pack.append((index, (start, end)))
+        self._packed += end - start + 1
+        if self._held is not None:
+            # A pack of full size borrows nothing from the held source.
+            if self._packed < MIN_PART_SIZE:
+                return
+            self._release(0, parts)
+        # Parts are cut at MIN_PART_SIZE from the front, leaving the
+        # last part, which takes the remainder, to close the pack.
+        while self._packed >= 2 * MIN_PART_SIZE:
+            part = []
+            need = MIN_PART_SIZE
+            while need:
+                index, (start, end) = self._pack.popleft()
+                take = min(need, end - start + 1)
+                part.append((index, (start, start + take - 1)))
+                if take < end - start + 1:
+                    self._pack.appendleft((index, (start + take, end)))
+                need -= take
+            self._packed -= MIN_PART_SIZE
+            parts.append(part)
+
+    def _close_pack(self, parts):
+        parts.extend(_split_pack(list(self._pack)))
+        self._pack.clear()
+        self._packed = 0
+
+
+def plan_parts(sizes, copy_part_size=COPY_PART_SIZE, max_parts=None):
+    """Plan the parts concatenating sources of the given sizes.
+
+    Copied ranges are split into parts of about `copy_part_size` bytes,
+    grown as needed to keep the plan within `max_parts` parts, the part
+    limit by default.
+    """
+    if max_parts is None:
+        max_parts = MAX_PARTS
+    while True:
+        stream = StreamPlanner(copy_part_size, window=None)
+        parts = []
+        for index, size in enumerate(sizes):
+            parts.extend(stream.add(index, size))
+        parts.extend(stream.finish())
+        if len(parts) <= max_parts or copy_part_size == MAX_PART_SIZE:
+            return parts
+        # Larger copy parts only help if some copy was split.
+        if not any(len(prev) == len(part) == 1 and prev[0][0] == part[0][0]
+                   for prev, part in zip(parts, parts[1:])):
+            return parts
+        copy_part_size = min(MAX_PART_SIZE, 2 * copy_part_size)
+
+
+def _split_pack(pieces, part_size=MIN_PART_SIZE):
+    """Cut packed pieces into parts of at least `part_size` bytes."""
+    total = sum(end - start + 1 for _, (start, end) in pieces)
+    if not total:
+        return []
+    count = max(1, total // part_size)
+    parts = []
+    part = []
+    filled = 0
+    for index, (start, end) in pieces:
+        while start <= end:
+            if len(parts) == count - 1:
+                take = end - start + 1
+            else:
+                take = min(end - start + 1, part_size - filled)
+            part.append((index, (start, start + take - 1)))
+            start += take
+            filled += take
+            if filled == part_size and len(parts) < count - 1:
+                parts.append(part)
+                part = []
+                filled = 0
+    parts.append(part)
+    return parts
+
+
+def estimate(parts, is_local=None):
+    """Estimate the requests and bytes moved in executing the plan.
+
+    Ranges of sources for which `is_local` is true are read locally and
+    uploaded rather than downloaded or copied.
+    """
+    gets = puts = copies = downloaded = uploaded = copied = 0
+    for part in parts:
+        size = sum(end - start + 1 for _, (start, end) in part)
+        local = [is_local is not None and is_local(source)
+                 for source, _ in part]
+        if len(part) == 1 and not local[0]:
+            copies += 1
+            copied += size
+            continue
+        puts += 1
+        uploaded += size
+        for (_, (start, end)), is_read in zip(part, local):
+            if not is_read:
+                gets += 1
+                downloaded += end - start + 1
+    return Estimate(
+        parts=len(parts), gets=gets, puts=puts, copies=copies,
+        bytes_downloaded=downloaded, bytes_uploaded=uploaded,
+        bytes_copied=copied)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import logging
+import threading
+from collections import defaultdict
+
+from botocore.exceptions import ClientError
+
+from . import resources
+from .scheduler import UNSCHEDULED
+
+
+log = logging.getLogger(__name__)
+
+
+# Ways of moving a range of a source into a part.
+COPY = 'copy'           # upload_part_copy, server-side
+TRANSFER = 'transfer'   # get_object, then upload_part
+
+# Legacy location constraints, as returned by GetBucketLocation.
+_LOCATIONS = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}
+
+
+class BucketRegions(object):
+    """Cache of the regions buckets are in.
+
+    A bucket's region is looked up on first use from the header S3 sends
+    with any HEAD of the bucket, or else with GetBucketLocation, through
+    the shared client. A bucket that cannot be looked up is given no
+    region, so that its requests go to the shared client's region, until
+    it is invalidated.
+    """
+
+    def __init__(self):
+        self._regions = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket):
+        """Return the region of the bucket, or None if unknown."""
+        try:
+            return self._regions[bucket]
+        except KeyError:
+            pass
+        region = self._discover(bucket)
+        with self._lock:
+            self._regions[bucket] = region
+        return region
+
+    def cached(self, bucket):
+        """Return the region of the bucket, if looked up before."""
+        return self._regions.get(bucket)
+
+    def set(self, bucket, region):
+        with self._lock:
+            self._regions[bucket] = region
+
+    def invalidate(self, bucket):
+        with self._lock:
+            self._regions.pop(bucket, None)
+
+    def clear(self):
+        with self._lock:
+            self._regions.clear()
+
+    def _discover(self, bucket):
+        client = resources.get_client()
+        try:
+            resp = client.head_bucket(Bucket=bucket)
+        except ClientError as exc:
+            resp = exc.response
+        region = resp.get('ResponseMetadata', {}).get(
+            'HTTPHeaders', {}).get('x-amz-bucket-region')
+        if region is not None:
+            return region
+        try:
+            location = client.get_bucket_location(
+                Bucket=bucket)['LocationConstraint']
+        except ClientError as exc:
+            log.warning('Cannot look up the region of bucket %s: %s',
+                        bucket, exc)
+            return None
+        return _LOCATIONS.get(location, location)
+
+
+class RegionRouter(object):
+    """S3 client proxy sending each request to its bucket's region.
+
+    Requests go through the shared clients of :mod:`s3concat.resources`,
+    one per region, each with a pool of `max_pool_connections`. This
+    saves the redirects, and the failures of requests that cannot be
+    redirected, of a single client addressing buckets everywhere.
+    """
+
+    def __init__(self, max_pool_connections=None, regions=None):
+        self.max_pool_connections = max_pool_connections
+        self.regions = regions or bucket_regions
+
+    def client(self, bucket=None):
+        region = None
+        if bucket is not None and not resources.is_client_set():
+            region = self.regions.get(bucket)
+        return resources.get_client(self.max_pool_connections, region)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client(), name)
+        if name.startswith('_') or name in UNSCHEDULED or not callable(attr):
+            return attr
+
+        def call(**kwargs):
+            return getattr(self.client(kwargs.get('Bucket')), name)(**kwargs)
+        call.__name__ = name
+        return call
+
+
+class Throughput(object):
+    """Measured throughput of copies and transfers between regions.
+
+    Parts from a bucket in another region than the target's may be
+    copied server-side, which is slow across regions, or downloaded and
+    uploaded in parallel. choose() returns the way that has been faster
+    so far, copies until transfers are measured, and every `explore`-th
+    time the other way, to keep measuring both.
+    """
+
+    def __init__(self, explore=16, weight=0.2):
+        self.explore = explore
+        self.weight = weight
+        self._rates = {}
+        self._choices = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def rate(self, method, source, target):
+        """Return the mean bytes per second of a part, or None."""
+        return self._rates.get((method, source, target))
+
+    def record(self, method, source, target, size, seconds):
+        if source is None or target is None or source == target:
+            return
+        rate = size / max(seconds, 1e-6)
+        key = (method, source, target)
+        with self._lock:
+            mean = self._rates.get(key)
+            self._rates[key] = rate if mean is None else (
+                self.weight * rate + (1 - self.weight) * mean)
+
+    def choose(self, source, target):
+        if source is None or target is None or source == target:
+            return COPY
+        copy = self.rate(COPY, source, target)
+        transfer = self.rate(TRANSFER, source, target)
+        best = COPY
+        if transfer is not None and (copy is None or transfer > copy):
+            best = TRANSFER
+        with self._lock:
+            self._choices[source, target] += 1
+            count = self._choices[source, target]
+        if self.explore and count % self.explore == 0:
+            return COPY if best == TRANSFER else TRANSFER
+        return best
+
+
+bucket_regions = BucketRegions()
+
+throughput = Throughput()
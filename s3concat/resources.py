@@ -24,11 +24,108 @@
 # SOFTWARE.
 from __future__ import absolute_import
 import logging
-
-import boto3
+import threading
 
 
 log = logging.getLogger(__name__)
 
 
-s3 = boto3.client('s3')
+# Connection pool size of botocore clients by default.
+DEFAULT_POOL_SIZE = 10
+
+_session = None
+_client_kwargs = {}
+_client = None
+_pool_size = 0
+# Clients for regions other than the shared client's, by region.
+_region_clients = {}
+# Guards creating and replacing the clients above.
+_lock = threading.Lock()
+
+
+def configure(session=None, **client_kwargs):
+    """Set how the shared S3 client is created.
+
+    `session` is a boto3 session to create the client from, and any
+    keyword arguments are passed on to its ``client('s3', ...)`` call.
+    The client is recreated on next use, as are those of other regions.
+    """
+    global _session, _client_kwargs, _client, _pool_size
+    with _lock:
+        _session = session
+        _client_kwargs = client_kwargs
+        _client = None
+        _pool_size = 0
+        _region_clients.clear()
+
+
+def set_client(client):
+    """Use the given client as the shared S3 client as is.
+
+    It is then used for buckets in every region.
+    """
+    global _client, _pool_size
+    with _lock:
+        _client = client
+        _pool_size = float('inf')
+        _region_clients.clear()
+
+
+def is_client_set():
+    """Return whether a client was given with set_client()."""
+    return _pool_size == float('inf')
+
+
+def _create_client(pool_size, region=None):
+    import boto3
+    from botocore.config import Config
+
+    kwargs = dict(_client_kwargs)
+    # Retries are left to the scheduler, unless configured otherwise.
+    config = Config(retries={'max_attempts': 0})
+    if kwargs.get('config') is not None:
+        config = config.merge(kwargs['config'])
+    config = config.merge(Config(max_pool_connections=pool_size))
+    kwargs['config'] = config
+    if region is not None:
+        kwargs['region_name'] = region
+    client = (_session or boto3).client('s3', **kwargs)
+    log.debug('Created S3 client for %s with %d pooled connections',
+              client.meta.region_name, pool_size)
+    return client
+
+
+def _get_region_client(region, max_pool_connections):
+    # Called with _lock held.
+    client, pool_size = _region_clients.get(region, (None, 0))
+    if client is None or (max_pool_connections is not None and
+                          max_pool_connections > pool_size):
+        pool_size = max(
+            max_pool_connections or 0, pool_size, DEFAULT_POOL_SIZE)
+        client = _create_client(pool_size, region)
+        _region_clients[region] = client, pool_size
+    return client
+
+
+def get_client(max_pool_connections=None, region=None):
+    """Return the shared S3 client, creating it on first use.
+
+    The client is recreated with a larger connection pool when more
+    than its current pool size of concurrent connections is requested.
+    With `region`, the client for buckets in that region is returned;
+    clients of other regions than the shared one's are configured and
+    grown alike.
+    """
+    global _client, _pool_size
+    with _lock:
+        if _client is None:
+            _pool_size = max(max_pool_connections or 0, DEFAULT_POOL_SIZE)
+            _client = _create_client(_pool_size)
+        if (region is not None and not is_client_set() and
+                region != _client.meta.region_name):
+            return _get_region_client(region, max_pool_connections)
+        if max_pool_connections is not None and (
+                max_pool_connections > _pool_size):
+            _pool_size = max_pool_connections
+            _client = _create_client(_pool_size)
+        return _client
@@ -23,33 +23,87 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 from __future__ import absolute_import
+import base64
+import binascii
+import errno
+import hashlib
+import itertools
 import logging
+import os
+import sys
+import threading
+import time
+import uuid
+import zlib
 from collections import defaultdict
 from collections import namedtuple
 
-import gevent
-import gevent.pool
 from botocore.exceptions import ClientError
 
-from . import resources
+from . import executors
+from . import local
+from . import planner
+from . import regions
+from .cache import metadata_cache
+from .journal import Journal
+from .metrics import Recorder
+from .planner import COPY_PART_SIZE
+from .planner import KB
+from .planner import StreamPlanner
+from .planner import MB
+from .planner import estimate
+from .planner import plan_parts
+from .planner import split_copy
+from .scheduler import scheduled
+from .sources import S3Obj
+from .sources import SourceTable
 from .urls import S3URL
+from .urls import make_url
 
 
 logging.basicConfig(level='WARNING')
 log = logging.getLogger(__name__)
 
 
-s3 = resources.s3
+CONCURRENCY = 10
+READ_CHUNK_SIZE = 256 * KB
 
-KB = 1024
-MB = KB**2
+# Bytes of content compressed into each gzip member.
+GZIP_BLOCK_SIZE = 1 * MB
 
 
-def _get_object_info(bucket, key):
+def _get_client(client=None, concurrency=CONCURRENCY, recorder=None):
+    # Parts in flight may each hold a connection while a packed part
+    # fetches its ranges, hence twice the concurrency.
+    return scheduled(client or regions.RegionRouter(
+        max_pool_connections=2 * concurrency), recorder=recorder)
+
+
+def _get_object_info(bucket, key, s3=None, trust_writes=False):
+    """Return the size and ETag of the object, or None if missing.
+
+    Only callers that copy the object conditionally on the returned
+    ETag, and can start over should the copy fail, may `trust_writes`.
+    """
+    s3 = s3 or scheduled(regions.RegionRouter())
+    cached = metadata_cache.get(bucket, key, trust_writes)
+    if cached is not None and cached[1]:
+        return cached[0]
     try:
-        return s3.head_object(Bucket=bucket, Key=key)
-    except ClientError:
-        return None
+        info = s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as exc:
+        code = exc.response['Error']['Code']
+        if code in ('404', 'NoSuchKey', 'NoSuchBucket', 'NotFound'):
+            metadata_cache.invalidate(bucket, key)
+            return None
+        raise
+    metadata_cache.set(bucket, key, info)
+    return info
+
+
+def _parse_range(byte_range):
+    start, end = byte_range[len('bytes='):].split('-')
+    return int(start), int(end)
 
 
 def split(content, size):
@@ -57,171 +111,1087 @@ def split(content, size):
         yield content[i:i + size]
 
 
+def _iter_chunks(content):
+    if isinstance(content, basestring):
+        yield content
+    elif hasattr(content, 'read'):
+        for chunk in iter(lambda: content.read(READ_CHUNK_SIZE), ''):
+            yield chunk
+    else:
+        for chunk in content:
+            yield chunk
+
+
+def _iter_parts(content, size):
+    """Yield parts of `size` bytes (the last may be shorter) from content.
+
+    Content may be a string, a file-like object, or an iterable of
+    byte chunks. Non-string content is consumed lazily, so only the part
+    being assembled is held in memory.
+    """
+    if isinstance(content, basestring):
+        for part in split(content, size):
+            yield part
+        return
+
+    buf = []
+    buffered = 0
+    for chunk in _iter_chunks(content):
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            data = ''.join(buf)
+            offset = 0
+            while len(data) - offset >= size:
+                yield data[offset:offset + size]
+                offset += size
+            buf = [data[offset:]]
+            buffered = len(buf[0])
+    if buffered:
+        yield ''.join(buf)
+
+
+class IntegrityError(Exception):
+    """The object written does not match the data it was made from."""
+
+
+def _md5(body):
+    if isinstance(body, (str, bytearray)):
+        return hashlib.md5(body)
+    md5 = hashlib.md5()
+    start = body.tell()
+    for chunk in iter(lambda: body.read(READ_CHUNK_SIZE), ''):
+        md5.update(chunk)
+    body.seek(start)
+    return md5
+
+
+def _multipart_etag(etags):
+    """Return the ETag S3 gives an object completed from parts."""
+    digests = ''.join(binascii.unhexlify(etag.strip('"')) for etag in etags)
+    return '"{}-{}"'.format(hashlib.md5(digests).hexdigest(), len(etags))
+
+
+def _copy_etag(copy_source, byte_range):
+    """Return the ETag of a part copied from a range, if known.
+
+    It is the source's ETag when the range is the whole object, and the
+    ETag is an MD5 digest, not one of a multipart upload.
+    """
+    cached = metadata_cache.get(copy_source['Bucket'], copy_source['Key'])
+    if cached is None:
+        return None
+    info = cached[0]
+    if '-' in info['ETag'] or byte_range not in (
+            None, (0, info['ContentLength'] - 1)):
+        return None
+    return info['ETag']
+
+
+def _gzip(data, level):
+    # A window of 16 + MAX_WBITS bits makes zlib write a gzip member.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _check_level(compress):
+    level = 6 if compress is True else compress
+    if not isinstance(level, (int, long)) or not 1 <= level <= 9:
+        raise ValueError('Compression level must be between 1 and 9')
+    return level
+
+
+def _iter_gzip_members(content, level, concurrency=1):
+    """Yield content compressed as independent gzip members.
+
+    Each member holds GZIP_BLOCK_SIZE bytes of content, compressed on
+    up to `concurrency` threads ahead of the consumer. Members can be
+    concatenated to any gzip stream, which remains valid.
+    """
+    pool = executors.ThreadPool(concurrency)
+    return pool.imap(lambda block: _gzip(block, level),
+                     _iter_parts(content, GZIP_BLOCK_SIZE))
+
+
 class _MultipartUpload(object):
 
-    def __init__(self, bucket, key):
+    def __init__(self, bucket, key, concurrency=1, s3=None, journal=None,
+                 num_parts=None, verify=False):
+        self.s3 = s3 or scheduled(regions.RegionRouter())
         self.bucket = bucket
         self.key = key
         self.upload_id = None
         self.upload_parts = []
+        self.pool = executors.pool(concurrency)
+        self.error = None
+        self.size = 0
+        self.journal = journal
+        self.num_parts = num_parts
+        self.uploaded = {}
+        # With `verify`, the ETag each part is expected to get, if known.
+        self.verify = verify
+        self.expected = []
+        self.encrypted = False
+        self.completed = False
 
     def __enter__(self):
-        resp = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)
-        self.upload_id = resp['UploadId']
+        if self.journal is not None:
+            self._resume()
+        if self.upload_id is None:
+            resp = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)
+            self.upload_id = resp['UploadId']
+            if self.journal is not None:
+                self.journal.start_upload(
+                    self.bucket, self.key, self.upload_id, self.num_parts)
         return self
 
     def __exit__(self, exc_t, exc_v, exc_tb):
         if exc_t:
-            log.exception('Error completing multipart upload; aborting')
-            s3.abort_multipart_upload(
-                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            if self.journal is not None:
+                log.exception('Error completing multipart upload; leaving '
+                              'it to be resumed from %s', self.journal.path)
+                self.pool.kill()
+            else:
+                log.exception('Error completing multipart upload; aborting')
+                self.abort()
             raise exc_v
 
+    def _resume(self):
+        upload_id, num_parts = self.journal.uploads.get(
+            (self.bucket, self.key), (None, None))
+        if upload_id is None:
+            return
+        if num_parts != self.num_parts:
+            raise ValueError(
+                'Upload {} to {}/{} was planned with {} parts, not {}'.format(
+                    upload_id, self.bucket, self.key, num_parts,
+                    self.num_parts))
+        kwargs = {'Bucket': self.bucket, 'Key': self.key,
+                  'UploadId': upload_id}
+        try:
+            while True:
+                page = self.s3.list_parts(**kwargs)
+                for rec in page.get('Parts', []):
+                    self.uploaded[rec['PartNumber']] = (
+                        rec['ETag'], rec['Size'])
+                if not page.get('IsTruncated'):
+                    break
+                kwargs['PartNumberMarker'] = page['NextPartNumberMarker']
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+            log.warning('Upload %s to %s/%s no longer exists; restarting',
+                        upload_id, self.bucket, self.key)
+            return
+        log.info('Resuming upload %s to %s/%s with %d parts done',
+                 upload_id, self.bucket, self.key, len(self.uploaded))
+        self.upload_id = upload_id
+
+    def reuse_part(self, size):
+        """Take the next part from the resumed upload if it is there.
+
+        Returns True if a part of the given size was already uploaded
+        under the next part number, in which case it need not be added.
+        """
+        uploaded = self.uploaded.get(len(self.upload_parts) + 1)
+        if uploaded is None or uploaded[1] != size:
+            return False
+        self.upload_parts.append(uploaded[0])
+        self.expected.append(None)
+        if self.size is not None:
+            self.size += size
+        return True
+
+    def abort(self):
+        self.pool.kill()
+        if self.completed:
+            return
+        self.s3.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
     def start(self):
-        s3.complete_multipart_upload(
+        self.pool.join()
+        self._raise_error()
+        resp = self.s3.complete_multipart_upload(
             Bucket=self.bucket, Key=self.key, MultipartUpload={'Parts': [
                 {'ETag': etag, 'PartNumber': i}
                 for i, etag in enumerate(self.upload_parts, 1)]},
             UploadId=self.upload_id)
+        self.completed = True
+        if self.size is None:
+            metadata_cache.invalidate(self.bucket, self.key)
+        else:
+            metadata_cache.set(self.bucket, self.key, {
+                'ContentLength': self.size, 'ETag': resp['ETag']},
+                written=True)
+        if self.journal is not None:
+            self.journal.complete_upload(self.bucket, self.key, self.size)
+        if self.verify:
+            self._verify(resp['ETag'])
+
+    def _verify(self, etag):
+        # Objects encrypted with KMS or customer keys do not have MD5
+        # digests for ETags.
+        if self.encrypted:
+            log.info('Cannot verify encrypted object %s/%s', self.bucket,
+                     self.key)
+            return
+        # Parts whose data was not seen here count as they were received;
+        # the whole is still checked to be made of them, in order.
+        expected = _multipart_etag([
+            part_expected or part_etag for part_expected, part_etag in zip(
+                self.expected, self.upload_parts)])
+        if expected != etag:
+            metadata_cache.invalidate(self.bucket, self.key)
+            raise IntegrityError(
+                '{}/{} has ETag {}, not {} as expected from its parts'.format(
+                    self.bucket, self.key, etag, expected))
+        log.debug('Verified %s/%s; %d of %d parts checked', self.bucket,
+                  self.key, sum(1 for e in self.expected if e),
+                  len(self.expected))
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _submit(self, method, get_etag, kwargs, done=None, expected=None):
+        # Part numbers are assigned in submission order, so ETags end
+        # up in the right slots regardless of completion order.
+        self._raise_error()
+        self.upload_parts.append(None)
+        self.expected.append(expected)
+        self.pool.spawn(self._run_part, len(self.upload_parts), method,
+                        get_etag, kwargs, done)
+
+    def _run_part(self, part_number, method, get_etag, kwargs, done=None):
+        start = time.time()
+        try:
+            resp = method(
+                Bucket=self.bucket,
+                Key=self.key,
+                PartNumber=part_number,
+                UploadId=self.upload_id,
+                **kwargs)
+        except Exception as exc:
+            log.error('Error uploading part %d of %s/%s: %r',
+                      part_number, self.bucket, self.key, exc)
+            if self.error is None:
+                self.error = exc
+            return
+        finally:
+            if done is not None:
+                done(time.time() - start)
+        etag = get_etag(resp)
+        if 'SSEKMSKeyId' in resp or 'SSECustomerAlgorithm' in resp:
+            self.encrypted = True
+        expected = self.expected[part_number - 1]
+        if expected is not None and etag != expected and not self.encrypted:
+            log.error('Part %d of %s/%s has ETag %s, not %s', part_number,
+                      self.bucket, self.key, etag, expected)
+            if self.error is None:
+                self.error = IntegrityError(
+                    'Part {} of {}/{} does not match its data'.format(
+                        part_number, self.bucket, self.key))
+            return
+        self.upload_parts[part_number - 1] = etag
+        if self.journal is not None:
+            self.journal.record_part(self.upload_id, part_number, etag)
 
-    def add_part(self, **kwargs):
-        resp = s3.upload_part(
-            Bucket=self.bucket,
-            Key=self.key,
-            PartNumber=len(self.upload_parts) + 1,
-            UploadId=self.upload_id,
-            **kwargs)
-        self.upload_parts.append(resp['ETag'])
-
-    def add_part_copy(self, **kwargs):
-        resp = s3.upload_part_copy(
-            Bucket=self.bucket,
-            Key=self.key,
-            PartNumber=len(self.upload_parts) + 1,
-            UploadId=self.upload_id,
-            **kwargs)
-        self.upload_parts.append(resp['CopyPartResult']['ETag'])
-
-
-def _upload_object(bucket, key, content):
-    if len(content) < 5 * MB:
-        s3.put_object(Bucket=bucket, Key=key, Body=content)
+    def add_part(self, done=None, **kwargs):
+        """Upload a part.
+
+        `done` is called with the seconds the request took once it is
+        over, successful or not.
+        """
+        if self.size is not None:
+            self.size += len(kwargs['Body'])
+        expected = None
+        if self.verify:
+            # S3 rejects the part if its data arrives corrupted.
+            md5 = _md5(kwargs['Body'])
+            kwargs['ContentMD5'] = base64.b64encode(md5.digest())
+            expected = '"{}"'.format(md5.hexdigest())
+        self._submit(self.s3.upload_part, lambda resp: resp['ETag'], kwargs,
+                     done, expected)
+
+    def add_part_copy(self, done=None, **kwargs):
+        byte_range = None
+        if 'CopySourceRange' in kwargs:
+            byte_range = _parse_range(kwargs['CopySourceRange'])
+        if byte_range is not None and self.size is not None:
+            self.size += byte_range[1] - byte_range[0] + 1
+        else:
+            self.size = None
+        expected = None
+        if self.verify:
+            expected = _copy_etag(kwargs['CopySource'], byte_range)
+        self._submit(self.s3.upload_part_copy,
+                     lambda resp: resp['CopyPartResult']['ETag'], kwargs,
+                     done, expected)
+
+
+def _put_object(s3, bucket, key, body, verify=False):
+    kwargs = {}
+    if verify:
+        md5 = _md5(body)
+        kwargs['ContentMD5'] = base64.b64encode(md5.digest())
+    resp = s3.put_object(Bucket=bucket, Key=key, Body=body, **kwargs)
+    if verify and not ('SSEKMSKeyId' in resp or
+                       'SSECustomerAlgorithm' in resp) and (
+            resp['ETag'] != '"{}"'.format(md5.hexdigest())):
+        metadata_cache.invalidate(bucket, key)
+        raise IntegrityError('{}/{} has ETag {}, not the MD5 of its '
+                             'data'.format(bucket, key, resp['ETag']))
+    metadata_cache.set(bucket, key, {
+        'ContentLength': len(body), 'ETag': resp['ETag']}, written=True)
+
+
+def _upload_object(s3, bucket, key, content, concurrency=1, verify=False):
+    parts = _iter_parts(content, 5 * MB)
+    first = next(parts, '')
+    second = next(parts, None)
+    if second is None:
+        _put_object(s3, bucket, key, first, verify)
     else:
-        with _MultipartUpload(bucket, key) as mpu:
-            for part in split(content, size=5 * MB):
+        # The pool blocks submission once `concurrency` parts are in
+        # flight, which bounds the number of part buffers in memory.
+        with _MultipartUpload(bucket, key, concurrency, s3,
+                              verify=verify) as mpu:
+            mpu.add_part(Body=first)
+            mpu.add_part(Body=second)
+            del first, second
+            for part in parts:
                 mpu.add_part(Body=part)
             mpu.start()
 
 
-def _concat_to_small_object(bucket, key, content):
+def _concat_to_small_object(s3, bucket, key, content, concurrency=1,
+                            verify=False):
     resp = s3.get_object(Bucket=bucket, Key=key)
-    _upload_object(bucket, key, resp['Body'].read() + content)
+    existing = resp['Body'].read()
+    if isinstance(content, basestring):
+        content = existing + content
+    else:
+        content = itertools.chain([existing], _iter_chunks(content))
+    _upload_object(s3, bucket, key, content, concurrency, verify)
+
+
+# Parts left by default for what is appended after an existing object;
+# at 5 MB a part, a tenth of the limit holds 5 GB.
+_APPEND_PARTS = planner.MAX_PARTS // 10
 
 
-def _concat_to_big_object(bucket, key, content):
-    with _MultipartUpload(bucket, key) as mpu:
+def _add_copy_parts(mpu, bucket, key, info, copy_part_size,
+                    reserve=_APPEND_PARTS):
+    """Copy the object into the upload as ranged parts copied in parallel.
+
+    Parts grow past `copy_part_size` as needed to leave `reserve` parts
+    of the limit to the content that follows. The copies fail with
+    PreconditionFailed if the object no longer has the ETag in `info`.
+    """
+    for byte_range in split_copy(0, info['ContentLength'] - 1,
+                                 copy_part_size, planner.MAX_PARTS - reserve):
         mpu.add_part_copy(
-            CopySource={'Bucket': bucket, 'Key': key})
-        for part in split(content, size=5 * MB):
+            CopySource={'Bucket': bucket, 'Key': key},
+            CopySourceIfMatch=info['ETag'],
+            CopySourceRange='bytes={0}-{1}'.format(*byte_range))
+
+
+def _concat_to_big_object(s3, bucket, key, info, content, concurrency=1,
+                          copy_part_size=COPY_PART_SIZE, verify=False):
+    reserve = _APPEND_PARTS
+    if isinstance(content, basestring):
+        reserve = max(1, -(-len(content) // (5 * MB)))
+    with _MultipartUpload(bucket, key, concurrency, s3,
+                          verify=verify) as mpu:
+        _add_copy_parts(mpu, bucket, key, info, copy_part_size, reserve)
+        for part in _iter_parts(content, 5 * MB):
             mpu.add_part(Body=part)
         mpu.start()
 
 
-def s3concat_content(bucket, key, content):
-    info = _get_object_info(bucket, key)
-    if info is None:
-        _upload_object(bucket, key, content)
+def s3concat_content(bucket, key, content, concurrency=CONCURRENCY,
+                     client=None, copy_part_size=COPY_PART_SIZE, hooks=(),
+                     compress=False, verify=False):
+    """Append content to the S3 object, creating it if missing.
+
+    Content may be a string, a file-like object, or an iterable of byte
+    chunks; the latter two are streamed part by part. The shared clients
+    from :mod:`s3concat.resources`, one per bucket region, are used
+    unless `client` is given.
+    An existing object is copied in parts of `copy_part_size` bytes,
+    grown as needed to leave room within the part limit for the content.
+
+    With `compress`, True or a zlib level from 1 to 9, content is
+    appended as gzip members compressed while parts upload. Appended to
+    a gzip object, or to none, they make a valid multi-member gzip file.
+
+    With `verify`, the object written is checked as by :func:`s3concat`.
+
+    Returns a :class:`s3concat.metrics.Report` of the requests made,
+    which are also passed to the `hooks`.
+    """
+    planner.check_copy_part_size(copy_part_size)
+    # Only content that can be read again may be appended on the word of
+    # the metadata cache, as the object must be looked up again and the
+    # append started over should another writer have changed it.
+    replayable = isinstance(content, basestring) and not compress
+    if compress:
+        content = _iter_gzip_members(
+            content, _check_level(compress), concurrency)
+    with Recorder(hooks) as recorder:
+        s3 = _get_client(client, concurrency, recorder)
+        while True:
+            info = _get_object_info(bucket, key, s3, replayable)
+            try:
+                if info is None:
+                    _upload_object(
+                        s3, bucket, key, content, concurrency, verify)
+                elif info['ContentLength'] < 5 * MB:
+                    _concat_to_small_object(
+                        s3, bucket, key, content, concurrency, verify)
+                else:
+                    _concat_to_big_object(
+                        s3, bucket, key, info, content, concurrency,
+                        copy_part_size, verify)
+                break
+            except ClientError as exc:
+                if not replayable or exc.response['Error']['Code'] not in (
+                        'PreconditionFailed', 'NoSuchKey', '404'):
+                    raise
+                log.info('%s/%s changed since it was cached; appending '
+                         'again', bucket, key)
+                metadata_cache.invalidate(bucket, key)
+    return recorder.report
+
+
+def _fetch_part(s3, part, concurrency=1):
+    """Download the byte ranges of a packed part into a single buffer.
+
+    The buffer is allocated once from the known range sizes and each
+    range is fetched concurrently and written to its own offset. Ranges
+    of local files are read into the buffer directly.
+    """
+    offsets = []
+    size = 0
+    for _, (start, end) in part:
+        offsets.append(size)
+        size += end - start + 1
+    buf = bytearray(size)
+    view = memoryview(buf)
+
+    def fetch(args):
+        (obj, byte_range), offset = args
+        if obj.bucket is None:
+            local.read_into(obj.key, byte_range[0], view[
+                offset:offset + byte_range[1] - byte_range[0] + 1])
+            return
+        resp = s3.get_object(
+            Bucket=obj.bucket, Key=obj.key,
+            Range='bytes={0}-{1}'.format(*byte_range))
+        end = offset + byte_range[1] - byte_range[0] + 1
+        body = resp['Body']
+        while offset < end:
+            chunk = body.read(min(READ_CHUNK_SIZE, end - offset))
+            if not chunk:
+                raise IOError(
+                    'Premature end of {} at byte {}'.format(obj, offset))
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+
+    pool = executors.pool(concurrency)
+    pool.map(fetch, zip(part, offsets))
+    return buf
+
+
+Plan = namedtuple('Plan', ['target', 'sources', 'parts', 'estimate'])
+
+
+def _read_url(s3, url):
+    """Return the content of the S3 object or local file, or None."""
+    s3url = make_url(url)
+    if s3url.bucket is None:
+        try:
+            with open(s3url.key, 'rb') as f:
+                return f.read()
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return None
+    try:
+        resp = s3.get_object(Bucket=s3url.bucket, Key=s3url.key)
+    except ClientError as exc:
+        if exc.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        return None
+    return resp['Body'].read()
+
+
+def _write_url(s3, url, data):
+    """Write the S3 object or local file; a file is replaced atomically."""
+    s3url = make_url(url)
+    if s3url.bucket is None:
+        tmp = '{}.{}.tmp'.format(s3url.key, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, s3url.key)
     else:
-        if info['ContentLength'] < 5 * MB:
-            _concat_to_small_object(bucket, key, content)
-        else:
-            _concat_to_big_object(bucket, key, content)
+        s3.put_object(Bucket=s3url.bucket, Key=s3url.key, Body=data)
+
+
+def _list_objects(s3, s3url, start_after=None):
+    """Yield the objects matching a prefix or glob URL in key order.
 
+    Sizes and ETags are taken from the listing, so no HEAD is needed.
+    Only keys after `start_after` are listed, if given.
+    """
+    kwargs = {'Bucket': s3url.bucket, 'Prefix': s3url.prefix}
+    if start_after is not None:
+        kwargs['StartAfter'] = start_after
+    while True:
+        # Paged by hand rather than with a paginator so that every page
+        # is requested through the scheduler.
+        page = s3.list_objects_v2(**kwargs)
+        for rec in page.get('Contents', []):
+            if s3url.match(rec['Key']):
+                info = {'ContentLength': rec['Size'], 'ETag': rec['ETag']}
+                metadata_cache.set(s3url.bucket, rec['Key'], info)
+                yield S3Obj(S3URL.from_parts(s3url.bucket, rec['Key']), info)
+        if not page.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = page['NextContinuationToken']
 
-S3Obj = namedtuple('S3Obj', ['s3url', 'info'])
 
+def _iter_listed(s3, s3url):
+    """List the objects a prefix or glob URL names lazily.
+
+    The first page is requested at once, the others as the objects are
+    consumed, so that the first sources are used without waiting for
+    the whole listing.
+    """
+    objs = _list_objects(s3, s3url)
+    first = next(objs, None)
+    return [] if first is None else itertools.chain([first], objs)
+
+
+def _lookup(s3, url, expand=True):
+    """Return the parsed URL and the sources it names that exist.
+
+    A key with glob characters names the object of that exact key if
+    there is one, and is otherwise expanded as a glob unless `expand`
+    is false. Sources listed for a prefix or glob are yielded lazily.
+    """
+    s3url = make_url(url)
+    if s3url.bucket is None:
+        try:
+            size = os.path.getsize(s3url.key)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return s3url, []
+        return s3url, [S3Obj(s3url, {'ContentLength': size})]
+    if s3url.is_prefix:
+        return s3url, _iter_listed(s3, s3url)
+    info = _get_object_info(s3url.bucket, s3url.key, s3)
+    if info is None:
+        if expand and s3url.is_pattern:
+            return s3url, _iter_listed(s3, s3url)
+        return s3url, []
+    return s3url, [S3Obj(s3url, {'ContentLength': info['ContentLength'],
+                                 'ETag': info.get('ETag')})]
 
-def s3concat(urls, remove_orig=False):
-    urls = iter(urls)
 
-    def get_info(url):
-        s3url = S3URL(url)
-        return S3Obj(s3url, _get_object_info(s3url.bucket, s3url.key))
+def _lookup_all(s3, urls, concurrency=CONCURRENCY, expand_first=True):
+    """Look up URLs `concurrency` at a time, yielding results in order."""
+    def lookup(args):
+        i, url = args
+        return _lookup(s3, url, expand=expand_first or i > 0)
+    return executors.pool(concurrency).imap(lookup, enumerate(urls))
 
-    pool = gevent.pool.Group()
-    s3objs = [o for o in pool.imap(get_info, urls)]
-    pool.join()
 
-    if len(s3objs) < 2:
+def _iter_sources(s3, urls, concurrency=CONCURRENCY):
+    """Yield the target URL, then the existing sources in input order.
+
+    URLs are consumed lazily and looked up `concurrency` at a time ahead
+    of the consumer, so sources can be used as their sizes arrive. Only
+    the size and ETag of each source are kept. Sources other than s3://
+    URLs are local files. The target is never expanded as a glob.
+    """
+    expanded = _lookup_all(s3, urls, concurrency, expand_first=False)
+    head = list(itertools.islice(expanded, 2))
+    if len(head) < 2:
         raise ValueError('Must specify at least two S3 objects')
 
-    primary = s3objs[0].s3url
-    s3objs = [o for o in s3objs if o.info is not None]
-    if not s3objs:
+    primary = head[0][0]
+    if primary.bucket is None:
+        raise ValueError('The first URL must name an S3 object, '
+                         'not a local file')
+    if primary.is_prefix:
+        raise ValueError('The first S3 URL must name an object, '
+                         'not a prefix')
+    yield primary
+
+    found = False
+    for s3url, objs in itertools.chain(head, expanded):
+        for o in objs:
+            # A listing that covers the target must not add it again;
+            # only objects found by listing have URLs of their own.
+            if o.s3url is not s3url and (
+                    o.s3url.bucket == primary.bucket and
+                    o.s3url.key == primary.key):
+                continue
+            found = True
+            yield o
+    if not found:
         raise ValueError('None of input S3 objects exist')
 
-    parts = []
-    current_part = []
-    current_part_size = 0
-    for s3obj in s3objs:
-        size = s3obj.info['ContentLength']
 
-        if current_part_size + size < 5 * MB:
-            current_part.append((s3obj.s3url, None))
-            current_part_size += size
-        else:
-            if current_part_size == 0:
-                parts.append([(s3obj.s3url, (0, size - 1))])
+def _get_sources(s3, urls, concurrency=CONCURRENCY):
+    sources = _iter_sources(s3, urls, concurrency)
+    primary = next(sources)
+    return primary, SourceTable.from_objs(sources)
 
-            else:
-                diff_size = 5 * MB - current_part_size
-                current_part.append((s3obj.s3url, (0, diff_size - 1)))
 
-                parts.append(current_part)
+def _plan_sources(s3objs, copy_part_size=COPY_PART_SIZE):
+    return plan_parts(s3objs.sizes, copy_part_size)
 
-                if size - diff_size < 5 * MB:
-                    current_part = [(s3obj.s3url, (diff_size, size - 1))]
-                    current_part_size = size - diff_size
-                else:
-                    parts.append([(s3obj.s3url, (diff_size, size - 1))])
-
-                    current_part = []
-                    current_part_size = 0
-
-    if current_part:
-        parts.append(current_part)
-
-    with _MultipartUpload(primary.bucket, primary.key) as mpu:
-        for part_number, part in enumerate(parts, 1):
-            if len(part) == 1:
-                obj, byte_range = part[0]
-                kwargs = {'CopySource': {'Bucket': obj.bucket, 'Key': obj.key}}
-                if byte_range is not None:
-                    kwargs['CopySourceRange'] = 'bytes={0}-{1}'.format(
-                        *byte_range)
-                mpu.add_part_copy(**kwargs)
-            else:
-                content = ''
-                for obj, byte_range in part:
-                    kwargs = {'Bucket': obj.bucket, 'Key': obj.key}
-                    if byte_range is not None:
-                        kwargs['Range'] = 'bytes={0}-{1}'.format(*byte_range)
-                    resp = s3.get_object(**kwargs)
-                    content += resp['Body'].read()
-                mpu.add_part(Body=content)
+
+def _resolve_parts(s3objs, parts):
+    return [[(s3objs.s3url(index), byte_range)
+             for index, byte_range in part]
+            for part in parts]
+
+
+def s3concat_plan(urls, concurrency=CONCURRENCY, client=None,
+                  copy_part_size=COPY_PART_SIZE):
+    """Plan the concatenation of objects without performing it.
+
+    The returned plan lists the parts of the multipart upload and an
+    estimate of the requests and bytes the concatenation would take. A
+    plan of more than 10,000 parts is carried out by merging through
+    intermediate objects, which adds server-side copies not counted in
+    the estimate.
+    """
+    planner.check_copy_part_size(copy_part_size)
+    primary, s3objs = _get_sources(
+        _get_client(client, concurrency), urls, concurrency)
+    parts = _resolve_parts(s3objs, _plan_sources(s3objs, copy_part_size))
+    return Plan(primary, s3objs, parts,
+                estimate(parts, lambda obj: obj.bucket is None))
+
+
+def _group_sources(s3objs, parts, max_parts):
+    """Cut the sources into consecutive groups of about `max_parts` parts.
+
+    Groups end only where a source ends, so each can be merged on its
+    own and re-planned to roughly the same number of parts.
+    """
+    groups = []
+    lo = 0
+    count = 0
+    for part in parts:
+        count += 1
+        index, (_, end) = part[-1]
+        if (count >= max_parts and
+                end == s3objs.sizes[index] - 1):
+            groups.append(s3objs[lo:index + 1])
+            lo = index + 1
+            count = 0
+    if lo < len(s3objs):
+        groups.append(s3objs[lo:])
+    return groups
+
+
+class _Job(object):
+    """State shared by the uploads of one concatenation."""
+
+    def __init__(self, s3, concurrency, journal=None,
+                 copy_part_size=COPY_PART_SIZE, memory=None, verify=False,
+                 transfer_remote=False):
+        self.s3 = s3
+        self.concurrency = concurrency
+        self.copy_part_size = copy_part_size
+        self.verify = verify
+        self.transfer_remote = transfer_remote
+        self.journal = journal
+        self.token = journal.token if journal else uuid.uuid4().hex
+        self.temps = []
+        # An executors.Budget of bytes of part buffers, shared by jobs.
+        self.memory = memory
+        self.reserved = 0
+        self._lock = threading.Lock()
+        # (bucket, key) of sources downloaded and uploaded, not copied.
+        self.transfers = set()
+
+    def reserve(self, size):
+        """Take bytes of the memory budget, if any; returns the bytes held."""
+        if self.memory is None:
+            return 0
+        size = self.memory.acquire(size)
+        with self._lock:
+            self.reserved += size
+        return size
+
+    def unreserve(self, size):
+        with self._lock:
+            size = min(size, self.reserved)
+            self.reserved -= size
+        if size:
+            self.memory.release(size)
+
+    def temp_url(self, bucket, key, index):
+        # Named deterministically so that a resumed job finds them again.
+        s3url = S3URL('s3://{}/{}.s3concat-{}-{}'.format(
+            bucket, key, self.token, index))
+        self.temps.append(s3url)
+        if self.journal is not None and (
+                str(s3url) not in self.journal.temps):
+            self.journal.add_temp(str(s3url))
+        return s3url
+
+
+def _merge(job, bucket, key, s3objs):
+    """Concatenate the sources into the object at bucket/key.
+
+    When the plan has more parts than a multipart upload allows, the
+    sources are first merged in groups, in parallel, into intermediate
+    objects that are recorded in `job.temps` for later removal.
+    """
+    if job.journal is not None and (bucket, key) in job.journal.completed:
+        log.info('%s/%s was completed before; skipping', bucket, key)
+        return
+
+    parts = _plan_sources(s3objs, job.copy_part_size)
+
+    if len(parts) > planner.MAX_PARTS:
+        groups = _group_sources(s3objs, parts, planner.MAX_PARTS // 2)
+        if len(groups) < 2:
+            raise ValueError(
+                'Concatenation needs {} parts; at most {} are allowed'.format(
+                    len(parts), planner.MAX_PARTS))
+        log.info('Merging %d parts into %s/%s through %d intermediate '
+                 'objects', len(parts), bucket, key, len(groups))
+
+        def merge_group(args):
+            index, group = args
+            s3url = job.temp_url(bucket, key, index)
+            _merge(job, s3url.bucket, s3url.key, group)
+            return s3url.bucket, s3url.key, sum(group.sizes)
+
+        pool = executors.pool(job.concurrency)
+        s3objs = SourceTable(pool.map(merge_group, enumerate(groups)))
+        return _merge(job, bucket, key, s3objs)
+
+    if not parts:
+        _put_object(job.s3, bucket, key, '', job.verify)
+        return
+
+    with _MultipartUpload(bucket, key, job.concurrency, job.s3,
+                          job.journal, len(parts), job.verify) as mpu:
+        for part in _resolve_parts(s3objs, parts):
+            if mpu.reuse_part(
+                    sum(end - start + 1 for _, (start, end) in part)):
+                continue
+            _add_part(job, mpu, part)
+        mpu.start()
+
+
+def _add_part(job, mpu, part):
+    size = sum(end - start + 1 for _, (start, end) in part)
+    obj = part[0][0]
+    source = regions.bucket_regions.cached(obj.bucket)
+    target = regions.bucket_regions.cached(mpu.bucket)
+
+    if len(part) == 1 and obj.bucket is None:
+        mpu.add_part(Body=local.MappedRange(obj.key, *part[0][1]))
+    elif len(part) == 1 and (obj.bucket, obj.key) not in job.transfers:
+        mpu.add_part_copy(
+            CopySource={'Bucket': obj.bucket, 'Key': obj.key},
+            CopySourceRange='bytes={0}-{1}'.format(*part[0][1]),
+            done=lambda elapsed: regions.throughput.record(
+                regions.COPY, source, target, size, elapsed))
+    else:
+        # The buffer is held until its upload is over.
+        held = job.reserve(size)
+        try:
+            start = time.time()
+            body = _fetch_part(job.s3, part, job.concurrency)
+            fetched = time.time() - start
+
+            def done(elapsed):
+                job.unreserve(held)
+                if len(part) == 1:
+                    regions.throughput.record(
+                        regions.TRANSFER, source, target, size,
+                        fetched + elapsed)
+            mpu.add_part(Body=body, done=done)
+        except BaseException:
+            # Nothing was submitted, so the callback never runs.
+            job.unreserve(held)
+            raise
+
+
+def _stream_merge(job, bucket, key, sources):
+    """Concatenate sources into bucket/key while they are looked up.
+
+    Parts are uploaded as soon as the streaming planner settles them.
+    Should the plan outgrow the part limit, the rest of it goes into
+    intermediate objects, which are finally copied into the target's
+    upload in the parts held in reserve. Returns the sources.
+    """
+    # At 5 GB a part, a tenth of the parts holds an object of any size.
+    reserve = max(1, planner.MAX_PARTS // 10)
+    stream = StreamPlanner(job.copy_part_size)
+    s3objs = SourceTable()
+    spills = SourceTable()
+    uploads = [None, None]  # to the target, and to the current spill
+
+    def open_upload(s3url):
+        mpu = _MultipartUpload(s3url.bucket, s3url.key, job.concurrency,
+                               job.s3, verify=job.verify)
+        mpu.__enter__()
+        return mpu
+
+    def close_spill():
+        mpu = uploads[1]
         mpu.start()
+        spills.append(mpu.bucket, mpu.key, mpu.size)
+        uploads[1] = None
+
+    def upload(parts):
+        for part in _resolve_parts(s3objs, parts):
+            if uploads[0] is None:
+                uploads[0] = open_upload(S3URL(
+                    's3://{}/{}'.format(bucket, key)))
+            mpu = uploads[1] or uploads[0]
+            limit = planner.MAX_PARTS
+            if mpu is uploads[0]:
+                limit -= reserve
+            if len(mpu.upload_parts) >= limit:
+                if uploads[1] is not None:
+                    close_spill()
+                else:
+                    log.info('Plan for %s/%s outgrew the part limit; '
+                             'spilling into intermediate objects',
+                             bucket, key)
+                mpu = uploads[1] = open_upload(
+                    job.temp_url(bucket, key, len(spills)))
+            _add_part(job, mpu, part)
+
+    def part_size(s3url, size):
+        # Sources that may be copied whole are copied or, from another
+        # region if faster, downloaded and uploaded in smaller parts.
+        if (s3url.bucket is None or size < planner.MIN_PART_SIZE or
+                not job.transfer_remote):
+            return None
+        if regions.throughput.choose(
+                regions.bucket_regions.cached(s3url.bucket),
+                regions.bucket_regions.cached(bucket)) == regions.COPY:
+            return None
+        job.transfers.add((s3url.bucket, s3url.key))
+        return planner.TRANSFER_PART_SIZE
+
+    try:
+        for o in sources:
+            s3objs.add(o)
+            size = o.info['ContentLength']
+            upload(stream.add(len(s3objs) - 1, size,
+                              part_size(o.s3url, size)))
+        upload(stream.finish())
+
+        if uploads[0] is None:
+            _put_object(job.s3, bucket, key, '', job.verify)
+            return s3objs
+
+        if uploads[1] is not None:
+            close_spill()
+            parts = plan_parts(spills.sizes, job.copy_part_size, reserve)
+            if len(parts) > reserve:
+                s3url = job.temp_url(bucket, key, 'spilled')
+                _merge(job, s3url.bucket, s3url.key, spills)
+                spills = SourceTable(
+                    [(s3url.bucket, s3url.key, sum(spills.sizes))])
+                parts = plan_parts(spills.sizes, job.copy_part_size, reserve)
+            for part in _resolve_parts(spills, parts):
+                _add_part(job, uploads[0], part)
+        uploads[0].start()
+    except BaseException:
+        exc_info = sys.exc_info()
+        log.exception('Error concatenating into %s/%s; aborting', bucket, key)
+        for mpu in uploads:
+            if mpu is not None:
+                try:
+                    mpu.abort()
+                except Exception:
+                    log.exception('Error aborting upload %s', mpu.upload_id)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return s3objs
+
+
+def _delete_objects(s3, s3urls, concurrency=CONCURRENCY):
+    buckets = defaultdict(set)
+    for s3url in s3urls:
+        if s3url.bucket is None:
+            _remove_file(s3url.key)
+            continue
+        buckets[s3url.bucket].add(s3url.key)
+        metadata_cache.invalidate(s3url.bucket, s3url.key)
+
+    def delete(args):
+        bucket, keys = args
+        s3.delete_objects(
+            Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys]})
+
+    batches = []
+    for bucket, keys in buckets.iteritems():
+        keys = sorted(keys)
+        for idx in xrange(0, len(keys), 1000):
+            batches.append((bucket, keys[idx:idx + 1000]))
+    executors.pool(concurrency).map(delete, batches)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def _run(job, primary, s3objs, remove_orig):
+    try:
+        if job.journal is None:
+            s3objs = _stream_merge(job, primary.bucket, primary.key, s3objs)
+        else:
+            _merge(job, primary.bucket, primary.key, s3objs)
+    except Exception:
+        if job.journal is None and job.temps:
+            _delete_objects(job.s3, job.temps, job.concurrency)
+        raise
+    finally:
+        # Parts cancelled by an abort never release their buffers.
+        job.unreserve(job.reserved)
+
+    temps = job.temps
+    if job.journal is not None:
+        temps = set(str(u) for u in temps) | set(job.journal.temps)
+        temps = [S3URL(url) for url in sorted(temps)]
+    if temps:
+        _delete_objects(job.s3, temps, job.concurrency)
 
     if remove_orig:
-        buckets = defaultdict(set)
-        for s3obj in s3objs:
-            s3url = s3obj.s3url
-            if not (s3url.bucket == primary.bucket and
-                    s3url.key == primary.key):
-                buckets[s3url.bucket].add(s3url.key)
-        for bucket, keys in buckets.iteritems():
-            keys = list(keys)
-            for idx in xrange(0, len(keys), 1000):
-                s3.delete_objects(
-                    Bucket=bucket,
-                    Delete={'Objects': [
-                        {'Key': key} for key in keys[idx:idx + 1000]]})
+        _delete_objects(job.s3, [
+            s3objs.s3url(i) for i in xrange(len(s3objs))
+            if not (s3objs.bucket(i) == primary.bucket and
+                    s3objs.key(i) == primary.key)], job.concurrency)
+
+
+def s3concat(urls, remove_orig=False, concurrency=CONCURRENCY, client=None,
+             journal=None, copy_part_size=COPY_PART_SIZE, hooks=(),
+             verify=False, transfer_remote=False):
+    """Concatenate S3 objects into the first one.
+
+    URLs may be any iterable. Sources are looked up `concurrency` at a
+    time while parts already planned are copied or uploaded. Sources
+    copied server-side, the first object included, are copied in ranged
+    parts of about `copy_part_size` bytes, in parallel.
+
+    Sources after the first may also be local file paths. Their data is
+    memory-mapped and uploaded from the mapping, so large files are not
+    read into memory. With `remove_orig`, local sources are deleted too.
+
+    If `journal` names a local file, the plan and the progress of every
+    upload are recorded there, and a concatenation interrupted by a crash
+    can be finished with :func:`s3concat_resume`. Uploads are then left
+    open on failure instead of being aborted.
+
+    With `verify`, uploaded parts are sent with their MD5 digests, which
+    S3 checks, and the ETag S3 gives the object is checked against the
+    one expected from its parts, without downloading anything. Parts
+    copied from whole objects are expected to get the sources' ETags;
+    other copied parts are only checked to be in place. An
+    :class:`IntegrityError` is raised on a mismatch. Objects encrypted
+    with KMS or customer keys cannot be checked.
+
+    With `transfer_remote`, large sources in another region than the
+    target's may be downloaded and uploaded in parts instead of copied,
+    once that has been measured to be faster between the two regions.
+
+    Returns a :class:`s3concat.metrics.Report` of the requests made,
+    which are also passed to the `hooks`.
+    """
+    planner.check_copy_part_size(copy_part_size)
+    with Recorder(hooks) as recorder:
+        _concat(_get_client(client, concurrency, recorder), urls,
+                remove_orig, concurrency, journal, copy_part_size,
+                verify=verify, transfer_remote=transfer_remote)
+    return recorder.report
+
+
+def _concat(s3, urls, remove_orig, concurrency, journal, copy_part_size,
+            memory=None, verify=False, transfer_remote=False):
+    s3objs = _iter_sources(s3, urls, concurrency)
+    primary = next(s3objs)
+
+    if journal is not None:
+        # The journal records the whole plan, so sources are all looked
+        # up before any part is planned.
+        s3objs = SourceTable.from_objs(s3objs)
+        journal = Journal(journal)
+        if journal.job is not None:
+            journal.close()
+            raise ValueError('{} already records a concatenation; use '
+                             's3concat_resume()'.format(journal.path))
+        journal.start_job(str(primary), [
+            (str(s3objs.s3url(i)), s3objs.sizes[i], s3objs.etag(i))
+            for i in xrange(len(s3objs))], remove_orig, copy_part_size)
+
+    _run_journaled(
+        _Job(s3, concurrency, journal, copy_part_size, memory, verify,
+             transfer_remote),
+        primary, s3objs, remove_orig)
+
+
+def s3concat_resume(journal, concurrency=CONCURRENCY, client=None,
+                    hooks=()):
+    """Finish a concatenation recorded in the journal file.
+
+    Uploads are reconciled with the parts S3 lists for them, so only the
+    parts that are missing are copied or uploaded again. Returns a
+    report like :func:`s3concat` does.
+    """
+    with Recorder(hooks) as recorder:
+        _resume(_get_client(client, concurrency, recorder), journal,
+                concurrency)
+    return recorder.report
+
+
+def _resume(s3, journal, concurrency):
+    journal = Journal(journal)
+    if journal.job is None:
+        journal.close()
+        raise ValueError(
+            'No concatenation recorded in {}'.format(journal.path))
+
+    rec = journal.job
+    s3objs = SourceTable()
+    for url, size, etag in rec['sources']:
+        s3url = make_url(url)
+        s3objs.append(s3url.bucket, s3url.key, size, etag)
+    job = _Job(s3, concurrency, journal,
+               rec.get('copy_part_size') or COPY_PART_SIZE)
+    _run_journaled(job, S3URL(rec['target']), s3objs, rec['remove_orig'])
+
+
+def _run_journaled(job, primary, s3objs, remove_orig):
+    if job.journal is None:
+        return _run(job, primary, s3objs, remove_orig)
+    try:
+        _run(job, primary, s3objs, remove_orig)
+    except Exception:
+        job.journal.close()
+        raise
+    job.journal.close(remove=True)
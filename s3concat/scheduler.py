@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import itertools
+import logging
+import random
+import threading
+from collections import deque
+
+from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectionError
+from botocore.exceptions import HTTPClientError
+
+from . import executors
+
+
+log = logging.getLogger(__name__)
+
+
+# Error codes with which S3 asks clients to slow down.
+THROTTLE_CODES = frozenset([
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequests', 'ServiceUnavailable', '503'])
+
+# Error codes of failures that may succeed when retried as is.
+TRANSIENT_CODES = frozenset([
+    'InternalError', 'RequestTimeout', '500', '502', '504'])
+
+# Client methods that do not make a request.
+UNSCHEDULED = frozenset([
+    'can_paginate', 'generate_presigned_post', 'generate_presigned_url',
+    'get_paginator', 'get_waiter'])
+
+
+def _error_code(exc):
+    if not isinstance(exc, ClientError):
+        return None
+    return exc.response.get('Error', {}).get('Code')
+
+
+def _is_throttle(exc):
+    if not isinstance(exc, ClientError):
+        return False
+    status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return _error_code(exc) in THROTTLE_CODES or status == 503
+
+
+def _is_transient(exc):
+    if isinstance(exc, (ConnectionError, HTTPClientError)):
+        return True
+    return _error_code(exc) in TRANSIENT_CODES
+
+
+class _Limiter(object):
+    """Bound on the requests in flight to one prefix, adjusted by AIMD."""
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        # Incremented on every decrease; requests started in an earlier
+        # epoch were already accounted for and do not decrease it again.
+        self.epoch = 0
+        self._waiters = deque()
+        # Guards the state above; never held while waiting.
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if not self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return self.epoch
+            waiter = executors.event()
+            self._waiters.append(waiter)
+        try:
+            waiter.wait()
+        except BaseException:
+            with self._lock:
+                if not waiter.is_set():
+                    self._waiters.remove(waiter)
+                    raise
+            self.release()
+            raise
+        return self.epoch
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self):
+        # Slots are handed over to waiters in the order they arrived.
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._waiters.popleft().set()
+
+    def increase(self, maximum):
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.limit = min(maximum, self.limit + 1. / self.limit)
+                self._wake()
+
+    def decrease(self, epoch, factor, minimum):
+        with self._lock:
+            if epoch != self.epoch:
+                return False
+            self.epoch += 1
+            self.limit = max(
+                minimum, min(self.limit, self.in_flight) * factor)
+            return True
+
+    @property
+    def idle(self):
+        return not self.in_flight and not self._waiters
+
+
+class Scheduler(object):
+    """Run S3 requests with per-prefix concurrency control and retries.
+
+    Requests are grouped by bucket and key prefix, as S3 scales request
+    rates per prefix. A group may have at most its limit of requests in
+    flight. The limit starts at `maximum` and is cut by `decrease` times
+    the requests in flight when S3 throttles, then grows by about one
+    for every round of requests that succeed.
+
+    Throttled and transient failures are retried up to `max_attempts`
+    in all, after a random delay of up to `backoff` seconds doubled per
+    attempt and capped at `max_backoff`.
+    """
+
+    def __init__(self, maximum=1024, minimum=1, decrease=0.5, max_attempts=8,
+                 backoff=0.1, max_backoff=20., sleep=None,
+                 random=random.random):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Sleeps with the configured backend if not given.
+        self.sleep = sleep
+        self.random = random
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limit(self, bucket, key=''):
+        """Return the current limit of requests in flight for the key."""
+        limiter = self._limiters.get(self._group(bucket, key))
+        return self.maximum if limiter is None else int(limiter.limit)
+
+    def _group(self, bucket, key):
+        return bucket, (key or '').rpartition('/')[0]
+
+    def _acquire(self, group):
+        with self._lock:
+            limiter = self._limiters.get(group)
+            if limiter is None:
+                limiter = self._limiters[group] = _Limiter(self.maximum)
+        return limiter, limiter.acquire()
+
+    def _release(self, group, limiter):
+        limiter.release()
+        with self._lock:
+            if limiter.idle and limiter.limit >= self.maximum:
+                self._limiters.pop(group, None)
+
+    def call(self, bucket, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs) as a request on the bucket and key."""
+        group = self._group(bucket, key)
+        for attempt in itertools.count(1):
+            limiter, epoch = self._acquire(group)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                error = exc
+                throttled = _is_throttle(exc)
+                if throttled and limiter.decrease(
+                        epoch, self.decrease, self.minimum):
+                    log.info('Throttled on s3://%s/%s; limiting to %d '
+                             'requests', group[0], group[1],
+                             int(limiter.limit))
+                self._release(group, limiter)
+                if (attempt >= self.max_attempts or
+                        not (throttled or _is_transient(exc))):
+                    raise
+            except BaseException:
+                self._release(group, limiter)
+                raise
+            else:
+                limiter.increase(self.maximum)
+                self._release(group, limiter)
+                return result
+
+            delay = self.random() * min(
+                self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            log.debug('Retrying %s on s3://%s/%s in %.2f s after: %s',
+                      getattr(func, '__name__', func), bucket, key, delay,
+                      error)
+            (self.sleep or executors.sleep)(delay)
+
+
+def _rewinding(func, body):
+    # Every attempt sends the body from where the first one started.
+    start = body.tell()
+
+    def call(**kwargs):
+        body.seek(start)
+        return func(**kwargs)
+    return call
+
+
+class ScheduledClient(object):
+    """S3 client proxy whose requests are run through a scheduler.
+
+    Every attempt at a request is recorded by the `recorder` of
+    :mod:`s3concat.metrics`, if given.
+    """
+
+    def __init__(self, client, scheduler, recorder=None):
+        self.client = client
+        self.scheduler = scheduler
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or name in UNSCHEDULED or not callable(attr):
+            return attr
+
+        def call(**kwargs):
+            func = attr
+            if hasattr(kwargs.get('Body'), 'seek'):
+                func = _rewinding(func, kwargs['Body'])
+            if self.recorder is not None:
+                func = self.recorder.wrap(name, func)
+            return self.scheduler.call(
+                kwargs.get('Bucket'), kwargs.get('Key', kwargs.get('Prefix')),
+                func, **kwargs)
+        call.__name__ = name
+        return call
+
+
+def scheduled(client, scheduler=None, recorder=None):
+    """Return the client with its requests run through the scheduler.
+
+    A client already scheduled is returned as is, unless a `recorder` is
+    given to record its requests instead.
+    """
+    if isinstance(client, ScheduledClient):
+        if recorder is None:
+            return client
+        return ScheduledClient(client.client, client.scheduler, recorder)
+    return ScheduledClient(client, scheduler or request_scheduler, recorder)
+
+
+request_scheduler = Scheduler()
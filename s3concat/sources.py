@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import binascii
+import logging
+import re
+from array import array
+from collections import namedtuple
+
+from .urls import LocalURL
+from .urls import S3URL
+
+
+log = logging.getLogger(__name__)
+
+
+S3Obj = namedtuple('S3Obj', ['s3url', 'info'])
+
+_md5_etag = re.compile(r'^"([0-9a-f]{32})(?:-([0-9]+))?"$')
+
+# Part counts marking ETags stored as is, and ETags without a count.
+_ODD = 0xffff
+_WHOLE = 0
+
+
+class SourceTable(object):
+    """Compact, columnar table of the sources of a concatenation.
+
+    Each row holds a bucket, key, size and ETag. Bucket names are
+    interned and referred to by number, keys are packed into a single
+    buffer delimited by offsets, and sizes are kept in an array. ETags
+    of the usual MD5 form, optionally with a part count, take 16 bytes
+    and a count; others are kept as they are. A row takes a few tens of
+    bytes besides its key, against the kilobyte or so of the objects
+    of an S3URL and a response dict.
+
+    Indexing returns a row as an S3Obj built on demand; slicing returns
+    a new table. Local files are rows with a bucket of None and their
+    path as key.
+    """
+
+    __slots__ = ('_buckets', '_bucket_ids', '_bucket_rows', '_keys',
+                 '_key_offsets', 'sizes', '_digests', '_part_counts',
+                 '_odd_etags')
+
+    def __init__(self, rows=()):
+        self._buckets = []
+        self._bucket_ids = {}
+        self._bucket_rows = array('I')
+        self._keys = bytearray()
+        self._key_offsets = array('L', [0])
+        # Sizes are 64 bits wide on the 64-bit platforms supported.
+        self.sizes = array('L')
+        self._digests = bytearray()
+        self._part_counts = array('H')
+        self._odd_etags = {}
+        for row in rows:
+            self.append(*row)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def append(self, bucket, key, size, etag=None):
+        bucket_id = self._bucket_ids.get(bucket)
+        if bucket_id is None:
+            bucket_id = self._bucket_ids[bucket] = len(self._buckets)
+            self._buckets.append(bucket)
+        self._bucket_rows.append(bucket_id)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        self._keys.extend(key)
+        self._key_offsets.append(len(self._keys))
+        self.sizes.append(size)
+
+        matched = _md5_etag.match(etag) if etag is not None else None
+        if matched and int(matched.group(2) or 1) < _ODD:
+            self._digests.extend(binascii.unhexlify(matched.group(1)))
+            self._part_counts.append(int(matched.group(2) or _WHOLE))
+        else:
+            self._digests.extend(b'\0' * 16)
+            self._part_counts.append(_ODD)
+            self._odd_etags[len(self.sizes) - 1] = etag
+
+    def add(self, s3obj):
+        """Append an S3Obj as a row."""
+        self.append(s3obj.s3url.bucket, s3obj.s3url.key,
+                    s3obj.info['ContentLength'], s3obj.info.get('ETag'))
+
+    @classmethod
+    def from_objs(cls, s3objs):
+        """Create a table from S3Obj tuples."""
+        table = cls()
+        for o in s3objs:
+            table.add(o)
+        return table
+
+    def bucket(self, i):
+        return self._buckets[self._bucket_rows[i]]
+
+    def key(self, i):
+        key = str(self._keys[self._key_offsets[i]:self._key_offsets[i + 1]])
+        try:
+            key.decode('ascii')
+        except UnicodeDecodeError:
+            return key.decode('utf-8')
+        return key
+
+    def etag(self, i):
+        count = self._part_counts[i]
+        if count == _ODD:
+            return self._odd_etags[i]
+        digest = binascii.hexlify(self._digests[16 * i:16 * (i + 1)])
+        if count == _WHOLE:
+            return '"{}"'.format(digest)
+        return '"{}-{}"'.format(digest, count)
+
+    def s3url(self, i):
+        bucket = self.bucket(i)
+        if bucket is None:
+            return LocalURL(self.key(i))
+        return S3URL.from_parts(bucket, self.key(i))
+
+    def _row(self, i):
+        return (self.bucket(i), self.key(i), self.sizes[i], self.etag(i))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return SourceTable(
+                self._row(j) for j in xrange(*i.indices(len(self))))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('source index out of range')
+        return S3Obj(self.s3url(i),
+                     {'ContentLength': self.sizes[i], 'ETag': self.etag(i)})
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
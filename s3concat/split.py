@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+# Copyright (c) 2016 Taro Sato
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import absolute_import
+import logging
+from collections import namedtuple
+
+from . import executors
+from . import planner
+from .metrics import Recorder
+from .planner import COPY_PART_SIZE
+from .planner import KB
+from .planner import MB
+from .planner import check_copy_part_size
+from .planner import split_copy
+from .s3concat import CONCURRENCY
+from .s3concat import _MultipartUpload
+from .s3concat import _get_client
+from .s3concat import _get_object_info
+from .urls import S3URL
+
+
+log = logging.getLogger(__name__)
+
+
+# Bytes read first around a cut point when looking for a delimiter.
+PROBE_SIZE = 64 * KB
+MAX_PROBE_SIZE = 8 * MB
+
+# The outputs, each an S3URL with the inclusive byte range of the
+# source it holds, and the report of the requests made.
+Split = namedtuple('Split', ['outputs', 'report'])
+
+
+def _find_after(s3, src, etag, size, cut, delimiter, probe_size):
+    """Return the offset just past the first delimiter at or after
+    cut - 1, or the size of the source if there is none.
+
+    The source is read in ranges that double in size while no delimiter
+    is found, so a long record costs few requests.
+    """
+    pos = cut - 1
+    while pos < size:
+        end = min(pos + probe_size, size) - 1
+        data = s3.get_object(
+            Bucket=src.bucket, Key=src.key, IfMatch=etag,
+            Range='bytes={}-{}'.format(pos, end))['Body'].read()
+        found = data.find(delimiter)
+        if found >= 0:
+            return pos + found + 1
+        pos = end + 1
+        probe_size = min(2 * probe_size, MAX_PROBE_SIZE)
+    return size
+
+
+def _cuts(size, offsets, chunk_size):
+    if (offsets is None) == (chunk_size is None):
+        raise ValueError('Give either offsets or a chunk size')
+    if chunk_size is not None:
+        if chunk_size <= 0:
+            raise ValueError('Chunk size must be positive')
+        return range(chunk_size, size, chunk_size)
+    offsets = sorted(set(offsets))
+    if offsets and not 0 <= offsets[0] <= offsets[-1] <= size:
+        raise ValueError('Offsets must be between 0 and {}'.format(size))
+    return [offset for offset in offsets if 0 < offset < size]
+
+
+def s3split(url, prefix, offsets=None, chunk_size=None, delimiter=None,
+            name='part-{:05d}', concurrency=CONCURRENCY, client=None,
+            copy_part_size=COPY_PART_SIZE, probe_size=PROBE_SIZE, hooks=()):
+    """Split the S3 object into objects holding consecutive byte ranges.
+
+    The object is cut at the byte `offsets`, or every `chunk_size`
+    bytes. With a `delimiter` byte, such as a newline, each cut is moved
+    forward to just past the next delimiter, found by ranged GETs of
+    about `probe_size` bytes, so that every output ends with a whole
+    record. Outputs are written under the S3 URL `prefix`, named by
+    formatting `name` with their number, `concurrency` at a time.
+
+    Outputs are built from server-side copies of ranges of the source,
+    in parts of about `copy_part_size` bytes, grown as needed to stay
+    within the part limit; only the bytes probed for delimiters pass
+    through the client. Copies are conditional on the source's ETag, so
+    a source modified meanwhile fails the split.
+    Returns a :class:`Split` of the outputs and the report of the
+    requests made.
+    """
+    check_copy_part_size(copy_part_size)
+    if delimiter is not None and len(delimiter) != 1:
+        raise ValueError('The delimiter must be a single byte')
+    src = S3URL(url)
+    target = S3URL(prefix)
+
+    with Recorder(hooks) as recorder:
+        s3 = _get_client(client, concurrency, recorder)
+        info = _get_object_info(src.bucket, src.key, s3)
+        if info is None:
+            raise ValueError('{} does not exist'.format(src))
+        size, etag = info['ContentLength'], info['ETag']
+        cuts = _cuts(size, offsets, chunk_size)
+
+        pool = executors.pool(concurrency)
+        if delimiter is not None and cuts:
+            cuts = sorted(set(pool.map(
+                lambda cut: _find_after(
+                    s3, src, etag, size, cut, delimiter, probe_size),
+                cuts)) - set([size]))
+
+        bounds = [0] + list(cuts) + [size]
+        outputs = [
+            (S3URL.from_parts(target.bucket, target.key + name.format(i)),
+             (start, end - 1))
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:]))
+            if end > start]
+        if any((s3url.bucket, s3url.key) == (src.bucket, src.key)
+               for s3url, _ in outputs):
+            raise ValueError('An output would overwrite {}'.format(src))
+
+        def build(output):
+            s3url, (start, end) = output
+            # A single part may be of any size, so every output, however
+            # small, is copied server-side.
+            with _MultipartUpload(s3url.bucket, s3url.key, 1, s3) as mpu:
+                for byte_range in split_copy(start, end, copy_part_size,
+                                             planner.MAX_PARTS):
+                    mpu.add_part_copy(
+                        CopySource={'Bucket': src.bucket, 'Key': src.key},
+                        CopySourceIfMatch=etag,
+                        CopySourceRange='bytes={0}-{1}'.format(*byte_range))
+                mpu.start()
+            log.info('Copied bytes %d-%d of %s to %s', start, end, src,
+                     s3url)
+            return output
+
+        outputs = list(pool.imap(build, outputs))
+    return Split(outputs, recorder.report)
@@ -24,27 +24,111 @@
 # SOFTWARE.
 from __future__ import absolute_import
 import logging
+import os
+import re
+from fnmatch import fnmatchcase
 from urlparse import urlparse
 
 
 log = logging.getLogger(__name__)
 
 
+_glob_chars = re.compile(r'[*?[]')
+
+
+def _intern(s):
+    return intern(s) if isinstance(s, str) else s
+
+
 class URL(object):
-    pass
+
+    __slots__ = ()
 
 
 class S3URL(URL):
 
+    __slots__ = ('bucket', 'key')
+
     def __init__(self, url):
         parsed = urlparse(url)
         if parsed.scheme != 's3':
             raise ValueError("An S3 path must starts with 's3://'")
-        self.bucket = parsed.netloc
-        self.key = parsed.path[1:]
+        # Many URLs share few buckets.
+        self.bucket = _intern(parsed.netloc)
+        # Taken verbatim, as keys may contain '?' and '#'.
+        self.key = url[len('s3://') + len(self.bucket) + 1:]
+
+    @classmethod
+    def from_parts(cls, bucket, key):
+        """Create the URL of the key in the bucket without parsing."""
+        s3url = cls.__new__(cls)
+        s3url.bucket = _intern(bucket)
+        s3url.key = key
+        return s3url
+
+    @property
+    def is_prefix(self):
+        """True if the URL names every key under a prefix (ends with '/')."""
+        return self.key == '' or self.key.endswith('/')
+
+    @property
+    def is_pattern(self):
+        """True if the URL names a prefix or may be a glob.
+
+        A key with glob characters is a glob only when no object has
+        exactly that key; see :meth:`is_prefix` for URLs always listed.
+        """
+        return self.is_prefix or bool(_glob_chars.search(self.key))
+
+    @property
+    def prefix(self):
+        """The longest literal prefix of the key."""
+        matched = _glob_chars.search(self.key)
+        return self.key[:matched.start()] if matched else self.key
+
+    def match(self, key):
+        if _glob_chars.search(self.key):
+            return fnmatchcase(key, self.key)
+        return key.startswith(self.key)
 
     def __repr__(self):
         return 's3://{}/{}'.format(self.bucket, self.key)
 
     def __str__(self):
         return self.__repr__()
+
+
+class LocalURL(URL):
+    """Path of a local file, given as is or as a file:// URL."""
+
+    __slots__ = ('key',)
+
+    # Local files are told apart from S3 objects by having no bucket.
+    bucket = None
+    is_prefix = is_pattern = False
+
+    def __init__(self, url):
+        if url.startswith('file://'):
+            url = url[len('file://'):]
+        self.key = os.path.abspath(url)
+
+    @property
+    def path(self):
+        return self.key
+
+    def __repr__(self):
+        return 'file://' + self.key
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def make_url(url):
+    """Return the S3URL or LocalURL that the string names."""
+    scheme = urlparse(url).scheme
+    if scheme == 's3':
+        return S3URL(url)
+    if scheme in ('', 'file'):
+        return LocalURL(url)
+    raise ValueError('A source must be an s3:// URL or a local path, '
+                     'not {}'.format(url))
@@ -59,7 +59,10 @@ setup(
         'Topic :: System :: Distributed Computing'],
     packages=['s3concat'],
     scripts=[],
+    entry_points={
+        'console_scripts': ['s3concat = s3concat.cli:main']},
     url='https://github.com/okomestudio/s3concat',
     install_requires=[
         'boto3',
+        'futures',
         'gevent'])
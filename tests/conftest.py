@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import urllib
+
 import pytest
 from moto import mock_s3
 
@@ -17,9 +19,47 @@ def s3(request):
     if not use_s3:
         m = mock_s3()
         m.start()
+        _check_copy_conditions()
 
     from s3concat import resources
-    yield resources.s3
+    yield resources.get_client()
 
     if m:
         m.stop()
+
+
+class _Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def _check_copy_conditions():
+    """Fail part copies whose source does not have the ETag required.
+
+    S3 does, but moto ignores CopySourceIfMatch. Clients created from
+    the default session afterwards, as the library's are, check it.
+    """
+    import boto3
+    s3 = boto3.client('s3')
+
+    def check(params, **kwargs):
+        headers = params['headers']
+        etag = headers.get('x-amz-copy-source-if-match')
+        if etag is None:
+            return None
+        bucket, key = urllib.unquote(
+            headers['x-amz-copy-source']).split('/', 1)
+        try:
+            matched = s3.head_object(Bucket=bucket, Key=key)['ETag'] == etag
+        except s3.exceptions.ClientError:
+            code, status = 'NoSuchKey', 404
+        else:
+            if matched:
+                return None
+            code, status = 'PreconditionFailed', 412
+        return _Response(status), {
+            'Error': {'Code': code, 'Message': 'Copy source changed'},
+            'ResponseMetadata': {'HTTPStatusCode': status}}
+    boto3._get_default_session().events.register(
+        'before-call.s3.UploadPartCopy', check)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(tmpdir, *args):
+    path = str(tmpdir.join('results.json'))
+    status = subprocess.call(
+        [sys.executable, '-m', 'benchmarks.run', '--latency', '0',
+         '--bandwidth', '0', '--copy-rate', '0', '--json', path] +
+        list(args), cwd=ROOT)
+    with open(path) as f:
+        return status, json.load(f)['results']
+
+
+def test_all_scenarios(tmpdir):
+    status, results = run(tmpdir, '--scale', '0.05')
+    assert status == 0
+    assert set(results) == {'tiny', 'mixed', 'huge', 'append',
+                            'append-small'}
+    for result in results.values():
+        assert 'error' not in result
+        assert sum(result['requests'].values()) > 0
+        assert result['peak_memory'] > 0
+    assert results['tiny']['bytes_copied'] == 0
+    assert results['tiny']['requests']['CompleteMultipartUpload'] == 1
+    assert results['huge']['bytes_copied'] > 4 * 1024 ** 3
+    assert results['append']['bytes_uploaded'] > 0
+
+
+def test_baseline_regression(tmpdir):
+    status, results = run(tmpdir, '--scale', '0.05', 'tiny')
+    results['tiny']['requests'] = {'GetObject': 1}
+    path = str(tmpdir.join('baseline.json'))
+    with open(path, 'w') as f:
+        json.dump({'results': results}, f)
+    status, _ = run(tmpdir, '--scale', '0.05', '--baseline', path, 'tiny')
+    assert status == 1
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from s3concat.cache import MetadataCache
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def info(size, etag='"x"'):
+    return {'ContentLength': size, 'ETag': etag}
+
+
+def test_lru_eviction():
+    cache = MetadataCache(maxsize=2)
+    cache.set('b', 'k1', info(1))
+    cache.set('b', 'k2', info(2))
+    cache.get('b', 'k1')
+    cache.set('b', 'k3', info(3))
+    assert len(cache) == 2
+    assert cache.get('b', 'k2') is None
+    assert cache.get('b', 'k1')[0] == info(1)
+
+
+def test_ttl():
+    clock = Clock()
+    cache = MetadataCache(ttl=10, clock=clock)
+    cache.set('b', 'k', dict(info(1), Metadata={}))
+    assert cache.get('b', 'k') == (info(1), True)
+    clock.now = 10
+    assert cache.get('b', 'k') == (info(1), False)
+
+
+def test_written_ttl():
+    clock = Clock()
+    cache = MetadataCache(clock=clock)
+    cache.set('b', 'looked-up', info(1))
+    cache.set('b', 'written', info(2), written=True)
+    assert cache.get('b', 'looked-up') == (info(1), False)
+    assert cache.get('b', 'written') == (info(2), True)
+    assert cache.get('b', 'written', trust_writes=False) == (info(2), False)
+    clock.now = cache.write_ttl
+    assert cache.get('b', 'written') == (info(2), False)
+
+
+def test_disabled():
+    cache = MetadataCache(maxsize=0, ttl=10)
+    cache.set('b', 'k', info(1))
+    assert cache.get('b', 'k') is None
+
+
+def test_invalidate():
+    cache = MetadataCache()
+    cache.set('b', 'k', info(1))
+    cache.invalidate('b', 'k')
+    cache.invalidate('b', 'missing')
+    assert cache.get('b', 'k') is None
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import string
+
+import pytest
+
+from s3concat.compact import _assign_balanced
+from s3concat.compact import _assign_ordered
+from s3concat.sources import S3Obj
+from s3concat.urls import S3URL
+
+
+KB = 1024
+MB = KB**2
+
+
+def objs(*sizes):
+    return [S3Obj(S3URL.from_parts('b', str(i)), {'ContentLength': size})
+            for i, size in enumerate(sizes)]
+
+
+def keys(groups):
+    return [[o.s3url.key for o in group] for group in groups]
+
+
+def test_assign_ordered():
+    groups = _assign_ordered(objs(4, 4, 3, 9, 1, 1, 6, 12, 2), 10)
+    assert keys(groups) == [['0', '1', '2'], ['3', '4'], ['5', '6'], ['7'],
+                            ['8']]
+
+
+def test_assign_balanced():
+    groups = _assign_balanced(objs(9, 1, 5, 5, 4, 6), 10)
+    assert keys(groups) == [['0', '1'], ['2', '3'], ['4', '5']]
+    assert len(_assign_balanced(objs(3), 10)) == 1
+
+
+@pytest.fixture
+def bucket(s3):
+    bucket = 's3concat-test-' + ''.join(
+        random.choice(string.ascii_lowercase) for _ in xrange(12))
+    s3.create_bucket(Bucket=bucket)
+    yield bucket
+    resp = s3.list_objects_v2(Bucket=bucket)
+    if 'Contents' in resp:
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [
+            {'Key': rec['Key']} for rec in resp['Contents']]})
+    s3.delete_bucket(Bucket=bucket)
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_s3compact(s3, bucket, ordered):
+    from s3concat import s3compact
+    contents = {}
+    for i, size in enumerate([3 * MB, 6 * MB, 2 * MB, 1 * MB, 7 * MB]):
+        key = 'in/{}'.format(i)
+        contents[key] = chr(ord('a') + i) * size
+        s3.put_object(Bucket=bucket, Key=key, Body=contents[key])
+
+    result = s3compact(['s3://{}/in/'.format(bucket)],
+                       's3://{}/out/'.format(bucket), shard_size=8 * MB,
+                       ordered=ordered, remove_orig=True)
+
+    listed = sorted(rec['Key'] for rec in s3.list_objects_v2(
+        Bucket=bucket)['Contents'])
+    assert listed == ['out/manifest.json'] + [
+        'out/part-{:05d}'.format(i) for i in xrange(len(result.shards))]
+    manifest = json.loads(s3.get_object(
+        Bucket=bucket, Key='out/manifest.json')['Body'].read())
+    assert manifest == result.manifest
+    assert sorted(src['url'] for shard in manifest['shards']
+                  for src in shard['sources']) == sorted(
+        's3://{}/{}'.format(bucket, key) for key in contents)
+    for shard in manifest['shards']:
+        key = shard['url'].split('/', 3)[3]
+        body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        assert body == ''.join(contents[src['url'].split('/', 3)[3]]
+                               for src in shard['sources'])
+        assert shard['size'] == len(body)
+    if ordered:
+        assert [len(s['sources']) for s in manifest['shards']] == [2, 3]
+    assert result.report.bytes_copied > 0
+
+
+def test_s3compact_no_sources(s3, bucket):
+    from s3concat import s3compact
+    with pytest.raises(ValueError):
+        s3compact(['s3://{}/in/'.format(bucket)],
+                  's3://{}/out/'.format(bucket))
+
+
+@pytest.mark.parametrize('manifest', [None, 'in/x'])
+def test_s3compact_refuses_to_overwrite_sources(s3, bucket, manifest):
+    from s3concat import s3compact
+    keys = ['in/part-00000', 'in/part-00001', 'in/x']
+    if manifest is not None:
+        keys = ['in/a', 'in/x']
+        manifest = 's3://{}/{}'.format(bucket, manifest)
+    for key in keys:
+        s3.put_object(Bucket=bucket, Key=key, Body=key)
+
+    with pytest.raises(ValueError):
+        s3compact(['s3://{}/in/'.format(bucket)], 's3://{}/in/'.format(bucket),
+                  shard_size=2, manifest=manifest, remove_orig=True)
+
+    for key in keys:
+        assert s3.get_object(Bucket=bucket, Key=key)['Body'].read() == key
+    assert sorted(rec['Key'] for rec in s3.list_objects_v2(
+        Bucket=bucket)['Contents']) == keys
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from s3concat import executors
+from s3concat.executors import ThreadPool
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setattr(executors, '_backend', executors.get_backend())
+
+
+def test_thread_pool_map():
+    pool = ThreadPool(3)
+    assert pool.map(lambda x: x * 2, xrange(10)) == range(0, 20, 2)
+
+
+def test_thread_pool_bounded():
+    lock = threading.Lock()
+    state = {'running': 0, 'peak': 0}
+
+    def work(_):
+        with lock:
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+        time.sleep(0.01)
+        with lock:
+            state['running'] -= 1
+
+    pool = ThreadPool(2)
+    for i in xrange(6):
+        pool.spawn(work, i)
+    pool.join()
+    assert state == {'running': 0, 'peak': 2}
+
+
+def test_thread_pool_error():
+    def work(x):
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        ThreadPool(2).map(work, xrange(6))
+
+
+def test_thread_pool_kill():
+    started = threading.Event()
+    done = []
+
+    def work(x):
+        started.set()
+        time.sleep(0.05)
+        done.append(x)
+
+    pool = ThreadPool(1)
+    pool.spawn(work, 0)
+    started.wait()
+    pool._slots.release()  # let a second call queue behind the first
+    pool.spawn(work, 1)
+    pool.kill()
+    assert done == [0]
+
+
+@pytest.mark.usefixtures('backend')
+def test_configure():
+    executors.configure('thread')
+    assert isinstance(executors.pool(2), ThreadPool)
+    assert isinstance(executors.event(), threading._Event)
+    with pytest.raises(ValueError) as exc:
+        executors.configure('asyncio')
+    assert 'Unknown backend' in exc.value.message
+    executors.configure(executors.GeventBackend())
+    assert executors.get_backend().name == 'gevent'
+
+
+@pytest.mark.usefixtures('backend')
+@pytest.mark.parametrize('name', ['gevent', 'thread'])
+def test_budget(name):
+    executors.configure(name)
+    budget = executors.Budget(10)
+    granted = []
+    assert budget.acquire(6) == 6
+
+    pool = executors.pool(2)
+    pool.spawn(lambda: granted.append(budget.acquire(20)))
+    executors.sleep(0.01)
+    # Later requests queue behind the first, even ones that would fit.
+    pool.spawn(lambda: granted.append(budget.acquire(3)))
+    executors.sleep(0.01)
+    assert granted == []
+
+    budget.release(6)
+    executors.sleep(0.01)
+    assert granted == [10]
+    budget.release(10)
+    pool.join()
+    assert granted == [10, 3]
+    assert budget.available == 7
+
+
+@pytest.mark.usefixtures('backend')
+@pytest.mark.parametrize('name', ['gevent', 'thread'])
+def test_later(name):
+    executors.configure(name)
+    called = []
+    executors.later(0.01, lambda: called.append(1))
+    cancel = executors.later(0.01, lambda: called.append(2))
+    cancel()
+    executors.sleep(0.1)
+    assert called == [1]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import string
+
+import pytest
+
+from s3concat import IncrementalCompactor
+
+
+KB = 1024
+MB = KB**2
+
+
+@pytest.fixture
+def bucket(s3):
+    bucket = 's3concat-test-' + ''.join(
+        random.choice(string.ascii_lowercase) for _ in xrange(12))
+    s3.create_bucket(Bucket=bucket)
+    yield bucket
+    resp = s3.list_objects_v2(Bucket=bucket)
+    if 'Contents' in resp:
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [
+            {'Key': rec['Key']} for rec in resp['Contents']]})
+    s3.delete_bucket(Bucket=bucket)
+
+
+def put(s3, bucket, contents, *items):
+    for key, size in items:
+        contents.append(chr(ord('a') + len(contents)) * size)
+        s3.put_object(Bucket=bucket, Key=key, Body=contents[-1])
+
+
+def read(s3, bucket, key):
+    return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+@pytest.mark.parametrize('state', ['local', 's3'])
+def test_incremental(s3, bucket, tmpdir, state):
+    if state == 'local':
+        state = str(tmpdir.join('state.json'))
+    else:
+        state = 's3://{}/stream/_state.json'.format(bucket)
+    compactor = IncrementalCompactor(
+        's3://{}/stream/all'.format(bucket),
+        's3://{}/stream/'.format(bucket), state)
+    contents = []
+    put(s3, bucket, contents, ('stream/0', 6 * MB), ('stream/1', KB))
+
+    increment = compactor.run()
+    assert [key for key, _ in increment.keys] == ['stream/0', 'stream/1']
+    assert increment.size == 6 * MB + KB
+    assert read(s3, bucket, 'stream/all') == ''.join(contents)
+
+    assert compactor.run().keys == []
+
+    put(s3, bucket, contents, ('stream/2', 2 * KB), ('stream/3', 3 * KB))
+    increment = compactor.run()
+    assert [key for key, _ in increment.keys] == ['stream/2', 'stream/3']
+    assert increment.report.operations['list_objects_v2'].count == 1
+    assert read(s3, bucket, 'stream/all') == ''.join(contents)
+
+
+def test_crash_after_append(s3, bucket, tmpdir, monkeypatch):
+    state = str(tmpdir.join('state.json'))
+    compactor = IncrementalCompactor(
+        's3://{}/out'.format(bucket), 's3://{}/in/'.format(bucket), state)
+    contents = []
+    put(s3, bucket, contents, ('in/0', KB), ('in/1', KB))
+
+    save = compactor._save
+
+    def crash(s3, state):
+        if state['pending'] is None:
+            raise RuntimeError('crash')
+        save(s3, state)
+
+    monkeypatch.setattr(compactor, '_save', crash)
+    with pytest.raises(RuntimeError):
+        compactor.run()
+    monkeypatch.undo()
+    with open(state) as f:
+        # Only the pending batch made it to the state.
+        assert json.load(f)['pending'] is not None
+
+    # The batch is committed without appending it again.
+    put(s3, bucket, contents, ('in/2', KB))
+    increment = compactor.run()
+    assert [key for key, _ in increment.keys] == ['in/2']
+    assert read(s3, bucket, 'out') == ''.join(contents)
+
+
+def test_crash_before_append(s3, bucket, tmpdir, monkeypatch):
+    from s3concat import incremental
+    state = str(tmpdir.join('state.json'))
+    compactor = IncrementalCompactor(
+        's3://{}/out'.format(bucket), 's3://{}/in/'.format(bucket), state)
+    contents = []
+    put(s3, bucket, contents, ('in/0', KB), ('in/1', KB))
+
+    def crash(*args):
+        raise RuntimeError('crash')
+
+    monkeypatch.setattr(incremental, '_run', crash)
+    with pytest.raises(RuntimeError):
+        compactor.run()
+    monkeypatch.undo()
+
+    increment = compactor.run()
+    assert [key for key, _ in increment.keys] == ['in/0', 'in/1']
+    assert read(s3, bucket, 'out') == ''.join(contents)
+
+
+def test_state_of_other_job(s3, bucket, tmpdir):
+    state = str(tmpdir.join('state.json'))
+    s3.put_object(Bucket=bucket, Key='in/0', Body='x')
+    IncrementalCompactor('s3://{}/a'.format(bucket),
+                         's3://{}/in/'.format(bucket), state).run()
+    with pytest.raises(ValueError):
+        IncrementalCompactor('s3://{}/b'.format(bucket),
+                             's3://{}/in/'.format(bucket), state).run()
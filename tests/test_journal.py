@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from s3concat.journal import Journal
+
+
+def test_replay(tmpdir):
+    path = str(tmpdir.join('journal'))
+    journal = Journal(path)
+    journal.start_job('s3://b/t', [('s3://b/s', 10, '"e"')], False)
+    journal.add_temp('s3://b/t.s3concat-x-0')
+    journal.start_upload('b', 't.s3concat-x-0', 'u1', 2)
+    journal.record_part('u1', 1, '"p1"')
+    journal.complete_upload('b', 't.s3concat-x-0', 10)
+    journal.start_upload('b', 't', 'u2', 3)
+    journal.close()
+
+    journal = Journal(path)
+    assert journal.job['target'] == 's3://b/t'
+    assert journal.job['sources'] == [['s3://b/s', 10, '"e"']]
+    assert journal.temps == ['s3://b/t.s3concat-x-0']
+    assert journal.completed == {('b', 't.s3concat-x-0'): 10}
+    assert journal.uploads == {('b', 't'): ('u2', 3)}
+    journal.close(remove=True)
+    assert not tmpdir.join('journal').check()
+
+
+def test_truncated_tail(tmpdir):
+    path = str(tmpdir.join('journal'))
+    journal = Journal(path)
+    journal.start_job('s3://b/t', [], True)
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"type": "upload", "bu')
+
+    journal = Journal(path)
+    assert journal.job['remove_orig'] is True
+    assert not journal.uploads
+    journal.start_upload('b', 't', 'u', 1)
+    journal.close()
+
+    assert Journal(path).uploads == {('b', 't'): ('u', 1)}
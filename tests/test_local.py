@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import mmap
+
+import pytest
+
+from s3concat.local import MappedRange
+from s3concat.local import read_into
+
+
+@pytest.fixture
+def path(tmpdir):
+    f = tmpdir.join('data')
+    f.write(''.join(chr(i % 251) for i in xrange(
+        3 * mmap.ALLOCATIONGRANULARITY)), 'wb')
+    return str(f)
+
+
+def test_mapped_range(path):
+    data = open(path, 'rb').read()
+    start = mmap.ALLOCATIONGRANULARITY + 7
+    body = MappedRange(path, start, start + 99)
+    assert len(body) == 100
+    assert body.read(10) == data[start:start + 10]
+    assert body.tell() == 10
+    assert body.read() == data[start + 10:start + 100]
+    assert body.read(1) == ''
+    body.seek(0)
+    assert body.read() == data[start:start + 100]
+    body.seek(-5, 2)
+    assert body.read() == data[start + 95:start + 100]
+    body.close()
+
+
+def test_read_into(path):
+    data = open(path, 'rb').read()
+    buf = bytearray(20)
+    read_into(path, 5, memoryview(buf)[10:])
+    assert str(buf[10:]) == data[5:15]
+    with pytest.raises(IOError):
+        read_into(path, len(data) - 1, memoryview(buf))
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import string
+import threading
+import time
+
+import pytest
+
+from s3concat import executors
+from s3concat.cli import main
+from s3concat.many import _SharedClient
+
+
+KB = 1024
+MB = KB**2
+
+
+class SlowClient(object):
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+        self.in_flight = self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _call(self, name, kwargs):
+        with self._lock:
+            self.calls.append((name, kwargs.get('Key')))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self._lock:
+            self.in_flight -= 1
+        if self.error is not None:
+            raise self.error
+        return {'Key': kwargs.get('Key')}
+
+    def head_object(self, **kwargs):
+        return self._call('head_object', kwargs)
+
+    def get_object(self, **kwargs):
+        return self._call('get_object', kwargs)
+
+
+@pytest.fixture
+def threads():
+    backend = executors.get_backend()
+    executors.configure('thread')
+    yield
+    executors.configure(backend)
+
+
+def test_shared_client_limits_requests(threads):
+    client = SlowClient()
+    shared = _SharedClient(client, 3)
+    executors.pool(10).map(
+        lambda i: shared.get_object(Bucket='b', Key=str(i)), range(10))
+    assert len(client.calls) == 10
+    assert client.max_in_flight == 3
+
+
+@pytest.mark.parametrize('error', [None, ValueError('boom')])
+def test_shared_client_single_flight_head(threads, error):
+    client = SlowClient(error)
+    shared = _SharedClient(client, 10)
+
+    def head(key):
+        try:
+            return shared.head_object(Bucket='b', Key=key)
+        except ValueError as exc:
+            return exc
+
+    results = executors.pool(6).map(head, ['x'] * 5 + ['y'])
+    assert sorted(client.calls) == [('head_object', 'x'),
+                                    ('head_object', 'y')]
+    if error is None:
+        assert [r['Key'] for r in results] == ['x'] * 5 + ['y']
+    else:
+        assert all(r is error for r in results)
+
+
+def test_shared_client_remembers_heads(threads):
+    from botocore.exceptions import ClientError
+
+    class Client(SlowClient):
+
+        def head_object(self, **kwargs):
+            if kwargs['Key'] == 'missing':
+                self.calls.append(('head_object', 'missing'))
+                raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            return SlowClient.head_object(self, **kwargs)
+
+        def put_object(self, **kwargs):
+            return self._call('put_object', kwargs)
+
+    client = Client()
+    shared = _SharedClient(client, 10)
+    for key in ('x', 'x', 'missing', 'missing'):
+        try:
+            shared.head_object(Bucket='b', Key=key)
+        except ClientError:
+            pass
+    assert client.calls == [('head_object', 'x'), ('head_object', 'missing')]
+
+    # Written through the proxy, the object is looked up again.
+    shared.put_object(Bucket='b', Key='x', Body='')
+    assert shared.head_object(Bucket='b', Key='x') == {'Key': 'x'}
+    assert client.calls[-2:] == [('put_object', 'x'), ('head_object', 'x')]
+
+
+@pytest.fixture
+def bucket(s3):
+    bucket = 's3concat-test-' + ''.join(
+        random.choice(string.ascii_lowercase) for _ in xrange(12))
+    s3.create_bucket(Bucket=bucket)
+    yield bucket
+    resp = s3.list_objects_v2(Bucket=bucket)
+    if 'Contents' in resp:
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [
+            {'Key': rec['Key']} for rec in resp['Contents']]})
+    s3.delete_bucket(Bucket=bucket)
+
+
+def put(s3, bucket, key, body):
+    s3.put_object(Bucket=bucket, Key=key, Body=body)
+    return 's3://{}/{}'.format(bucket, key)
+
+
+def get(s3, bucket, key):
+    return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def test_s3concat_many(s3, bucket, tmpdir):
+    from s3concat import s3concat_many
+    head = 'h' * (5 * MB)
+    small = [chr(ord('a') + i) * (2 * MB) for i in xrange(4)]
+    shared = put(s3, bucket, 'shared', 's' * MB)
+    srcs = [put(s3, bucket, 'src/{}'.format(i), body)
+            for i, body in enumerate(small)]
+    local = tmpdir.join('local')
+    local.write('l' * KB)
+    jobs = [
+        (put(s3, bucket, 'out/0', head), srcs[:2] + [shared]),
+        {'target': str(local), 'sources': [shared]},
+        {'target': put(s3, bucket, 'out/2', head),
+         'sources': srcs[2:] + [shared], 'remove_orig': True},
+    ]
+
+    # Packed parts wait for each other to fit in the memory budget.
+    results = s3concat_many(jobs, concurrency=4, job_concurrency=2,
+                            max_memory=5 * MB)
+
+    assert [r.target for r in results] == [
+        's3://{}/out/0'.format(bucket), str(local),
+        's3://{}/out/2'.format(bucket)]
+    assert results[0].error is None and results[2].error is None
+    assert isinstance(results[1].error, ValueError)
+    assert results[0].report.bytes_uploaded == 5 * MB
+    assert get(s3, bucket, 'out/0') == head + small[0] + small[1] + 's' * MB
+    assert get(s3, bucket, 'out/2') == head + small[2] + small[3] + 's' * MB
+    listed = sorted(rec['Key'] for rec in s3.list_objects_v2(
+        Bucket=bucket)['Contents'])
+    assert listed == ['out/0', 'out/2', 'src/0', 'src/1']
+
+
+def test_cli(s3, bucket, tmpdir, capsys, threads):
+    target = put(s3, bucket, 'out', 'a')
+    source = put(s3, bucket, 'in', 'b')
+    assert main([target, source, '--remove-orig']) == 0
+    assert get(s3, bucket, 'out') == 'ab'
+    assert capsys.readouterr()[0].startswith(target + ' ok (')
+
+    manifest = tmpdir.join('jobs.jsonl')
+    manifest.write('\n'.join(json.dumps(job) for job in [
+        {'target': target, 'sources': [put(s3, bucket, 'in', 'c')]},
+        {'target': str(tmpdir.join('local')), 'sources': [target]},
+    ]) + '\n')
+    assert main(['-m', str(manifest), '--json']) == 1
+    lines = [json.loads(line)
+             for line in capsys.readouterr()[0].splitlines()]
+    assert [line['target'] for line in lines] == [
+        target, str(tmpdir.join('local'))]
+    assert lines[0]['error'] is None and lines[0]['requests'] > 0
+    assert 'local file' in lines[1]['error']
+    assert get(s3, bucket, 'out') == 'abc'
+
+    manifest.write('{"target": "s3://b/k"}\n')
+    with pytest.raises(SystemExit):
+        main(['-m', str(manifest)])
+
+
+def test_cli_backend(s3, bucket, threads):
+    target = put(s3, bucket, 'out', 'a')
+    source = put(s3, bucket, 'in', 'b')
+    executors.configure('gevent')
+    assert main([target, source]) == 0
+    assert executors.get_backend().name == 'thread'
+    assert main([target, source, '--backend', 'gevent']) == 0
+    assert executors.get_backend().name == 'gevent'
+    assert get(s3, bucket, 'out') == 'abb'
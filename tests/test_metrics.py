@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from botocore.exceptions import ClientError
+
+from s3concat import metrics
+from s3concat.metrics import Hook
+from s3concat.metrics import Recorder
+from s3concat.scheduler import Scheduler
+from s3concat.scheduler import scheduled
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class Collect(Hook):
+
+    def __init__(self):
+        self.events = []
+        self.reports = []
+
+    def request(self, event):
+        self.events.append(event)
+
+    def finish(self, report):
+        self.reports.append(report)
+
+
+class Client(object):
+
+    def __init__(self):
+        self.throttles = 1
+
+    def get_object(self, **kwargs):
+        return {'ContentLength': 3}
+
+    def upload_part(self, **kwargs):
+        if self.throttles:
+            self.throttles -= 1
+            raise ClientError({'Error': {'Code': 'SlowDown'}},
+                              'UploadPart')
+        return {'ETag': '"e"'}
+
+    def upload_part_copy(self, **kwargs):
+        return {'CopyPartResult': {'ETag': '"e"'}}
+
+
+def client(recorder):
+    scheduler = Scheduler(sleep=lambda _: None)
+    return scheduled(Client(), scheduler, recorder)
+
+
+def test_report():
+    hook = Collect()
+    with Recorder([hook], clock=Clock()) as recorder:
+        s3 = client(recorder)
+        s3.get_object(Bucket='b', Key='k', Range='bytes=0-2')
+        s3.upload_part(Bucket='b', Key='k', Body='abcd')
+        s3.upload_part_copy(Bucket='b', Key='k',
+                            CopySourceRange='bytes=10-19')
+
+    report = recorder.report
+    assert hook.reports == [report]
+    assert report.requests == 4
+    assert report.retries == 1
+    assert report.bytes_downloaded == 3
+    assert report.bytes_uploaded == 4
+    assert report.bytes_copied == 10
+    assert report.max_in_flight == 1
+    assert report.wall_time == 9
+
+    stats = report.operations['upload_part']
+    assert (stats.count, stats.errors, stats.retries) == (2, 1, 1)
+    assert stats.mean_time == 1
+
+    assert [(e.operation, e.attempt, e.bytes) for e in hook.events] == [
+        ('get_object', 1, 3), ('upload_part', 1, 0), ('upload_part', 2, 4),
+        ('upload_part_copy', 1, 10)]
+    assert isinstance(hook.events[1].error, ClientError)
+    assert report.as_dict()['operations']['get_object']['count'] == 1
+
+
+def test_global_hooks(monkeypatch):
+    hook = Collect()
+    monkeypatch.setattr(metrics, 'global_hooks', [hook])
+    with Recorder() as recorder:
+        client(recorder).get_object(Bucket='b', Key='k')
+    assert len(hook.events) == 1
+    assert hook.reports == [recorder.report]
+
+
+def test_failing_hook():
+
+    class Failing(Hook):
+
+        def request(self, event):
+            raise RuntimeError
+
+    with Recorder([Failing()]) as recorder:
+        assert client(recorder).get_object(Bucket='b', Key='k')
+    assert recorder.report.requests == 1
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+from s3concat.planner import MAX_PART_SIZE
+from s3concat.planner import MB
+from s3concat.planner import MIN_PART_SIZE
+from s3concat.planner import StreamPlanner
+from s3concat.planner import estimate
+from s3concat.planner import plan_parts
+from s3concat.planner import split_copy
+
+
+def assert_valid(sizes, parts):
+    covered = []
+    for part in parts:
+        for index, (start, end) in part:
+            if covered and covered[-1][0] == index:
+                assert covered[-1][2] + 1 == start
+                covered[-1][2] = end
+            else:
+                covered.append([index, start, end])
+    assert covered == [[i, 0, size - 1]
+                       for i, size in enumerate(sizes) if size]
+
+    for part in parts[:-1]:
+        size = sum(end - start + 1 for _, (start, end) in part)
+        assert MIN_PART_SIZE <= size <= MAX_PART_SIZE
+
+
+@pytest.mark.parametrize('sizes', [
+    [],
+    [0, 0],
+    [1],
+    [MB, 0, 2 * MB],
+    [3 * MB, 5 * MB, 1024],
+    [20 * MB, MB, 8 * MB],
+    [MB, 12 * MB, MB, MB, 30 * MB, 4 * MB],
+])
+def test_plan_is_valid(sizes):
+    assert_valid(sizes, plan_parts(sizes))
+
+
+def test_plan_random_sizes():
+    rand = random.Random(0)
+    for _ in xrange(500):
+        sizes = [rand.choice([0, rand.randint(1, 3 * MB),
+                              rand.randint(1, 12 * MB),
+                              rand.randint(5 * MB, 30 * MB)])
+                 for _ in xrange(rand.randint(1, 10))]
+        assert_valid(sizes, plan_parts(sizes, copy_part_size=8 * MB))
+
+
+def test_small_source_borrows_from_previous_tail():
+    # Greedy packing would download 1 MB + 4 MB of the 8 MB object, then
+    # its remaining 4 MB; borrowing the 20 MB object's tail lets the
+    # 8 MB object be copied whole.
+    parts = plan_parts([20 * MB, MB, 8 * MB])
+    assert parts == [
+        [(0, (0, 16 * MB - 1))],
+        [(0, (16 * MB, 20 * MB - 1)), (1, (0, MB - 1))],
+        [(2, (0, 8 * MB - 1))]]
+    assert estimate(parts).bytes_downloaded == 5 * MB
+
+
+def test_small_trailing_sources_are_copied():
+    parts = plan_parts([10 * MB, 1024])
+    assert parts == [[(0, (0, 10 * MB - 1))], [(1, (0, 1023))]]
+    assert estimate(parts).gets == 0
+
+
+def test_large_source_is_split():
+    parts = plan_parts([25 * MB], copy_part_size=10 * MB)
+    assert parts == [[(0, (0, 25 * MB // 3))],
+                     [(0, (25 * MB // 3 + 1, 50 * MB // 3))],
+                     [(0, (50 * MB // 3 + 1, 25 * MB - 1))]]
+
+
+def test_estimate():
+    parts = plan_parts([MB, MB, 6 * MB, 7 * MB])
+    est = estimate(parts)
+    assert est.parts == len(parts)
+    assert est.copies + est.puts == est.parts
+    assert est.bytes_downloaded == est.bytes_uploaded
+    assert est.bytes_downloaded + est.bytes_copied == 15 * MB
+
+
+def test_copy_part_size_grows_to_fit_part_limit(monkeypatch):
+    from s3concat import planner
+    monkeypatch.setattr(planner, 'MAX_PARTS', 4)
+    parts = plan_parts([100 * MB], copy_part_size=10 * MB)
+    assert len(parts) <= 4
+    assert_valid([100 * MB], parts)
+
+
+def test_split_copy_grows_to_fit_max_parts():
+    assert len(split_copy(0, 100 * MB - 1, 10 * MB)) == 10
+    ranges = split_copy(0, 100 * MB - 1, 10 * MB, max_parts=4)
+    assert len(ranges) == 3
+    assert ranges[0][0] == 0 and ranges[-1][1] == 100 * MB - 1
+    with pytest.raises(ValueError):
+        split_copy(0, 3 * MAX_PART_SIZE - 1, 10 * MB, max_parts=2)
+
+
+@pytest.mark.parametrize('copy_part_size', [MB, 6 * 1024 * MB])
+def test_invalid_copy_part_size(copy_part_size):
+    with pytest.raises(ValueError):
+        plan_parts([10 * MB], copy_part_size=copy_part_size)
+
+
+def test_stream_settles_parts_early():
+    stream = StreamPlanner()
+    settled = []
+    for index in xrange(100):
+        settled.append(len(stream.add(index, 6 * MB)))
+    assert sum(settled[:40]) > 0
+    assert sum(settled) + len(stream.finish()) == 100
+
+
+@pytest.mark.parametrize('window', [1, 3, None])
+def test_stream_plan_is_valid(monkeypatch, window):
+    monkeypatch.setattr(StreamPlanner, 'CHECK_INTERVAL', 1)
+    rand = random.Random(window)
+    for _ in xrange(200):
+        sizes = [rand.choice([0, rand.randint(1, 3 * MB),
+                              rand.randint(1, 12 * MB),
+                              rand.randint(5 * MB, 30 * MB)])
+                 for _ in xrange(rand.randint(1, 30))]
+        stream = StreamPlanner(copy_part_size=8 * MB, window=window)
+        parts = []
+        for index, size in enumerate(sizes):
+            parts.extend(stream.add(index, size))
+        parts.extend(stream.finish())
+        assert_valid(sizes, parts)
+        if window is None:
+            assert parts == plan_parts(sizes, copy_part_size=8 * MB)
+
+
+def test_stream_part_size_per_source():
+    stream = StreamPlanner(copy_part_size=32 * MB)
+    sizes = [40 * MB, 40 * MB]
+    parts = stream.add(0, sizes[0]) + stream.add(1, sizes[1], 10 * MB)
+    parts += stream.finish()
+    assert_valid(sizes, parts)
+    assert [len([p for p in parts if p[0][0] == i]) for i in (0, 1)] == [
+        2, 4]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import random
+import string
+
+import pytest
+
+from s3concat import regions
+from s3concat import resources
+from s3concat.regions import COPY
+from s3concat.regions import TRANSFER
+from s3concat.regions import BucketRegions
+from s3concat.regions import RegionRouter
+from s3concat.regions import Throughput
+
+
+KB = 1024
+MB = KB**2
+
+
+def test_throughput_choice():
+    throughput = Throughput(explore=4)
+    assert throughput.choose('us-east-1', 'us-east-1') == COPY
+    assert throughput.choose(None, 'us-east-1') == COPY
+    # Copies until transfers are measured, trying one now and then.
+    assert [throughput.choose('eu-west-1', 'us-east-1')
+            for _ in xrange(4)] == [COPY] * 3 + [TRANSFER]
+
+    throughput.record(COPY, 'eu-west-1', 'us-east-1', 10 * MB, 1)
+    throughput.record(TRANSFER, 'eu-west-1', 'us-east-1', 10 * MB, 2)
+    assert throughput.rate(COPY, 'eu-west-1', 'us-east-1') == 10 * MB
+    assert [throughput.choose('eu-west-1', 'us-east-1')
+            for _ in xrange(4)] == [COPY] * 3 + [TRANSFER]
+
+    throughput.record(TRANSFER, 'eu-west-1', 'us-east-1', 100 * MB, 1)
+    assert throughput.choose('eu-west-1', 'us-east-1') == TRANSFER
+    throughput.record(COPY, 'us-east-1', 'us-east-1', MB, 1)
+    assert throughput.rate(COPY, 'us-east-1', 'us-east-1') is None
+
+
+@pytest.fixture
+def buckets(s3):
+    name = 's3concat-test-' + ''.join(
+        random.choice(string.ascii_lowercase) for _ in xrange(12))
+    created = {'us-east-1': name + '-us', 'eu-west-1': name + '-eu'}
+    s3.create_bucket(Bucket=created['us-east-1'])
+    s3.create_bucket(Bucket=created['eu-west-1'], CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-1'})
+    yield created
+    for bucket in created.itervalues():
+        resp = s3.list_objects_v2(Bucket=bucket)
+        if 'Contents' in resp:
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': [
+                {'Key': rec['Key']} for rec in resp['Contents']]})
+        s3.delete_bucket(Bucket=bucket)
+
+
+def test_bucket_regions(buckets):
+    cache = BucketRegions()
+    for region, bucket in buckets.iteritems():
+        assert cache.cached(bucket) is None
+        assert cache.get(bucket) == region
+        assert cache.cached(bucket) == region
+    assert cache.get('s3concat-test-missing') is None
+
+
+def test_router(buckets):
+    cache = BucketRegions()
+    router = RegionRouter(regions=cache)
+    router.put_object(Bucket=buckets['eu-west-1'], Key='k', Body='eu')
+    assert router.client(buckets['eu-west-1']).meta.region_name == (
+        'eu-west-1')
+    assert router.client(buckets['us-east-1']) is resources.get_client()
+    assert router.get_object(
+        Bucket=buckets['eu-west-1'], Key='k')['Body'].read() == 'eu'
+
+
+@pytest.mark.parametrize('method', [COPY, TRANSFER])
+def test_s3concat_across_regions(monkeypatch, buckets, s3, method):
+    from s3concat import s3concat
+    throughput = Throughput(explore=0)
+    other = COPY if method == TRANSFER else TRANSFER
+    throughput.record(method, 'eu-west-1', 'us-east-1', 2 * MB, 1)
+    throughput.record(other, 'eu-west-1', 'us-east-1', MB, 1)
+    monkeypatch.setattr(regions, 'throughput', throughput)
+    monkeypatch.setattr('s3concat.planner.TRANSFER_PART_SIZE', 8 * MB)
+
+    target, source = buckets['us-east-1'], buckets['eu-west-1']
+    s3.put_object(Bucket=target, Key='out', Body='a' * (5 * MB))
+    s3.put_object(Bucket=source, Key='in', Body='b' * (20 * MB))
+    report = s3concat(['s3://{}/out'.format(target),
+                       's3://{}/in'.format(source)], transfer_remote=True)
+
+    body = s3.get_object(Bucket=target, Key='out')['Body'].read()
+    assert body == 'a' * (5 * MB) + 'b' * (20 * MB)
+    if method == TRANSFER:
+        assert report.operations['upload_part'].count == 3
+        assert report.operations['upload_part_copy'].count == 1
+        assert report.bytes_downloaded == 20 * MB
+        assert throughput.rate(TRANSFER, 'eu-west-1', 'us-east-1') != MB
+    else:
+        assert 'upload_part' not in report.operations
+        assert report.operations['upload_part_copy'].count == 2
+
+
+def test_s3concat_copies_across_regions_by_default(monkeypatch, buckets, s3):
+    from s3concat import s3concat
+    throughput = Throughput(explore=0)
+    throughput.record(TRANSFER, 'eu-west-1', 'us-east-1', 2 * MB, 1)
+    monkeypatch.setattr(regions, 'throughput', throughput)
+
+    target, source = buckets['us-east-1'], buckets['eu-west-1']
+    s3.put_object(Bucket=target, Key='out', Body='a' * (5 * MB))
+    s3.put_object(Bucket=source, Key='in', Body='b' * (5 * MB))
+    report = s3concat(['s3://{}/out'.format(target),
+                       's3://{}/in'.format(source)])
+
+    assert 'upload_part' not in report.operations
+    assert report.operations['upload_part_copy'].count == 2
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from s3concat import resources
+
+
+@pytest.fixture
+def reset_client(monkeypatch):
+    for name in ('_session', '_client_kwargs', '_client', '_pool_size'):
+        monkeypatch.setattr(resources, name, getattr(resources, name))
+    monkeypatch.setattr(resources, '_region_clients', {})
+    resources.configure()
+
+
+def pool_size(client):
+    return client.meta.config.max_pool_connections
+
+
+@pytest.mark.usefixtures('reset_client')
+class TestClient(object):
+
+    def test_lazy_and_shared(self):
+        assert resources._client is None
+        client = resources.get_client()
+        assert resources.get_client() is client
+        assert pool_size(client) == resources.DEFAULT_POOL_SIZE
+
+    def test_pool_grows(self):
+        client = resources.get_client(max_pool_connections=4)
+        assert pool_size(client) == resources.DEFAULT_POOL_SIZE
+        assert resources.get_client(max_pool_connections=5) is client
+
+        bigger = resources.get_client(max_pool_connections=64)
+        assert pool_size(bigger) == 64
+        assert resources.get_client() is bigger
+
+    def test_configure(self):
+        from botocore.config import Config
+        resources.configure(region_name='eu-west-1',
+                            config=Config(connect_timeout=3))
+        client = resources.get_client(max_pool_connections=32)
+        assert client.meta.region_name == 'eu-west-1'
+        assert client.meta.config.connect_timeout == 3
+        assert pool_size(client) == 32
+
+    def test_set_client(self):
+        client = object()
+        resources.set_client(client)
+        assert resources.get_client(max_pool_connections=1000) is client
+
+    def test_retries_left_to_scheduler(self):
+        from botocore.config import Config
+        retries = resources.get_client().meta.config.retries
+        assert retries['total_max_attempts'] == 1
+
+        resources.configure(config=Config(retries={'max_attempts': 3}))
+        retries = resources.get_client().meta.config.retries
+        assert retries['total_max_attempts'] == 4
+
+    def test_region_clients(self):
+        client = resources.get_client()
+        region = client.meta.region_name
+        assert resources.get_client(region=region) is client
+
+        other = 'ap-northeast-1' if region != 'ap-northeast-1' else 'us-west-2'
+        remote = resources.get_client(region=other)
+        assert remote.meta.region_name == other
+        assert resources.get_client(region=other) is remote
+        bigger = resources.get_client(max_pool_connections=64, region=other)
+        assert pool_size(bigger) == 64
+        assert resources.get_client() is client
+
+        resources.set_client(object())
+        assert resources.get_client(region=other) is resources._client
+
+    def test_concurrent_first_use(self, monkeypatch):
+        created = []
+        create = resources._create_client
+        started = threading.Event()
+
+        def slow_create(*args, **kwargs):
+            created.append(args)
+            started.wait(1)
+            return create(*args, **kwargs)
+
+        monkeypatch.setattr(resources, '_create_client', slow_create)
+        clients = []
+        threads = [threading.Thread(
+            target=lambda: clients.append(resources.get_client()))
+            for _ in xrange(8)]
+        for t in threads:
+            t.start()
+        started.set()
+        for t in threads:
+            t.join()
+        assert len(created) == 1
+        assert all(c is clients[0] for c in clients)
@@ -4,6 +4,7 @@ import logging
 import random
 import string
 from collections import defaultdict
+from StringIO import StringIO
 
 import pytest
 
@@ -31,11 +32,42 @@ def generate_file(size):
                    for i in xrange(size - 1)) + '\n'
 
 
+def split(content, size):
+    for i in xrange(0, len(content), size):
+        yield content[i:i + size]
+
+
 @pytest.mark.parametrize('size', [100, 1024, 1024**2 + 3])
 def test_generate_file(size):
     assert size == len(generate_file(size))
 
 
+class CompositeETagClient(object):
+    """Client giving multipart objects the ETags S3 does, which moto does
+    not, and a wrong ETag in the response to the `tamper` method."""
+
+    def __init__(self, s3, tamper=None):
+        self.s3 = s3
+        self.tamper = tamper
+
+    def __getattr__(self, name):
+        method = getattr(self.s3, name)
+
+        def call(**kwargs):
+            resp = method(**kwargs)
+            if name == 'complete_multipart_upload':
+                etags = [part['ETag'].strip('"') for part in
+                         kwargs['MultipartUpload']['Parts']]
+                resp['ETag'] = '"{}-{}"'.format(hashlib.md5(''.join(
+                    etag.decode('hex') for etag in etags)).hexdigest(),
+                    len(etags))
+            if name == self.tamper:
+                resp.get('CopyPartResult', resp)['ETag'] = '"{}"'.format(
+                    '0' * 32)
+            return resp
+        return call
+
+
 class TestS3URL(object):
 
     def test_invalid_s3_url(self):
@@ -43,6 +75,45 @@ class TestS3URL(object):
         with pytest.raises(ValueError):
             S3URL('http://boo')
 
+    @pytest.mark.parametrize('url, is_prefix, is_pattern, prefix', [
+        ('s3://b/k', False, False, 'k'),
+        ('s3://b/', True, True, ''),
+        ('s3://b/dir/', True, True, 'dir/'),
+        ('s3://b/dir/*.log', False, True, 'dir/'),
+        ('s3://b/dir/[0-9]', False, True, 'dir/'),
+    ])
+    def test_pattern(self, url, is_prefix, is_pattern, prefix):
+        from s3concat.urls import S3URL
+        s3url = S3URL(url)
+        assert s3url.is_prefix is is_prefix
+        assert s3url.is_pattern is is_pattern
+        assert s3url.prefix == prefix
+
+    def test_make_url(self):
+        import os
+        from s3concat.urls import LocalURL
+        from s3concat.urls import S3URL
+        from s3concat.urls import make_url
+        assert isinstance(make_url('s3://b/k'), S3URL)
+        local = make_url('file:///tmp/x')
+        assert isinstance(local, LocalURL)
+        assert (local.bucket, local.path) == (None, '/tmp/x')
+        assert make_url('x').path == os.path.abspath('x')
+        assert str(make_url(str(local))) == 'file:///tmp/x'
+        with pytest.raises(ValueError):
+            make_url('http://boo')
+
+    def test_key_with_query_chars(self):
+        from s3concat.urls import S3URL
+        assert S3URL('s3://b/x?y#z').key == 'x?y#z'
+
+    def test_match(self):
+        from s3concat.urls import S3URL
+        assert S3URL('s3://b/dir/').match('dir/sub/x')
+        assert not S3URL('s3://b/dir/').match('dirx')
+        assert S3URL('s3://b/dir/*.log').match('dir/x.log')
+        assert not S3URL('s3://b/dir/*.log').match('dir/x.txt')
+
 
 @pytest.fixture(scope='class')
 def buckets(request, s3):
@@ -104,11 +175,204 @@ class TestS3ConcatContent(object):
         # concat to an existing key adds to the object
         diff = generate_file(size_diff)
         h = md5(content + diff)
-        s3concat_content(bucket, key, diff)
+        s3concat_content(bucket, key, diff, copy_part_size=5 * MB)
         resp = self.s3.get_object(Bucket=bucket, Key=key)
         downloaded = resp['Body'].read()
         assert h == md5(downloaded)
 
+    @pytest.mark.parametrize('wrap', [str, StringIO])
+    def test_s3concat_content_after_other_writer(self, wrap):
+        from s3concat import s3concat_content
+        bucket = self.buckets[0]
+        key = 'shared'
+        content = generate_file(6 * MB)
+        s3concat_content(bucket, key, content)
+
+        # Appended by another writer, unknown to the metadata cache.
+        other = 'x' * 100
+        self.s3.put_object(Bucket=bucket, Key=key, Body=content + other)
+        diff = generate_file(KB)
+        s3concat_content(bucket, key, wrap(diff))
+
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content + other + diff) == md5(resp['Body'].read())
+        self.s3.delete_object(Bucket=bucket, Key=key)
+
+    def test_s3concat_content_part_limit(self, monkeypatch):
+        from s3concat import planner
+        from s3concat import s3concat_content
+        monkeypatch.setattr(planner, 'MAX_PARTS', 4)
+        copies = []
+        upload_part_copy = self.s3.upload_part_copy
+        monkeypatch.setattr(self.s3, 'upload_part_copy', lambda **kwargs: (
+            copies.append(kwargs), upload_part_copy(**kwargs))[1])
+        bucket = self.buckets[0]
+        key = 'limited'
+        content = generate_file(30 * MB)
+        self.s3.put_object(Bucket=bucket, Key=key, Body=content)
+
+        # Two parts of content leave two for the 30 MB copied.
+        diff = generate_file(6 * MB)
+        s3concat_content(bucket, key, diff, client=self.s3,
+                         copy_part_size=5 * MB)
+        assert len(copies) == 2
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content + diff) == md5(resp['Body'].read())
+
+    @pytest.mark.parametrize('wrap', ['file', 'chunks'])
+    @pytest.mark.parametrize('size_source, size_diff', [
+        (0, 5 * MB + KB),
+        (KB, 11 * MB),
+        (5 * MB + KB, 3 * KB)])
+    def test_s3concat_content_stream(self, wrap, size_source, size_diff):
+        from s3concat import s3concat_content
+        bucket = self.buckets[0]
+        key = 'streamed'
+        content = generate_file(size_source) if size_source else ''
+        if content:
+            self.s3.put_object(Bucket=bucket, Key=key, Body=content)
+
+        diff = generate_file(size_diff)
+        if wrap == 'file':
+            stream = StringIO(diff)
+        else:
+            stream = split(diff, 100 * KB + 1)
+        s3concat_content(bucket, key, stream)
+
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content + diff) == md5(resp['Body'].read())
+
+    @pytest.mark.parametrize('sizes', [
+        (KB, 0, KB),
+        (7 * MB, KB),
+        (KB, 7 * MB + KB)])
+    def test_s3concat_content_compressed(self, sizes):
+        import gzip
+        import os
+        from s3concat import s3concat_content
+        bucket = self.buckets[0]
+        key = 'compressed.gz'
+        appended = ''
+        for size in sizes:
+            # Random bytes do not compress, so the object grows past the
+            # size of a part.
+            content = os.urandom(size)
+            appended += content
+            s3concat_content(bucket, key, StringIO(content),
+                             compress=True if size > KB else 1)
+
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        downloaded = gzip.GzipFile(
+            fileobj=StringIO(resp['Body'].read())).read()
+        assert md5(downloaded) == md5(appended)
+
+    def test_s3concat_content_compression_level(self):
+        from s3concat import s3concat_content
+        with pytest.raises(ValueError):
+            s3concat_content(self.buckets[0], 'k', 'a', compress=10)
+
+
+@pytest.mark.usefixtures('setup_s3concat_content')
+class TestS3Appender(object):
+
+    @pytest.mark.parametrize('size_source', [0, KB, 5 * MB + KB])
+    def test_append(self, size_source):
+        from s3concat import S3Appender
+        bucket = self.buckets[0]
+        key = 'appended'
+        content = generate_file(size_source) if size_source else ''
+        if content:
+            self.s3.put_object(Bucket=bucket, Key=key, Body=content)
+
+        chunks = list(split(generate_file(6 * MB), 50 * KB))
+        with S3Appender(bucket, key) as appender:
+            for chunk in chunks:
+                appender.write(chunk)
+
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content + ''.join(chunks)) == md5(resp['Body'].read())
+
+    def test_flush_size(self):
+        from s3concat import S3Appender
+        bucket = self.buckets[0]
+        key = 'appended'
+        appender = S3Appender(bucket, key, flush_size=10 * KB)
+
+        appender.write('a' * (5 * KB))
+        assert self.get_object(bucket, key) is None
+        appender.write('b' * (5 * KB))
+        assert self.get_object(bucket, key) == 'a' * (5 * KB) + 'b' * (5 * KB)
+
+        appender.write('c')
+        appender.close()
+        assert self.get_object(bucket, key).endswith('bc')
+
+        with pytest.raises(ValueError):
+            appender.write('d')
+
+    def test_flush_interval(self):
+        from s3concat import S3Appender
+        bucket = self.buckets[0]
+        key = 'appended'
+        now = [0]
+        appender = S3Appender(bucket, key, flush_interval=60,
+                              clock=lambda: now[0])
+
+        appender.write('a')
+        now[0] = 59
+        assert not appender.poll()
+        assert self.get_object(bucket, key) is None
+        now[0] = 60
+        assert appender.poll()
+        assert self.get_object(bucket, key) == 'a'
+        assert not appender.poll()
+
+        # A write after the interval flushes too.
+        appender.write('b')
+        now[0] = 120
+        appender.write('c')
+        assert self.get_object(bucket, key) == 'abc'
+        appender.close()
+
+    @pytest.mark.parametrize('backend', ['gevent', 'thread'])
+    def test_flush_interval_timer(self, monkeypatch, backend):
+        from s3concat import S3Appender
+        from s3concat import executors
+        monkeypatch.setattr(executors, '_backend',
+                            executors.BACKENDS[backend]())
+        bucket = self.buckets[0]
+        key = 'timed'
+        appender = S3Appender(bucket, key, flush_interval=0.05)
+
+        # Flushed without further writes.
+        appender.write('a')
+        for _ in xrange(100):
+            executors.sleep(0.05)
+            if self.get_object(bucket, key) is not None:
+                break
+        assert self.get_object(bucket, key) == 'a'
+        appender.close()
+        self.s3.delete_object(Bucket=bucket, Key=key)
+
+    def test_abort(self):
+        from s3concat import S3Appender
+        bucket = self.buckets[0]
+        key = 'appended'
+        self.s3.put_object(Bucket=bucket, Key=key, Body='orig')
+
+        with pytest.raises(Exception) as exc:
+            with S3Appender(bucket, key) as appender:
+                appender.write('x' * (6 * MB))
+                raise Exception('Bomb')
+        assert 'Bomb' in exc.value.message
+        assert self.get_object(bucket, key) == 'orig'
+
+    def get_object(self, bucket, key):
+        from s3concat.s3concat import _get_object_info
+        if _get_object_info(bucket, key) is None:
+            return None
+        return self.s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
 
 @pytest.fixture(scope='class')
 def setup_s3concat(request, s3, buckets):
@@ -207,3 +471,415 @@ class TestS3Concat(object):
             with _MultipartUpload(self.buckets[0], 'baa'):
                 raise Exception('Bomb')
         assert 'Bomb' in exc.value.message
+
+    @pytest.mark.parametrize('concurrency', [1, 4])
+    @pytest.mark.parametrize('backend', ['gevent', 'thread'])
+    def test_s3concat_concurrency(self, monkeypatch, concurrency, backend):
+        from s3concat import executors
+        monkeypatch.setattr(executors, '_backend', executors.get_backend())
+        executors.configure(backend)
+        bucket = self.buckets[1]
+        key = 'concurrent-{}-{}'.format(backend, concurrency)
+        self.s3.put_object(Bucket=bucket, Key=key, Body='')
+        urls = ['s3://{}/{}'.format(bucket, key),
+                self.to_url(0, 7 * MB), self.to_url(0, 5 * MB),
+                self.to_url(1, 1 * KB), self.to_url(0, 7 * MB)]
+        objs = self.env['objects']
+        content = (objs[self.buckets[0]][str(7 * MB)] +
+                   objs[self.buckets[0]][str(5 * MB)] +
+                   objs[bucket][str(1 * KB)] +
+                   objs[self.buckets[0]][str(7 * MB)])
+
+        self.s3concat(urls, concurrency=concurrency)
+
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content) == md5(resp['Body'].read())
+
+    def test_abort_on_part_error(self):
+        from botocore.exceptions import ClientError
+        from s3concat.s3concat import _MultipartUpload
+        bucket = self.buckets[0]
+        with pytest.raises(ClientError):
+            with _MultipartUpload(bucket, 'baa', concurrency=2) as mpu:
+                mpu.add_part_copy(
+                    CopySource={'Bucket': bucket, 'Key': str(7 * MB)})
+                mpu.add_part_copy(
+                    CopySource={'Bucket': bucket, 'Key': 'nonexistent'})
+                mpu.start()
+        assert self.get_object_info(bucket, 'baa') is None
+
+    def test_s3concat_empty_objects(self):
+        bucket = self.buckets[1]
+        self.s3.put_object(Bucket=bucket, Key='empty1', Body='')
+        self.s3.put_object(Bucket=bucket, Key='empty2', Body='')
+
+        self.s3concat(['s3://{}/empty0'.format(bucket),
+                       's3://{}/empty1'.format(bucket),
+                       's3://{}/empty2'.format(bucket)])
+
+        assert self.get_object_info(bucket, 'empty0')['ContentLength'] == 0
+
+    def test_fetch_part(self):
+        from s3concat.s3concat import _fetch_part
+        from s3concat.urls import S3URL
+        bucket = self.buckets[1]
+        objs = self.env['objects'][bucket]
+        part = [(S3URL(self.to_url(1, 10 * KB)), (5, 10 * KB - 1)),
+                (S3URL(self.to_url(1, 1 * KB)), (0, 1 * KB - 1)),
+                (S3URL(self.to_url(1, 100 * KB)), (0, 99))]
+
+        buf = _fetch_part(self.s3, part, concurrency=3)
+
+        assert isinstance(buf, bytearray)
+        assert str(buf) == (objs[str(10 * KB)][5:] + objs[str(1 * KB)] +
+                            objs[str(100 * KB)][:100])
+
+    def test_s3concat_plan(self):
+        from s3concat import s3concat_plan
+        urls = [self.to_url(0, 'planned'), self.to_url(0, 3 * MB),
+                self.to_url(0, 7 * MB), self.to_url(1, 1 * KB)]
+
+        plan = s3concat_plan(urls)
+
+        assert str(plan.target) == urls[0]
+        assert [str(o.s3url) for o in plan.sources] == urls[1:]
+        est = plan.estimate
+        assert est.parts == len(plan.parts)
+        assert est.bytes_downloaded + est.bytes_copied == 10 * MB + 1 * KB
+        assert self.get_object_info(self.buckets[0], 'planned') is None
+
+    def test_s3concat_tree_merge(self, monkeypatch):
+        from s3concat import planner
+        monkeypatch.setattr(planner, 'MAX_PARTS', 4)
+        bucket = self.buckets[1]
+        key = 'merged'
+        sizes = [(0, 7 * MB), (0, 5 * MB), (1, 1 * KB), (0, 7 * MB),
+                 (1, 100 * KB), (0, 3 * MB), (0, 7 * MB), (0, 5 * MB),
+                 (0, 7 * MB), (1, 10 * KB)]
+        urls = ['s3://{}/{}'.format(bucket, key)] + [
+            self.to_url(bucket_number, size)
+            for bucket_number, size in sizes]
+        content = ''.join(self.env['objects'][self.buckets[bucket_number]]
+                          [str(size)] for bucket_number, size in sizes)
+
+        self.s3concat(urls, concurrency=3)
+
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content) == md5(resp['Body'].read())
+        resp = self.s3.list_objects_v2(Bucket=bucket)
+        assert not [o for o in resp['Contents'] if 's3concat-' in o['Key']]
+
+    @pytest.mark.parametrize('pattern, keys', [
+        ('globbed/', ['a/1', 'a/2', 'b/1']),
+        ('globbed/a/', ['a/1', 'a/2']),
+        ('globbed/*/1', ['a/1', 'b/1']),
+        ('globbed/[ab]/?', ['a/1', 'a/2', 'b/1']),
+    ])
+    def test_s3concat_pattern(self, pattern, keys):
+        bucket = self.buckets[1]
+        for key in ('a/1', 'a/2', 'b/1'):
+            self.s3.put_object(
+                Bucket=bucket, Key='globbed/' + key, Body=key + '\n')
+        target = 'globbed/target'
+        self.s3.put_object(Bucket=bucket, Key=target, Body='head\n')
+
+        self.s3concat(['s3://{}/{}'.format(bucket, target),
+                       's3://{}/{}'.format(bucket, pattern)])
+
+        resp = self.s3.get_object(Bucket=bucket, Key=target)
+        assert resp['Body'].read() == 'head\n' + ''.join(
+            key + '\n' for key in keys)
+        self.s3.delete_object(Bucket=bucket, Key=target)
+
+    def test_listing_is_lazy(self, monkeypatch):
+        from s3concat.s3concat import _iter_sources
+        pages = []
+        list_objects_v2 = self.s3.list_objects_v2
+        monkeypatch.setattr(self.s3, 'list_objects_v2', lambda **kwargs: (
+            pages.append(kwargs), list_objects_v2(MaxKeys=1, **kwargs))[1])
+        bucket = self.buckets[1]
+        for key in ('a', 'b', 'c'):
+            self.s3.put_object(Bucket=bucket, Key='lazy/' + key, Body=key)
+
+        sources = _iter_sources(self.s3, [
+            's3://{}/lazy-target'.format(bucket),
+            's3://{}/lazy/'.format(bucket)])
+        next(sources)
+        assert next(sources).s3url.key == 'lazy/a'
+        assert len(pages) == 1
+        assert [o.s3url.key for o in sources] == ['lazy/b', 'lazy/c']
+        assert len(pages) >= 3
+
+    def test_pattern_target(self):
+        bucket = self.buckets[1]
+        with pytest.raises(ValueError) as exc:
+            self.s3concat(['s3://{}/a/'.format(bucket),
+                           self.to_url(1, 1 * KB)])
+        assert 'must name an object' in exc.value.message
+
+    def test_literal_keys_with_glob_chars(self):
+        bucket = self.buckets[1]
+        for key in ('literal/data1.csv', 'literal/data[1].csv'):
+            self.s3.put_object(Bucket=bucket, Key=key, Body=key + '\n')
+        target = 'literal/out[*]'
+
+        self.s3concat(['s3://{}/{}'.format(bucket, target),
+                       's3://{}/literal/data[1].csv'.format(bucket),
+                       's3://{}/literal/data[1].csv'.format(bucket)])
+
+        resp = self.s3.get_object(Bucket=bucket, Key=target)
+        assert resp['Body'].read() == 'literal/data[1].csv\n' * 2
+        # Without an object of that exact key, the URL is a glob.
+        self.s3.delete_object(Bucket=bucket, Key='literal/data[1].csv')
+        self.s3concat(['s3://{}/{}'.format(bucket, target),
+                       's3://{}/literal/data[1].csv'.format(bucket)])
+        resp = self.s3.get_object(Bucket=bucket, Key=target)
+        assert resp['Body'].read() == (
+            'literal/data[1].csv\n' * 2 + 'literal/data1.csv\n')
+
+    def test_metadata_cache(self, monkeypatch):
+        from s3concat import s3concat_content
+        from s3concat.cache import metadata_cache
+        heads = []
+        head_object = self.s3.head_object
+        monkeypatch.setattr(self.s3, 'head_object', lambda **kwargs: (
+            heads.append(kwargs), head_object(**kwargs))[1])
+        bucket = self.buckets[1]
+        key = 'cached'
+
+        s3concat_content(bucket, key, 'a', client=self.s3)
+        s3concat_content(bucket, key, 'b', client=self.s3)
+        s3concat_content(bucket, key, 'c', client=self.s3)
+        assert len(heads) == 1
+        info = self.get_object_info(bucket, key)
+        assert info['ContentLength'] == 3
+        assert info['ETag'] == self.s3.head_object(
+            Bucket=bucket, Key=key)['ETag']
+
+        self.s3.put_object(Bucket=bucket, Key='cached-2', Body='de')
+        self.s3concat(['s3://{}/cached-all'.format(bucket),
+                       's3://{}/{}'.format(bucket, key),
+                       's3://{}/cached-2'.format(bucket)], remove_orig=True)
+        assert self.get_object_info(bucket, key) is None
+        assert self.get_object_info(
+            bucket, 'cached-all')['ContentLength'] == 5
+
+        # Not trusting its own writes, every append looks the object up.
+        monkeypatch.setattr(metadata_cache, 'write_ttl', 0)
+        del heads[:]
+        s3concat_content(bucket, key, 'a', client=self.s3)
+        s3concat_content(bucket, key, 'b', client=self.s3)
+        assert heads == [{'Bucket': bucket, 'Key': key}] * 2
+        metadata_cache.clear()
+
+    def test_s3concat_resume(self, monkeypatch, tmpdir):
+        from botocore.exceptions import ClientError
+        from s3concat import s3concat_resume
+        bucket = self.buckets[0]
+        key = 'resumed'
+        sizes = [5 * MB, 7 * MB, 3 * MB, 7 * MB]
+        urls = ['s3://{}/{}'.format(bucket, key)] + [
+            self.to_url(0, size) for size in sizes]
+        content = ''.join(self.env['objects'][bucket][str(size)]
+                          for size in sizes)
+        journal = str(tmpdir.join('journal'))
+
+        copies = []
+        crashing = [True]
+        upload_part_copy = self.s3.upload_part_copy
+
+        def crash(**kwargs):
+            copies.append(kwargs)
+            if crashing[0] and len(copies) == 2:
+                raise ClientError({'Error': {'Code': 'AccessDenied'}},
+                                  'UploadPartCopy')
+            return upload_part_copy(**kwargs)
+
+        monkeypatch.setattr(self.s3, 'upload_part_copy', crash)
+        with pytest.raises(ClientError):
+            self.s3concat(urls, concurrency=1, client=self.s3,
+                          journal=journal)
+        assert tmpdir.join('journal').check()
+        assert self.get_object_info(bucket, key) is None
+
+        del copies[:]
+        crashing[0] = False
+        s3concat_resume(journal, concurrency=1, client=self.s3)
+
+        assert str(5 * MB) not in [c['CopySource']['Key'] for c in copies]
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content) == md5(resp['Body'].read())
+        assert not tmpdir.join('journal').check()
+
+    def test_s3concat_resume_without_job(self, tmpdir):
+        from s3concat import s3concat_resume
+        with pytest.raises(ValueError) as exc:
+            s3concat_resume(str(tmpdir.join('journal')), client=self.s3)
+        assert 'No concatenation recorded' in exc.value.message
+
+    def test_s3concat_copy_part_size(self, monkeypatch):
+        bucket = self.buckets[1]
+        key = 'split-copy'
+        head = generate_file(16 * MB)
+        self.s3.put_object(Bucket=bucket, Key=key, Body=head)
+        ranges = []
+        upload_part_copy = self.s3.upload_part_copy
+        monkeypatch.setattr(self.s3, 'upload_part_copy', lambda **kwargs: (
+            ranges.append(kwargs['CopySourceRange']),
+            upload_part_copy(**kwargs))[1])
+
+        self.s3concat(['s3://{}/{}'.format(bucket, key),
+                       self.to_url(1, 1 * KB)],
+                      client=self.s3, copy_part_size=5 * MB)
+
+        # Three ranges of the 16 MB head, then the small trailing source.
+        assert len(ranges) == 4
+        assert ranges[2] == 'bytes={}-{}'.format(32 * MB // 3 + 1, 16 * MB - 1)
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(head + self.env['objects'][bucket][str(1 * KB)]) == md5(
+            resp['Body'].read())
+
+    def test_invalid_copy_part_size(self):
+        with pytest.raises(ValueError) as exc:
+            self.s3concat([self.to_url(1, 'x'), self.to_url(1, 1 * KB)],
+                          copy_part_size=1 * MB)
+        assert 'Copy part size' in exc.value.message
+
+    def test_s3concat_streams_sources(self, monkeypatch):
+        from s3concat import executors
+        from s3concat.planner import StreamPlanner
+        monkeypatch.setattr(StreamPlanner, 'CHECK_INTERVAL', 1)
+        # Unpatched gevent runs lookups ahead without yielding.
+        monkeypatch.setattr(executors, '_backend', executors.ThreadBackend())
+        bucket = self.buckets[0]
+        sizes = [7 * MB, 5 * MB, 7 * MB, 5 * MB, 3 * MB, 7 * MB]
+        consumed = []
+        started = []
+        create_multipart_upload = self.s3.create_multipart_upload
+
+        def urls():
+            yield 's3://{}/streamed'.format(bucket)
+            for size in sizes:
+                consumed.append(size)
+                yield self.to_url(0, size)
+
+        def create(**kwargs):
+            started.append(len(consumed))
+            return create_multipart_upload(**kwargs)
+
+        monkeypatch.setattr(self.s3, 'create_multipart_upload', create)
+        self.s3concat(urls(), concurrency=1, client=self.s3)
+
+        # The upload began before all sources were looked up.
+        assert started[0] < len(sizes)
+        content = ''.join(self.env['objects'][bucket][str(size)]
+                          for size in sizes)
+        resp = self.s3.get_object(Bucket=bucket, Key='streamed')
+        assert md5(content) == md5(resp['Body'].read())
+
+    def test_s3concat_report(self):
+        from s3concat.metrics import Hook
+
+        class Collect(Hook):
+            events = []
+            reports = []
+
+            def request(self, event):
+                self.events.append(event)
+
+            def finish(self, report):
+                self.reports.append(report)
+
+        hook = Collect()
+        bucket = self.buckets[0]
+        urls = ['s3://{}/reported'.format(bucket), self.to_url(0, 3 * MB),
+                self.to_url(0, 5 * MB), self.to_url(0, 7 * MB)]
+        report = self.s3concat(urls, hooks=[hook])
+
+        assert hook.reports == [report]
+        assert len(hook.events) == report.requests
+        assert report.operations['head_object'].count == 4
+        assert report.operations['upload_part_copy'].count == 1
+        assert report.operations['complete_multipart_upload'].count == 1
+        # 3 MB and the head of 5 MB are packed; the rest is copied.
+        assert report.bytes_downloaded == 8 * MB
+        assert report.bytes_uploaded == 8 * MB
+        assert report.bytes_copied == 7 * MB
+        assert report.retries == 0
+        assert report.max_in_flight >= 1
+        assert report.wall_time > 0
+
+    def test_s3concat_local_files(self, tmpdir):
+        from s3concat import s3concat_plan
+        bucket = self.buckets[0]
+        big = generate_file(6 * MB)
+        small = generate_file(10 * KB)
+        tmpdir.join('big').write(big, 'wb')
+        tmpdir.join('small').write(small, 'wb')
+        urls = [self.to_url(0, 5 * MB), str(tmpdir.join('big')),
+                self.to_url(0, 3 * MB), 'file://' + str(tmpdir.join('small')),
+                str(tmpdir.join('missing'))]
+
+        plan = s3concat_plan(urls)
+        assert plan.estimate.bytes_uploaded >= 6 * MB + 10 * KB
+        assert plan.estimate.gets == 1
+
+        self.s3.put_object(Bucket=bucket, Key='local',
+                           Body=self.env['objects'][bucket][str(5 * MB)])
+        urls[0] = 's3://{}/local'.format(bucket)
+        self.s3concat(urls, remove_orig=True)
+
+        content = (self.env['objects'][bucket][str(5 * MB)] + big +
+                   self.env['objects'][bucket][str(3 * MB)] + small)
+        resp = self.s3.get_object(Bucket=bucket, Key='local')
+        assert md5(content) == md5(resp['Body'].read())
+        assert not tmpdir.join('big').check()
+        assert not tmpdir.join('small').check()
+        self.s3.put_object(Bucket=bucket, Key=str(3 * MB),
+                           Body=self.env['objects'][bucket][str(3 * MB)])
+
+    def test_s3concat_local_target(self, tmpdir):
+        tmpdir.join('x').write('x')
+        with pytest.raises(ValueError) as exc:
+            self.s3concat([str(tmpdir.join('x')), self.to_url(1, 1 * KB)])
+        assert 'local file' in exc.value.message
+
+    @pytest.mark.parametrize('tamper', [None, 'upload_part_copy',
+                                        'complete_multipart_upload'])
+    def test_s3concat_verify(self, tmpdir, tamper):
+        from s3concat import IntegrityError
+        bucket = self.buckets[0]
+        self.s3.copy_object(Bucket=bucket, Key='verified', CopySource={
+            'Bucket': bucket, 'Key': str(5 * MB)})
+        tmpdir.join('local').write('l' * (6 * MB))
+        urls = ['s3://{}/verified'.format(bucket), self.to_url(0, 7 * MB),
+                self.to_url(0, 3 * MB), self.to_url(1, 1 * KB),
+                str(tmpdir.join('local'))]
+        client = CompositeETagClient(self.s3, tamper)
+        if tamper is not None:
+            with pytest.raises(IntegrityError):
+                self.s3concat(urls, client=client, verify=True)
+            return
+
+        self.s3concat(urls, client=client, verify=True)
+        objs = self.env['objects']
+        content = (objs[bucket][str(5 * MB)] + objs[bucket][str(7 * MB)] +
+                   objs[bucket][str(3 * MB)] +
+                   objs[self.buckets[1]][str(1 * KB)] + 'l' * (6 * MB))
+        resp = self.s3.get_object(Bucket=bucket, Key='verified')
+        assert md5(content) == md5(resp['Body'].read())
+
+    @pytest.mark.parametrize('sizes', [(KB,), (KB, 6 * MB), (6 * MB, KB)])
+    def test_s3concat_content_verify(self, sizes):
+        from s3concat import s3concat_content
+        bucket = self.buckets[1]
+        key = random_chars()
+        content = ''
+        for size in sizes:
+            data = generate_file(size)
+            content += data
+            s3concat_content(bucket, key, data, verify=True,
+                             client=CompositeETagClient(self.s3),
+                             copy_part_size=5 * MB)
+        resp = self.s3.get_object(Bucket=bucket, Key=key)
+        assert md5(content) == md5(resp['Body'].read())
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import gevent
+import gevent.event
+import pytest
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+
+from s3concat.scheduler import Scheduler
+from s3concat.scheduler import ScheduledClient
+from s3concat.scheduler import scheduled
+
+
+def error(code, status=None):
+    return ClientError({'Error': {'Code': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}},
+                       'HeadObject')
+
+
+class Flaky(object):
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return kwargs
+
+
+@pytest.fixture
+def sleeps():
+    return []
+
+
+@pytest.fixture
+def scheduler(sleeps):
+    return Scheduler(maximum=8, max_attempts=3, sleep=sleeps.append,
+                     random=lambda: 1.)
+
+
+@pytest.mark.parametrize('exc', [
+    error('SlowDown'), error('Unknown', 503), error('InternalError'),
+    EndpointConnectionError(endpoint_url='http://s3')])
+def test_retry(scheduler, sleeps, exc):
+    func = Flaky(exc, exc)
+    assert scheduler.call('b', 'k', func, Key='k') == {'Key': 'k'}
+    assert func.calls == 3
+    assert sleeps == [0.1, 0.2]
+
+
+def test_retries_exhausted(scheduler):
+    func = Flaky(*[error('SlowDown')] * 3)
+    with pytest.raises(ClientError):
+        scheduler.call('b', 'k', func)
+    assert func.calls == 3
+
+
+@pytest.mark.parametrize('code', [
+    '404', 'AccessDenied', 'NoSuchUpload', 'RequestTimeTooSkewed'])
+def test_no_retry(scheduler, sleeps, code):
+    func = Flaky(error(code))
+    with pytest.raises(ClientError):
+        scheduler.call('b', 'k', func)
+    assert func.calls == 1
+    assert not sleeps
+
+
+def test_backoff_capped(sleeps):
+    scheduler = Scheduler(max_attempts=10, backoff=1., max_backoff=5.,
+                          sleep=sleeps.append, random=lambda: 1.)
+    scheduler.call('b', 'k', Flaky(*[error('SlowDown')] * 5))
+    assert sleeps == [1., 2., 4., 5., 5.]
+
+
+def test_throttling_limits_prefix(scheduler):
+    entered = []
+    release = gevent.event.Event()
+
+    def request(**kwargs):
+        entered.append(kwargs)
+        if len(entered) == 1:
+            gevent.sleep(0)
+            raise error('SlowDown')
+        release.wait()
+
+    greenlets = [gevent.spawn(scheduler.call, 'b', 'p/k', request, n=n)
+                 for n in xrange(4)]
+    gevent.sleep(0.01)
+    # Four requests were in flight when one was throttled.
+    assert scheduler.limit('b', 'p/x') == 2
+    assert scheduler.limit('b', 'q/x') == 8
+    assert scheduler.limit('other', 'p/x') == 8
+
+    release.set()
+    gevent.joinall(greenlets, raise_error=True)
+    assert len(entered) == 5
+
+
+def test_limit_bounds_requests_in_flight(scheduler):
+    in_flight = [0]
+    peak = [0]
+
+    def request():
+        in_flight[0] += 1
+        assert in_flight[0] <= scheduler.limit('b', 'k')
+        peak[0] = max(peak[0], in_flight[0])
+        gevent.sleep(0.001)
+        in_flight[0] -= 1
+
+    scheduler.call('b', 'k', Flaky(error('SlowDown')))
+    assert scheduler.limit('b', 'k') == 2
+    gevent.joinall([gevent.spawn(scheduler.call, 'b', 'k', request)
+                    for _ in xrange(20)], raise_error=True)
+    assert 2 <= peak[0] < 8
+
+
+def test_limit_recovers(scheduler):
+    scheduler.call('b', 'k', Flaky(error('SlowDown')))
+    for _ in xrange(30):
+        gevent.joinall([gevent.spawn(scheduler.call, 'b', 'k', gevent.sleep)
+                        for _ in xrange(8)], raise_error=True)
+    assert scheduler.limit('b', 'k') == 8
+    assert not scheduler._limiters
+
+
+def test_scheduled_client(scheduler):
+    class Client(object):
+        meta = 'meta'
+        head_object = Flaky(error('SlowDown'))
+
+        def get_paginator(self, name):
+            return name
+
+    client = scheduled(Client(), scheduler)
+    assert isinstance(client, ScheduledClient)
+    assert scheduled(client) is client
+    assert client.head_object(Bucket='b', Key='k') == {
+        'Bucket': 'b', 'Key': 'k'}
+    assert Client.head_object.calls == 2
+    assert client.meta == 'meta'
+    assert client.get_paginator('x') == 'x'
+
+
+@pytest.mark.parametrize('recorded', [False, True])
+def test_retry_rewinds_body(scheduler, recorded):
+    from StringIO import StringIO
+    from s3concat.metrics import Recorder
+    sent = []
+
+    class Client(object):
+
+        def upload_part(self, Body, **kwargs):
+            sent.append(Body.read())
+            if len(sent) == 1:
+                raise error('SlowDown')
+            return {}
+
+    body = StringIO('headbody')
+    body.read(4)
+    recorder = Recorder() if recorded else None
+    scheduled(Client(), scheduler, recorder).upload_part(
+        Bucket='b', Key='k', Body=body)
+    assert sent == ['body', 'body']
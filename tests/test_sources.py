@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from s3concat.sources import S3Obj
+from s3concat.sources import SourceTable
+from s3concat.urls import S3URL
+
+
+ROWS = [
+    ('b1', 'logs/a', 10, '"d41d8cd98f00b204e9800998ecf8427e"'),
+    ('b2', 'logs/b', 0, '"0123456789abcdef0123456789abcdef-12"'),
+    ('b1', u'logs/\xe9', 5 * 1024**4, None),
+    ('b1', 'logs/?#[', 7, 'opaque'),
+]
+
+
+def test_rows_round_trip():
+    table = SourceTable(ROWS)
+    assert len(table) == 4
+    for i, (bucket, key, size, etag) in enumerate(ROWS):
+        assert table.bucket(i) == bucket
+        assert table.key(i) == key
+        assert table.sizes[i] == size
+        assert table.etag(i) == etag
+    assert list(table.sizes) == [10, 0, 5 * 1024**4, 7]
+
+
+def test_buckets_interned():
+    table = SourceTable(ROWS)
+    assert table._buckets == ['b1', 'b2']
+
+
+def test_getitem():
+    table = SourceTable(ROWS)
+    o = table[-1]
+    assert isinstance(o, S3Obj)
+    assert str(o.s3url) == 's3://b1/logs/?#['
+    assert o.info == {'ContentLength': 7, 'ETag': 'opaque'}
+    with pytest.raises(IndexError):
+        table[4]
+
+
+def test_slice():
+    sliced = SourceTable(ROWS)[1:3]
+    assert isinstance(sliced, SourceTable)
+    assert [(o.s3url.bucket, o.s3url.key) for o in sliced] == [
+        ('b2', 'logs/b'), ('b1', u'logs/\xe9')]
+
+
+def test_from_objs():
+    objs = [S3Obj(S3URL('s3://b/k1'), {'ContentLength': 1, 'ETag': None}),
+            S3Obj(S3URL.from_parts('b', 'k2'), {'ContentLength': 2})]
+    table = SourceTable.from_objs(objs)
+    assert [table.key(i) for i in xrange(2)] == ['k1', 'k2']
+    assert table.etag(1) is None
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import random
+import string
+
+import pytest
+
+from s3concat.split import _cuts
+
+
+KB = 1024
+MB = KB**2
+
+
+def test_cuts():
+    assert _cuts(10, None, 4) == [4, 8]
+    assert _cuts(8, None, 4) == [4]
+    assert _cuts(10, [7, 0, 3, 3, 10], None) == [3, 7]
+    for offsets, chunk_size in [(None, None), ([1], 4), (None, 0),
+                                ([11], None), ([-1], None)]:
+        with pytest.raises(ValueError):
+            _cuts(10, offsets, chunk_size)
+
+
+@pytest.fixture
+def bucket(s3):
+    bucket = 's3concat-test-' + ''.join(
+        random.choice(string.ascii_lowercase) for _ in xrange(12))
+    s3.create_bucket(Bucket=bucket)
+    yield bucket
+    resp = s3.list_objects_v2(Bucket=bucket)
+    if 'Contents' in resp:
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [
+            {'Key': rec['Key']} for rec in resp['Contents']]})
+    s3.delete_bucket(Bucket=bucket)
+
+
+def records(rand, count):
+    return ''.join(
+        ''.join(rand.choice(string.ascii_letters)
+                for _ in xrange(rand.choice([1, 10, 300, 5000]))) + '\n'
+        for _ in xrange(count))
+
+
+def outputs(s3, bucket, split):
+    return [s3.get_object(Bucket=bucket, Key=s3url.key)['Body'].read()
+            for s3url, _ in split.outputs]
+
+
+def test_s3split_on_delimiter(s3, bucket):
+    from s3concat import s3split
+    data = records(random.Random(0), 200)
+    s3.put_object(Bucket=bucket, Key='src', Body=data)
+
+    split = s3split('s3://{}/src'.format(bucket),
+                    's3://{}/out/'.format(bucket), chunk_size=32 * KB,
+                    delimiter='\n', probe_size=KB)
+
+    chunks = outputs(s3, bucket, split)
+    assert ''.join(chunks) == data
+    assert all(chunk.endswith('\n') for chunk in chunks)
+    assert 1 < len(chunks) <= -(-len(data) // (32 * KB))
+    assert [s3url.key for s3url, _ in split.outputs] == [
+        'out/part-{:05d}'.format(i) for i in xrange(len(chunks))]
+    assert 'upload_part' not in split.report.operations
+    # Only the ranges probed for newlines are downloaded.
+    assert split.report.bytes_downloaded < len(data) // 4
+
+
+def test_s3split_offsets(s3, bucket):
+    from s3concat import s3split
+    data = ''.join(chr(ord('a') + i) * (3 * MB) for i in xrange(6))
+    s3.put_object(Bucket=bucket, Key='src', Body=data)
+
+    split = s3split('s3://{}/src'.format(bucket),
+                    's3://{}/out-'.format(bucket), offsets=[KB, 12 * MB],
+                    name='{}', copy_part_size=5 * MB)
+
+    assert [(s3url.key, byte_range) for s3url, byte_range in
+            split.outputs] == [('out-0', (0, KB - 1)),
+                               ('out-1', (KB, 12 * MB - 1)),
+                               ('out-2', (12 * MB, 18 * MB - 1))]
+    assert outputs(s3, bucket, split) == [
+        data[:KB], data[KB:12 * MB], data[12 * MB:]]
+    assert split.report.operations['upload_part_copy'].count == 4
+
+
+def test_s3split_part_limit(s3, bucket, monkeypatch):
+    from s3concat import planner
+    from s3concat import s3split
+    monkeypatch.setattr(planner, 'MAX_PARTS', 2)
+    data = ''.join(chr(ord('a') + i) * (5 * MB) for i in xrange(6))
+    s3.put_object(Bucket=bucket, Key='src', Body=data)
+
+    split = s3split('s3://{}/src'.format(bucket),
+                    's3://{}/out-'.format(bucket), chunk_size=20 * MB,
+                    name='{}', copy_part_size=5 * MB)
+
+    assert outputs(s3, bucket, split) == [data[:20 * MB], data[20 * MB:]]
+    # 20 MB in two parts of 10 MB, then 10 MB in two of 5 MB.
+    assert split.report.operations['upload_part_copy'].count == 4
+
+
+def test_s3split_errors(s3, bucket):
+    from s3concat import s3split
+    s3.put_object(Bucket=bucket, Key='src', Body='abc\n')
+    with pytest.raises(ValueError):
+        s3split('s3://{}/missing'.format(bucket),
+                's3://{}/out/'.format(bucket), chunk_size=1)
+    with pytest.raises(ValueError):
+        s3split('s3://{}/src'.format(bucket), 's3://{}/'.format(bucket),
+                offsets=[2], name='src')
+    with pytest.raises(ValueError):
+        s3split('s3://{}/src'.format(bucket), 's3://{}/'.format(bucket),
+                chunk_size=1, delimiter='\r\n')